@@ -0,0 +1,236 @@
+# Нагрузочный прогон бота целиком: настоящий ConversationHandler из build_application,
+# N пользователей одновременно создают напоминание кнопками, потом все напоминания срабатывают разом
+# Запуск: python benchmarks/bench_load.py [число пользователей через запятую, по умолчанию 1000,10000,100000]
+# Вместо Telegram - поддельный Bot API прямо в процессе бота (свой BaseRequest): сети нет,
+# меряется только сам бот. Каждый размер гоняется в отдельном процессе, чтобы пик памяти был честным
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from collections import Counter
+from datetime import datetime, timedelta
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = "1000,10000,100000"
+TOKEN = "123456:bench"
+FIRST_USER_ID = 1_000_000
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+# Методы, в ответ на которые Telegram присылает сообщение
+MESSAGE_METHODS = {"sendMessage", "sendPhoto", "editMessageText"}
+# Через сколько после срабатывания напоминаний приходят скрытые (у бота - 10 минут)
+HIDDEN_DELAY = timedelta(seconds=1)
+FIRE_TIMEOUT = 600
+
+bot = None  # модуль бота, импортируется в процессе замера уже во временной папке
+
+def make_fake_request():
+    """Поддельный Bot API: отвечает как Telegram и считает вызовы по методам"""
+    from telegram.request import BaseRequest
+
+    class FakeBotApi(BaseRequest):
+        def __init__(self):
+            self.calls = Counter()
+            self.message_ids = itertools.count(1)
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            # Настоящий запрос отдаёт управление циклу событий, иначе таймеры бота не успевают сработать
+            await asyncio.sleep(0)
+            api_method = url.rsplit("/", 1)[1]
+            params = request_data.parameters if request_data is not None else {}
+            self.calls[api_method] += 1
+            result = True
+            if api_method == "getMe":
+                result = BOT_USER
+            elif api_method in MESSAGE_METHODS:
+                result = {"message_id": next(self.message_ids), "date": int(time.time()),
+                          "chat": {"id": int(params.get("chat_id", 0)), "type": "private"}, "text": ""}
+                if api_method == "sendPhoto":
+                    result["photo"] = [{"file_id": "photo", "file_unique_id": "photo", "width": 1, "height": 1}]
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return FakeBotApi()
+
+def message_update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": "Котик"}
+    message = {"message_id": update_id, "date": int(time.time()), "text": text,
+               "chat": {"id": user_id, "type": "private"}, "from": user}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+def button_update(update_id, user_id, data):
+    user = {"id": user_id, "is_bot": False, "first_name": "Котик"}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": str(user_id), "from": user, "data": data,
+        "message": {"message_id": 1, "date": int(time.time()), "text": "",
+                    "chat": {"id": user_id, "type": "private"}},
+    }}
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def wait_sent(fake, api_method, total):
+    """Ждёт, пока поддельный Telegram получит total вызовов метода; возвращает время (time.time)"""
+    deadline = time.monotonic() + FIRE_TIMEOUT
+    while fake.calls[api_method] < total and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    return time.time()
+
+async def run_users(count):
+    """Один замер на count пользователей; возвращает словарь с результатами"""
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder, TypeHandler
+
+    fake = make_fake_request()
+    application = bot.build_application(ApplicationBuilder().token(TOKEN).request(fake).updater(None))
+
+    # Время ожидания считаем от попадания в очередь, время обработки - от первого до последнего обработчика
+    pending = {}  # update_id -> (future, время в очереди)
+    started_at = {}
+    waits, handling = [], []
+
+    async def on_start(update, context):
+        started_at[update.update_id] = time.perf_counter()
+
+    async def on_done(update, context):
+        now = time.perf_counter()
+        future, queued = pending.pop(update.update_id)
+        waits.append(now - queued)
+        handling.append(now - started_at.pop(update.update_id))
+        future.set_result(None)
+
+    application.add_handler(TypeHandler(Update, on_start), group=-1)
+    application.add_handler(TypeHandler(Update, on_done), group=1)
+
+    # Напоминание на время через 3 часа по Москве: попадает в окно планировщика
+    fire_local = datetime.now(bot.tz_service.tzinfo(bot.DEFAULT_TIMEZONE)) + timedelta(hours=3)
+    steps = [
+        (message_update, "/start"), (button_update, "what"), (message_update, "купить молоко"),
+        (button_update, "when"), (button_update, f"calendar_{fire_local.date().isoformat()}"),
+        (button_update, f"hour_{fire_local.hour:02}"), (button_update, f"minute_{fire_local.minute:02}"),
+        (button_update, "daily"),
+    ]
+    update_ids = itertools.count(1)
+    loop = asyncio.get_running_loop()
+
+    async def user_flow(user_id):
+        for make, data in steps:
+            update_id = next(update_ids)
+            future = loop.create_future()
+            pending[update_id] = (future, time.perf_counter())
+            await application.update_queue.put(Update.de_json(make(update_id, user_id, data), application.bot))
+            await future
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(user_flow(FIRST_USER_ID + i) for i in range(count)))
+        flow_elapsed = time.perf_counter() - started
+        scheduled = sum(len(jobs) for jobs in bot.scheduled_jobs.values())
+
+        # Все напоминания срабатывают разом; скрытые - через HIDDEN_DELAY
+        photos, messages = fake.calls["sendPhoto"], fake.calls["sendMessage"]
+        reminders = [reminder for jobs in bot.scheduled_jobs.values() for reminder in jobs.values()]
+        fire_at = time.time()
+        for reminder in reminders:
+            bot.scheduler.cancel(reminder.entry_id)
+            reminder.next_fire = fire_at
+        bot.scheduler.add_many(reminders)
+        main_elapsed = await wait_sent(fake, "sendPhoto", photos + len(reminders)) - fire_at
+        hidden_elapsed = (await wait_sent(fake, "sendMessage", messages + len(reminders)) - fire_at
+                          - HIDDEN_DELAY.total_seconds())
+
+        started = time.perf_counter()
+        await bot.store.flush()
+        flush_elapsed = time.perf_counter() - started
+    finally:
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+    persist = [series for (name, _), series in bot.metrics.series.items()
+               if name == "napominalochka_persist_seconds"]
+    return {
+        "users": count,
+        "updates": len(waits),
+        "scheduled": scheduled,
+        "updates_per_second": len(waits) / flow_elapsed,
+        "wait_p50": percentile(waits, 0.5), "wait_p99": percentile(waits, 0.99),
+        "handler_p50": percentile(handling, 0.5), "handler_p99": percentile(handling, 0.99),
+        "fired": fake.calls["sendPhoto"] - photos, "hidden": fake.calls["sendMessage"] - messages,
+        "main_seconds": main_elapsed, "hidden_seconds": hidden_elapsed,
+        "delivery_lag_p99": bot.delivery.lag.quantile(0.99),
+        "persist_batches": sum(series.count for series in persist),
+        "persist_seconds": sum(series.sum for series in persist),
+        "persist_max": max((series.max for series in persist), default=0.0),
+        "flush_seconds": flush_elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def measure(count):
+    """Процесс замера: своя временная папка, тихий бот без лимитов Telegram и сервера метрик"""
+    global bot
+    warnings.filterwarnings("ignore", message="If 'per_message=False'")
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, BOT_DIR)
+    bot = importlib.import_module("napominalochka")
+    bot.print = lambda *args, **kwargs: None
+    bot.HIDDEN_REMINDER_DELAY = HIDDEN_DELAY
+    bot.METRICS_REPORT_INTERVAL = None
+    bot.metrics.port = None
+    bot.DELIVERY_CHAT_RATE = bot.DELIVERY_CHAT_BURST = 10 ** 9
+    bot.delivery.global_bucket = bot.TokenBucket(10 ** 9, 10 ** 9)
+    result = asyncio.run(run_users(count))
+    bot.store.close()
+    return result
+
+def report(result):
+    print(f"👥 {result['users']} пользователей:")
+    print(f"   - диалог: {result['updates']} обновлений, {result['updates_per_second']:,.0f} в секунду, "
+          f"запланировано {result['scheduled']}")
+    print(f"   - обработка: p50 {result['handler_p50'] * 1000:.2f} мс, p99 {result['handler_p99'] * 1000:.2f} мс; "
+          f"с ожиданием в очереди: p50 {result['wait_p50'] * 1000:.1f} мс, p99 {result['wait_p99'] * 1000:.1f} мс")
+    print(f"   - срабатывание: {result['fired']} напоминаний за {result['main_seconds']:.2f} с, "
+          f"{result['hidden']} скрытых за {result['hidden_seconds']:.2f} с, "
+          f"задержка доставки p99 {result['delivery_lag_p99']:.2f} с")
+    print(f"   - запись: {result['persist_batches']} пачек, всего {result['persist_seconds']:.2f} с, "
+          f"самая долгая {result['persist_max'] * 1000:.1f} мс, финальный flush {result['flush_seconds'] * 1000:.1f} мс")
+    print(f"   - пик памяти: {result['peak_rss_mb']:.0f} МБ")
+
+def main():
+    sizes = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SIZES
+    for count in map(int, sizes.split(",")):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--users", str(count)],
+                                check=True, stdout=subprocess.PIPE, text=True).stdout
+        report(json.loads(output.strip().splitlines()[-1]))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--users":
+        print(json.dumps(measure(int(sys.argv[2]))))
+    else:
+        main()
@@ -0,0 +1,139 @@
+# Замер восстановления напоминаний при запуске на синтетических данных
+# Запуск: python benchmarks/bench_restore.py [количество напоминаний]
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+# Сколько напоминаний прогнать по одному через schedule_reminder для сравнения
+SINGLE_COUNT = 10_000
+REMINDERS_PER_USER = 5
+
+# Файлы хранилища создаются во временной папке, а не рядом с ботом
+os.chdir(tempfile.mkdtemp())
+sys.path.insert(0, BOT_DIR)
+import napominalochka as bot
+
+def make_reminders(count):
+    """Синтетические напоминания: случайные даты за 10 лет, время, повторения и пояса"""
+    random.seed(42)
+    timezones = [tz for _, tz in bot.RUSSIAN_TIMEZONES.values()]
+    first_day = date(2016, 1, 1).toordinal()
+    reminders, user_timezones = {}, {}
+    for i in range(count):
+        user_id = 1_000_000 + i // REMINDERS_PER_USER
+        if user_id not in user_timezones:
+            user_timezones[user_id] = random.choice(timezones)
+            reminders[str(user_id)] = {}
+        # Напоминание в том виде, в каком оно лежит в снапшоте (Reminder.to_row)
+        reminders[str(user_id)][i + 1] = [
+            f"напоминание {i}", first_day + random.randrange(3650),
+            random.randrange(24), random.randrange(60), random.randrange(len(bot.REPEAT_NAMES)), 0, None
+        ]
+    return reminders, user_timezones
+
+def open_fresh_store(reminders, user_timezones):
+    """Новая папка с JSON-снапшотами, как у бота после перезапуска"""
+    os.chdir(tempfile.mkdtemp())
+    with open(bot.DATA_FILE, 'w', encoding='utf-8') as f:
+        json.dump(reminders, f, ensure_ascii=False, default=bot.encode_reminder)
+    with open(bot.TIMEZONE_FILE, 'w', encoding='utf-8') as f:
+        json.dump(user_timezones, f)
+    bot.store = bot.JsonStore()
+    bot.scheduler = bot.ReminderScheduler()
+    bot.scheduled_jobs.clear()
+    bot.tz_service.user_timezones.clear()
+
+async def watch_stalls(stalls):
+    """Самая долгая остановка цикла событий: столько ждал бы ответа нажатый в это время пользователь"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(0.005)
+        stalls.append(time.perf_counter() - started - 0.005)
+
+async def measure(restore, reminders, user_timezones, stalls=None):
+    open_fresh_store(reminders, user_timezones)
+    watcher = asyncio.create_task(watch_stalls(stalls if stalls is not None else []))
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    restored = await restore(float("inf"))
+    elapsed = time.perf_counter() - started
+    watcher.cancel()
+    # Запись next_fire в журнал идёт в фоне и в замер не входит
+    await bot.store.flush()
+    saved = {user_id: dict(reminders) for user_id, reminders in bot.store.reminders.items()}
+    bot.store.close()
+    return restored, elapsed, saved
+
+def measure_open(saved, user_timezones):
+    """Открытие хранилища при запуске: из JSON-снапшота (первый запуск) и из двоичного (следующие)"""
+    open_fresh_store(saved, user_timezones)
+    bot.store.close()
+    started = time.perf_counter()
+    bot.store = bot.JsonStore()
+    binary_elapsed = time.perf_counter() - started
+    bot.store.close()
+    # Сам разбор JSON-снапшота, как делал бот до двоичного формата
+    json_store = bot.Journal(bot.DATA_FILE, bot.DATA_JOURNAL_FILE, bot.apply_data_record,
+                             decode_value=bot.decode_reminders, encode=bot.encode_reminder)
+    json_store._rewrite(saved)
+    started = time.perf_counter()
+    json_store.load()
+    json_elapsed = time.perf_counter() - started
+    json_store.close()
+    return json_elapsed, binary_elapsed
+
+async def main():
+    print(f"🧪 Генерация {COUNT} напоминаний...")
+    reminders, user_timezones = make_reminders(COUNT)
+
+    stalls = []
+    restored, elapsed, saved = await measure(bot.bulk_schedule_due, reminders, user_timezones, stalls)
+    print(f"⚡ Пакетное восстановление: {restored} напоминаний за {elapsed:.2f} с "
+          f"({restored / elapsed:,.0f} в секунду), цикл событий стоял до {max(stalls):.2f} с")
+
+    # То же с расчётом срабатываний в пуле процессов
+    bot.cpu_pool.start()
+    stalls = []
+    restored, elapsed, _ = await measure(bot.bulk_schedule_due, reminders, user_timezones, stalls)
+    bot.cpu_pool.stop()
+    print(f"⚡ С пулом процессов ({bot.cpu_pool.workers}): {restored} напоминаний за {elapsed:.2f} с, "
+          f"цикл событий стоял до {max(stalls):.2f} с")
+
+    # Только расчёт срабатываний по столбцам, без чтения хранилища и сборки записей
+    rows = [(int(user_id), row) for user_id, items in reminders.items() for row in items.values()]
+    columns = (
+        bot.np.array([user_timezones[user_id] for user_id, _ in rows]),
+        (bot.np.array([row[1] for _, row in rows]) - bot.EPOCH_ORDINAL).astype("datetime64[D]"),
+        bot.np.zeros(len(rows), dtype=bot.np.int64),
+        bot.np.array([row[2] for _, row in rows]),
+        bot.np.array([row[3] for _, row in rows]),
+        bot.np.array([row[4] for _, row in rows], dtype=bot.np.int8),
+    )
+    started = time.perf_counter()
+    bot.next_fire_times(*columns, bot.datetime.now(bot.pytz.UTC))
+    print(f"   - из них расчёт срабатываний: {time.perf_counter() - started:.2f} с")
+
+    # При следующем запуске next_fire уже посчитан, в хранилище пишутся только изменившиеся
+    restored, elapsed, _ = await measure(bot.bulk_schedule_due, saved, user_timezones)
+    print(f"⚡ Повторный запуск: {restored} напоминаний за {elapsed:.2f} с")
+
+    json_elapsed, binary_elapsed = measure_open(saved, user_timezones)
+    print(f"📂 Открытие хранилища: JSON-снапшот {json_elapsed:.2f} с, двоичный {binary_elapsed * 1000:.1f} мс")
+
+    # Прежний путь - по одному напоминанию через schedule_reminder
+    single = dict(list(reminders.items())[:SINGLE_COUNT // REMINDERS_PER_USER])
+    restored, elapsed, _ = await measure(bot.schedule_due, single, user_timezones)
+    print(f"🐢 По одному: {restored} напоминаний за {elapsed:.2f} с, "
+          f"на {COUNT} было бы около {elapsed * COUNT / restored:.0f} с")
+
+if __name__ == "__main__":
+    # Печать каждого напоминания при планировании по одному в замер не нужна
+    bot.print = lambda *args, **kwargs: None
+    asyncio.run(main())
@@ -0,0 +1,203 @@
+# Задержка от появления обновления до обработчика: polling против webhook
+# Запуск: python benchmarks/bench_updates.py [количество обновлений]
+# Вместо Telegram - локальный поддельный Bot API на aiohttp в отдельном процессе: в режиме polling
+# он отдаёт обновления через getUpdates, в режиме webhook сам присылает их POST-запросом, как Telegram.
+# Время появления и обработки обновления меряется time.monotonic - в Linux эти часы общие для процессов
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, web
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+# Одиночные обновления: следующее уходит после обработки предыдущего
+SINGLE_COUNT = 300
+TOKEN = "123456:bench"
+SECRET = "bench-secret"
+# Telegram держит до 40 одновременных соединений с webhook
+WEBHOOK_CONNECTIONS = 40
+
+# Файлы хранилища создаются во временной папке, а не рядом с ботом
+os.chdir(tempfile.mkdtemp())
+sys.path.insert(0, BOT_DIR)
+import napominalochka as bot
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+class FakeTelegram:
+    """Минимальный Bot API: getMe, getUpdates с долгим опросом, setWebhook/deleteWebhook"""
+
+    def __init__(self):
+        self.pending = []
+        self.arrived = asyncio.Event()
+        self.webhook = None
+        self.sent_at = {}
+        self.session = ClientSession()
+        self.connections = asyncio.Semaphore(WEBHOOK_CONNECTIONS)
+
+    async def control(self, request):
+        """Команды бенчмарка: выдать обновления или вернуть время их появления"""
+        if request.match_info["command"] == "push":
+            for update_id in await request.json():
+                self.push(make_update(update_id))
+            return web.json_response(True)
+        return web.json_response(self.sent_at)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if not params and request.can_read_body:
+            params = await request.json()
+        result = True
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            result = await self.get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        elif method == "setWebhook":
+            self.webhook = params["url"]
+        elif method == "deleteWebhook":
+            self.webhook = None
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_updates(self, offset, timeout):
+        self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.pending[:100]
+
+    def push(self, update):
+        """Обновление появилось у Telegram - отсюда считаем задержку"""
+        self.sent_at[update["update_id"]] = time.monotonic()
+        if self.webhook:
+            asyncio.create_task(self.post(update))
+        else:
+            self.pending.append(update)
+            self.arrived.set()
+
+    async def post(self, update):
+        async with self.connections:
+            async with self.session.post(self.webhook, data=json.dumps(update),
+                                         headers={bot.SECRET_HEADER: SECRET,
+                                                  "Content-Type": "application/json"}) as response:
+                assert response.status == 200, response.status
+
+def serve_fake_telegram(port_queue):
+    """Процесс поддельного Telegram; порт отдаёт через очередь"""
+    async def serve():
+        fake = FakeTelegram()
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", fake.handle)
+        app.router.add_post("/control/{command}", fake.control)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port_queue.put(site._server.sockets[0].getsockname()[1])
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+def make_update(update_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": "привет",
+            "chat": {"id": 1000 + update_id % 100, "type": "private"},
+            "from": {"id": 1000 + update_id % 100, "is_bot": False, "first_name": "Котик"},
+        },
+    }
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+async def drive(session, control_url, times, handled, next_id):
+    """Одиночные обновления по очереди, потом пачка сразу; возвращает задержки и время пачки"""
+    single_ids = [next(next_id) for _ in range(SINGLE_COUNT)]
+    for update_id in single_ids:
+        handled.clear()
+        async with session.post(f"{control_url}/push", json=[update_id]):
+            pass
+        await handled.wait()
+
+    burst_ids = [next(next_id) for _ in range(COUNT)]
+    started = time.monotonic()
+    async with session.post(f"{control_url}/push", json=burst_ids):
+        pass
+    while burst_ids[-1] not in times:
+        handled.clear()
+        await handled.wait()
+    elapsed = time.monotonic() - started
+
+    async with session.post(f"{control_url}/sent") as response:
+        sent_at = {int(k): v for k, v in (await response.json()).items()}
+    single = [times[i] - sent_at[i] for i in single_ids]
+    burst = [times[i] - sent_at[i] for i in burst_ids]
+    return single, burst, elapsed
+
+async def measure(mode):
+    port_queue = multiprocessing.Queue()
+    telegram = multiprocessing.Process(target=serve_fake_telegram, args=(port_queue,), daemon=True)
+    telegram.start()
+    api_port = port_queue.get()
+    control_url = f"http://127.0.0.1:{api_port}/control"
+    session = ClientSession()
+
+    application = ApplicationBuilder().token(TOKEN).base_url(f"http://127.0.0.1:{api_port}/bot").build()
+    times, handled = {}, asyncio.Event()
+
+    async def on_update(update, context):
+        times[update.update_id] = time.monotonic()
+        handled.set()
+
+    application.add_handler(TypeHandler(Update, on_update))
+    next_id = iter(range(1, 10 ** 9))
+
+    try:
+        if mode == "polling":
+            await application.initialize()
+            await application.updater.start_polling(poll_interval=0, timeout=10)
+            await application.start()
+            try:
+                return await drive(session, control_url, times, handled, next_id)
+            finally:
+                await application.updater.stop()
+                await application.stop()
+                await application.shutdown()
+        else:
+            stop_event = asyncio.Event()
+            server = asyncio.create_task(bot.run_webhook(
+                application, url=f"http://127.0.0.1:{bot.WEBHOOK_PORT}{bot.WEBHOOK_PATH}",
+                listen="127.0.0.1", secret=SECRET, stop_event=stop_event))
+            while not application.running:
+                await asyncio.sleep(0.01)
+            # Сервер поднимается сразу после start(); ждём, пока он начнёт принимать соединения
+            await asyncio.sleep(0.1)
+            try:
+                return await drive(session, control_url, times, handled, next_id)
+            finally:
+                stop_event.set()
+                await server
+    finally:
+        await session.close()
+        telegram.terminate()
+
+async def main():
+    print(f"Одиночных обновлений: {SINGLE_COUNT}, в пачке: {COUNT}")
+    for mode in ("polling", "webhook"):
+        single, burst, elapsed = await measure(mode)
+        print(f"{mode}:")
+        print(f"  по одному: p50 {percentile(single, 0.5) * 1000:.2f} мс, p99 {percentile(single, 0.99) * 1000:.2f} мс")
+        print(f"  пачкой:    p50 {percentile(burst, 0.5) * 1000:.1f} мс, p99 {percentile(burst, 0.99) * 1000:.1f} мс,"
+              f" {COUNT / elapsed:.0f} обновлений/с")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,22 +1,62 @@
 import asyncio
+import gc
+import heapq
+import hmac
+import itertools
+import array
+import bisect
+import calendar
+import contextlib
+from collections import OrderedDict, namedtuple
+from collections.abc import MutableMapping
 import random
 import json
+import mmap
+import multiprocessing
 import os
-from datetime import datetime, timedelta
+import signal
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError as FutureCancelled, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta
 import pytz
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+try:
+    import numpy as np
+except ImportError:
+    # Без numpy напоминания при запуске восстанавливаются по одному
+    np = None
+try:
+    from aiohttp import ClientError, ClientSession, ClientTimeout, web
+except ImportError:
+    # aiohttp нужен только для режима webhook
+    web = None
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    BasePersistence,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     ConversationHandler,
     ContextTypes,
+    PersistenceInput,
     filters
 )
 
 TOKEN = "MY_TOKEN_TELEGRAM"
 
+# Адрес Bot API; для проверки на одной машине можно указать локальный поддельный сервер
+API_BASE_URL = "https://api.telegram.org/bot"
+
+# Как получать обновления: "polling" (бот сам опрашивает Telegram) или "webhook" (Telegram присылает их на наш сервер)
+UPDATE_MODE = "polling"
+
 # ---------------------- Состояния ----------------------
 STATE_START, STATE_TEXT, STATE_CALENDAR, STATE_HOUR, STATE_MINUTE, STATE_REPEAT = range(6)
 STATE_SELECT_REMINDER, STATE_CONFIRM_STOP, STATE_TIMEZONE = range(6, 9)
@@ -24,53 +64,1539 @@ STATE_SELECT_REMINDER, STATE_CONFIRM_STOP, STATE_TIMEZONE = range(6, 9)
 # ---------------------- Файлы для хранения данных ----------------------
 DATA_FILE = "user_data.json"
 TIMEZONE_FILE = "user_timezones.json"
+# Двоичные снапшоты: JSON-файлы выше переводятся в них автоматически при первом запуске
+DATA_SNAPSHOT_FILE = "user_data.bin"
+TIMEZONE_SNAPSHOT_FILE = "user_timezones.bin"
+DATA_JOURNAL_FILE = "user_data.journal"
+TIMEZONE_JOURNAL_FILE = "user_timezones.journal"
+# Незаконченные диалоги: шаг ConversationHandler и context.user_data
+SESSION_FILE = "user_sessions.json"
+SESSION_JOURNAL_FILE = "user_sessions.journal"
+SQLITE_FILE = "napominalochka.db"
+MEDIA_CACHE_FILE = "media_cache.json"
+
+# Где хранить данные: "json" (снапшот + журнал) или "sqlite"
+STORAGE_BACKEND = "json"
+
+# Сколько записей журнала копим до фонового сжатия в снапшот
+JOURNAL_COMPACT_THRESHOLD = 1000
+
+# Сколько секунд копим изменения перед одной общей записью на диск
+SAVE_COALESCE_WINDOW = 0.05
+
+# ---------------------- Метрики ----------------------
+# Границы корзин гистограмм времени, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Метрики в формате Prometheus: http://METRICS_LISTEN:METRICS_PORT/metrics; 0 - не поднимать сервер
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 9108
+# Как часто печатать сводку метрик в лог; None - не печатать
+METRICS_REPORT_INTERVAL = 300
+
+METRICS_HELP = {
+    "napominalochka_handler_seconds": ("histogram", "Время обработки кнопки по маршруту"),
+    "napominalochka_scheduler_lag_seconds": ("histogram", "Насколько позже планового времени сработало событие"),
+    "napominalochka_send_seconds": ("histogram", "Время одного запроса отправки в Telegram"),
+    "napominalochka_send_errors_total": ("counter", "Ошибки отправки по методу и типу ошибки"),
+    "napominalochka_delivery_lag_seconds": ("histogram", "Задержка доставки относительно планового времени"),
+    "napominalochka_persist_seconds": ("histogram", "Время записи одной пачки изменений на диск"),
+    "napominalochka_persist_records_total": ("counter", "Сколько изменений записано на диск"),
+    "napominalochka_compaction_seconds": ("histogram", "Время сжатия журнала в снапшот"),
+    "napominalochka_queue_depth": ("gauge", "Глубина очередей"),
+}
+
+class Histogram:
+    """Гистограмма с постоянными корзинами: observe - один bisect и пара сложений"""
+
+    __slots__ = ("bounds", "counts", "sum", "count", "max")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Оценка квантиля сверху: граница корзины, в которую он попал"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+def prometheus_labels(labels, extra=()):
+    """{key="value",...} с экранированием, как требует формат Prometheus"""
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for key, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+class Metrics:
+    """Гистограммы, счётчики и глубины очередей; текст для Prometheus и сводка в лог.
+
+    Горячие места берут свою гистограмму или счётчик один раз и дальше только
+    вызывают observe/inc. Глубины очередей не копятся, а спрашиваются при чтении.
+    """
+
+    def __init__(self):
+        self.series = {}  # (имя, метки) -> Histogram или Counter
+        self.gauges = {}  # (имя, метки) -> функция без аргументов
+        self.runner = None
+        self.reporter = None
+        self.port = METRICS_PORT
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = Histogram()
+        return series
+
+    def counter(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = Counter()
+        return series
+
+    def gauge(self, name, read, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = read
 
-# ---------------------- Загрузка данных ----------------------
-def load_data():
-    """Загружает данные пользователей из файла"""
-    if os.path.exists(DATA_FILE):
+    def _grouped(self):
+        groups = {}
+        for (name, labels), series in self.series.items():
+            groups.setdefault(name, []).append((labels, series))
+        for (name, labels), read in self.gauges.items():
+            groups.setdefault(name, []).append((labels, read))
+        return groups
+
+    def prometheus(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for name, items in sorted(self._grouped().items()):
+            kind, help_text = METRICS_HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, series in items:
+                if isinstance(series, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(series.bounds, series.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{prometheus_labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{prometheus_labels(labels, [('le', '+Inf')])} {series.count}")
+                    lines.append(f"{name}_sum{prometheus_labels(labels)} {series.sum}")
+                    lines.append(f"{name}_count{prometheus_labels(labels)} {series.count}")
+                elif isinstance(series, Counter):
+                    lines.append(f"{name}{prometheus_labels(labels)} {series.value}")
+                else:
+                    lines.append(f"{name}{prometheus_labels(labels)} {series()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Строки сводки для лога: количество и p50/p99/максимум по каждой гистограмме"""
+        lines = []
+        for (name, labels), series in sorted(self.series.items()):
+            label = ",".join(f"{key}={value}" for key, value in labels)
+            title = name.replace("napominalochka_", "") + (f"{{{label}}}" if label else "")
+            if isinstance(series, Histogram):
+                if series.count:
+                    lines.append(f"   - {title}: {series.count} раз, p50 {series.quantile(0.5) * 1000:.1f} мс, "
+                                 f"p99 {series.quantile(0.99) * 1000:.1f} мс, макс. {series.max * 1000:.1f} мс")
+            elif series.value:
+                lines.append(f"   - {title}: {series.value}")
+        for (name, labels), read in sorted(self.gauges.items()):
+            label = ",".join(f"{value}" for _, value in labels)
+            lines.append(f"   - {name.replace('napominalochka_', '')}[{label}]: {read()}")
+        return lines
+
+    async def start(self):
+        """Поднимает /metrics (если есть aiohttp) и периодическую сводку в лог"""
+        if self.port and web is not None:
+            async def handle(request):
+                return web.Response(text=self.prometheus(), content_type="text/plain", charset="utf-8")
+            app = web.Application()
+            app.router.add_get("/metrics", handle)
+            self.runner = web.AppRunner(app, access_log=None)
+            await self.runner.setup()
+            try:
+                await web.TCPSite(self.runner, METRICS_LISTEN, self.port).start()
+                print(f"📈 Метрики: http://{METRICS_LISTEN}:{self.port}/metrics")
+            except OSError as e:
+                print(f"⚠️ Не удалось поднять сервер метрик: {e}")
+                await self.runner.cleanup()
+                self.runner = None
+        if METRICS_REPORT_INTERVAL:
+            self.reporter = asyncio.create_task(self._report())
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(METRICS_REPORT_INTERVAL)
+            lines = self.summary()
+            if lines:
+                print("📈 Метрики:")
+                print("\n".join(lines))
+
+    async def stop(self):
+        if self.reporter is not None:
+            self.reporter.cancel()
+            self.reporter = None
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+metrics = Metrics()
+
+# ---------------------- Фоновая запись ----------------------
+# Вся работа с диском идёт в одном потоке: записи выполняются строго по порядку,
+# а обработчики не ждут диск
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="napominalochka-io")
+
+async def run_io(func, *args):
+    """Выполняет блокирующую функцию в потоке записи"""
+    return await asyncio.get_running_loop().run_in_executor(IO_EXECUTOR, func, *args)
+
+class AsyncWriter:
+    """Копит изменения SAVE_COALESCE_WINDOW секунд и отдаёт их потоку записи одной пачкой"""
+
+    def __init__(self, write_batch, name):
+        self.write_batch = write_batch
+        self.pending = []
+        self.persist_time = metrics.histogram("napominalochka_persist_seconds", target=name)
+        self.persist_records = metrics.counter("napominalochka_persist_records_total", target=name)
+        metrics.gauge("napominalochka_queue_depth", lambda: len(self.pending), queue=f"persist:{name}")
+        self.timer = None
+        self.last_write = None
+
+    def submit(self, item):
+        self.pending.append(item)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Цикл событий ещё не запущен (старт, миграция) - пишем сразу
+            self.flush_sync()
+            return
+        if self.timer is None:
+            self.timer = loop.call_later(SAVE_COALESCE_WINDOW, self.flush_nowait)
+
+    def flush_nowait(self):
+        """Отдаёт накопленное потоку записи, не дожидаясь окончания"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return self.last_write
+        batch, self.pending = self.pending, []
+        future = asyncio.get_running_loop().run_in_executor(IO_EXECUTOR, self._write, batch)
+        self.last_write = future
+        return future
+
+    async def flush(self):
+        """Записывает всё накопленное и ждёт окончания записи"""
+        future = self.flush_nowait()
+        if future is not None:
+            await future
+
+    def flush_sync(self):
+        """Записывает накопленное без цикла событий (старт и остановка бота)"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            IO_EXECUTOR.submit(self._write, batch).result()
+
+    def _write(self, batch):
+        started = time.perf_counter()
         try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # Преобразуем ключи обратно в int
-                return {int(k): v for k, v in data.items()}
+            self.write_batch(batch)
         except Exception as e:
-            print(f"Ошибка загрузки данных: {e}")
-    return {}
+            print(f"Ошибка сохранения данных: {e}")
+        self.persist_time.observe(time.perf_counter() - started)
+        self.persist_records.inc(len(batch))
 
-def save_data():
-    """Сохраняет данные пользователей в файл"""
-    try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(user_data_store, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Ошибка сохранения данных: {e}")
+# ---------------------- Процессы для тяжёлой работы ----------------------
+# Сколько процессов считают тяжёлые задачи (длинные списки, пакетный расчёт срабатываний,
+# сжатие журнала); 0 - пул не запускается и всё считается в основном процессе
+# (так и будет на одноядерной машине)
+CPU_WORKERS = max(0, (os.cpu_count() or 1) - 1)
+# Сколько задач может одновременно ждать или выполняться в пуле
+CPU_QUEUE_LIMIT = 32
+
+class CpuPoolBusy(Exception):
+    """Пул занят или задачу вытеснила более новая - результата не будет"""
+
+class CpuPool:
+    """Пул процессов для CPU-тяжёлых задач, чтобы цикл событий не стоял.
+
+    Задач в пуле не больше limit: интерактивный вызов (wait=False) при заполненном пуле
+    получает CpuPoolBusy и считает на месте, фоновый ждёт места. Новая задача с тем же
+    key отменяет прежнюю, если та ещё не началась. Процессы запускаются через forkserver
+    (где его нет, например в Windows, - spawn), а не fork-ом: к start() у бота уже есть поток
+    записи и открытая база, и fork такого процесса может оставить потомка на чужой блокировке.
+    Процесс пула заново импортирует модуль бота, поэтому задачи - функции уровня модуля.
+    """
 
-def load_timezones():
-    """Загружает часовые пояса из файла"""
-    if os.path.exists(TIMEZONE_FILE):
+    def __init__(self, workers, limit):
+        self.workers = workers
+        self.slots = asyncio.Semaphore(limit)
+        self.executor = None
+        self.jobs = {}
+        self.running = 0
+        metrics.gauge("napominalochka_queue_depth", lambda: self.running, queue="cpu_pool")
+
+    def start(self):
+        if self.executor is not None or self.workers <= 0:
+            return
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=context)
+        # Первая задача дожидается запуска пула, чтобы первая кнопка не ждала импорта модуля
+        self.executor.submit(int).result()
+
+    async def run(self, func, *args, key=None, wait=True):
+        """Выполняет func(*args) в пуле; аргументы и результат должны переживать pickle"""
+        if self.executor is None:
+            return func(*args)
+        if not wait and self.slots.locked():
+            raise CpuPoolBusy()
+        if key is not None and key in self.jobs:
+            self.jobs[key].cancel()
+        async with self.slots:
+            self.running += 1
+            job = self.executor.submit(func, *args)
+            if key is not None:
+                self.jobs[key] = job
+            try:
+                result = await asyncio.wrap_future(job)
+            except asyncio.CancelledError:
+                if key is not None and self.jobs.get(key) is not job:
+                    raise CpuPoolBusy()
+                raise
+            finally:
+                self.running -= 1
+                if key is not None and self.jobs.get(key) is job:
+                    del self.jobs[key]
+        if key is not None and self.jobs.get(key, job) is not job:
+            # Пока считали, пришла задача новее - этот результат уже никому не нужен
+            raise CpuPoolBusy()
+        return result
+
+    def call(self, func, *args):
+        """Синхронный вызов из потока (сжатие журнала); без пула - на месте"""
+        if self.executor is None:
+            return func(*args)
         try:
-            with open(TIMEZONE_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # Преобразуем ключи обратно в int
-                return {int(k): v for k, v in data.items()}
+            return self.executor.submit(func, *args).result()
+        except (RuntimeError, FutureCancelled, BrokenProcessPool):
+            # Пул уже остановлен - досчитываем сами
+            return func(*args)
+
+    def stop(self):
+        """Отменяет ещё не начатые задачи и отпускает процессы"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+cpu_pool = CpuPool(CPU_WORKERS, CPU_QUEUE_LIMIT)
+
+# ---------------------- Журнал изменений ----------------------
+class Journal:
+    """Снапшот + журнал изменений, в который дописывается одна строка на изменение.
+
+    Снапшот - JSON или, если передан binary (класс с read/write), двоичный файл binary_file;
+    JSON-снапшот тогда читается только один раз, чтобы перевести его в двоичный.
+    """
+
+    def __init__(self, snapshot_file, journal_file, apply_record, decode_key=str, decode_value=None, upgrade=None,
+                 encode=None, binary_file=None, binary=None):
+        self.snapshot_file = snapshot_file
+        self.binary_file = binary_file
+        self.binary = binary
+        self.journal_file = journal_file
+        self.rotated_file = journal_file + ".1"
+        self.apply_record = apply_record
+        self.decode_key = decode_key
+        self.decode_value = decode_value
+        # upgrade(data) переводит старый формат данных в новый и возвращает True, если что-то поменял
+        self.upgrade = upgrade
+        # encode - json default для значений, которые JSON сам не умеет
+        self.encode = encode
+        self.records = 0
+        self.compacting = None
+        self.file = None
+        self.writer = AsyncWriter(self.write_records, journal_file)
+
+    def _read_snapshot(self):
+        if self.binary is not None and os.path.exists(self.binary_file):
+            return self.binary.read(self.binary_file)
+        if not os.path.exists(self.snapshot_file):
+            return {}
+        with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if self.decode_value is not None:
+            return {self.decode_key(k): self.decode_value(v) for k, v in data.items()}
+        return {self.decode_key(k): v for k, v in data.items()}
+
+    def _replay(self, data, path):
+        """Применяет записи журнала к данным, возвращает количество записей"""
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Недописанная строка в конце журнала после падения
+                    print(f"⚠️ Пропущена битая запись журнала {path}")
+                    continue
+                record["user"] = self.decode_key(record["user"])
+                self.apply_record(data, record)
+                count += 1
+        return count
+
+    def load(self):
+        """Загружает снапшот и проигрывает поверх него журнал"""
+        data = self._read_snapshot()
+        # Журнал, оставшийся от прерванного сжатия, идёт раньше текущего
+        self._replay(data, self.rotated_file)
+        self.records = self._replay(data, self.journal_file)
+        upgraded = self.upgrade is not None and self.upgrade(data)
+        if self.binary is not None and os.path.exists(self.snapshot_file):
+            print(f"📦 Снапшот {self.snapshot_file} переводится в двоичный {self.binary_file}, "
+                  f"прежние файлы остаются с расширением .bak")
+            self._write_snapshot(data)
+            self._backup_json()
+        elif upgraded:
+            # Старые записи журнала в новом формате не проиграть - сразу пишем новый снапшот
+            self._rewrite(data)
+        self.file = open(self.journal_file, 'a', encoding='utf-8')
+        if os.path.exists(self.rotated_file) or self.records >= JOURNAL_COMPACT_THRESHOLD:
+            self.compact()
+        return data
+
+    def _write_snapshot(self, data):
+        if self.binary is not None:
+            tmp_file = self.binary_file + ".tmp"
+            self.binary.write(tmp_file, data)
+            os.replace(tmp_file, self.binary_file)
+            return
+        tmp_file = self.snapshot_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, default=self.encode)
+        os.replace(tmp_file, self.snapshot_file)
+
+    def _backup_json(self):
+        """После перевода в двоичный формат JSON-снапшот и проигранные журналы переименовываются в *.bak.
+
+        Бот их больше не читает, но по ним можно вернуться к JSON: удалить .bin и убрать .bak из имён.
+        """
+        for path in (self.snapshot_file, self.rotated_file, self.journal_file):
+            if os.path.exists(path):
+                os.replace(path, path + ".bak")
+        self.records = 0
+
+    def _rewrite(self, data):
+        self._write_snapshot(data)
+        for path in (self.rotated_file, self.journal_file):
+            if os.path.exists(path):
+                os.remove(path)
+        self.records = 0
+
+    def append(self, record):
+        """Ставит одно изменение в очередь на запись в журнал"""
+        self.writer.submit(record)
+
+    def write_records(self, records):
+        """Дописывает пачку изменений в журнал (в потоке записи)"""
+        self.file.write("".join(json.dumps(record, ensure_ascii=False, default=self.encode) + "\n" for record in records))
+        self.file.flush()
+        self.records += len(records)
+        if self.records >= JOURNAL_COMPACT_THRESHOLD:
+            self.compact()
+
+    def compact(self):
+        """Переносит журнал в сторону и в фоне сливает его со снапшотом"""
+        if self.compacting is not None and self.compacting.is_alive():
+            return
+        if not os.path.exists(self.rotated_file):
+            self.file.close()
+            os.replace(self.journal_file, self.rotated_file)
+            self.file = open(self.journal_file, 'a', encoding='utf-8')
+            self.records = 0
+        self.compacting = threading.Thread(target=self._compact_in_pool, daemon=True)
+        self.compacting.start()
+
+    def _compact_in_pool(self):
+        # Поток только ждёт: разбор и запись JSON идут в пуле процессов и не держат GIL основного
+        started = time.perf_counter()
+        # Текущая папка у процесса пула своя - передаём полные пути
+        binary_file = self.binary_file and os.path.abspath(self.binary_file)
+        cpu_pool.call(compact_journal, os.path.abspath(self.snapshot_file), os.path.abspath(self.journal_file),
+                      self.apply_record, self.decode_key, self.decode_value, self.encode, binary_file, self.binary)
+        metrics.histogram("napominalochka_compaction_seconds", target=self.journal_file).observe(
+            time.perf_counter() - started)
+
+    def _compact_rotated(self):
+        # Живые данные не трогаем: снапшот собирается из старого снапшота и отложенного журнала
+        try:
+            data = self._read_snapshot()
+            self._replay(data, self.rotated_file)
+            self._write_snapshot(data)
+            os.remove(self.rotated_file)
         except Exception as e:
-            print(f"Ошибка загрузки часовых поясов: {e}")
-    return {}
+            print(f"Ошибка сжатия журнала {self.journal_file}: {e}")
+
+    def close(self):
+        self.writer.flush_sync()
+        if self.compacting is not None:
+            self.compacting.join()
+        if self.file is not None:
+            self.file.close()
+
+def compact_journal(snapshot_file, journal_file, apply_record, decode_key, decode_value, encode,
+                    binary_file=None, binary=None):
+    """Сжатие отложенного журнала; выполняется в пуле процессов, поэтому Journal собирается заново"""
+    Journal(snapshot_file, journal_file, apply_record, decode_key, decode_value, encode=encode,
+            binary_file=binary_file, binary=binary)._compact_rotated()
+
+# ---------------------- Применение изменений ----------------------
+def apply_data_record(data, record):
+    """Применяет одно изменение к хранилищу напоминаний {пользователь: {id: напоминание}}"""
+    op = record["op"]
+    if op == "append" or "idx" in record:
+        apply_legacy_record(data.setdefault(record["user"], []), record)
+        return
+    if op == "drop":
+        data.pop(record["user"], None)
+        return
+    reminders = data.setdefault(record["user"], {})
+    if op == "add":
+        reminders[record["id"]] = Reminder.decode(record["reminder"])
+    elif op == "set":
+        reminder = reminders.get(record["id"])
+        # Напоминание могли удалить, пока изменение шло к нам
+        if reminder is not None:
+            reminder.set_field(record["field"], record["value"])
+    elif op == "del":
+        reminders.pop(record["id"], None)
+
+def apply_legacy_record(reminders, record):
+    """Записи журнала до появления id: напоминания в списке адресуются позицией"""
+    op = record["op"]
+    if op == "append":
+        reminders.append(record["reminder"])
+    elif op == "set":
+        reminders[record["idx"]][record["field"]] = record["value"]
+    elif op == "pop":
+        reminders.pop(record["idx"])
+
+def decode_reminders(reminders):
+    """Напоминания пользователя из JSON-снапшота: ключи-id в числа, значения в Reminder.
+
+    Старый список (адресация по позиции) оставляем как есть - его переведёт upgrade_reminders.
+    """
+    if isinstance(reminders, list):
+        return reminders
+    return {int(reminder_id): Reminder.decode(reminder) for reminder_id, reminder in reminders.items()}
+
+def max_reminder_id(data):
+    if isinstance(data, ReminderSnapshot):
+        # Наибольший id снапшота записан в заголовке - не разбираем всех пользователей ради него
+        return max(data.max_id, max_reminder_id(data.loaded))
+    return max((max(reminders, default=0) for reminders in data.values() if isinstance(reminders, dict)), default=0)
+
+def upgrade_reminders(data):
+    """Переводит напоминания из списков в словари по постоянным id.
+
+    Недособранные черновики (без текста, даты или времени) больше не хранятся
+    вместе с напоминаниями и при переводе отбрасываются.
+    """
+    # В двоичном снапшоте списков нет, они могут прийти только из журнала
+    loaded = data.loaded if isinstance(data, ReminderSnapshot) else data
+    legacy = [user for user, reminders in loaded.items() if isinstance(reminders, list)]
+    if not legacy:
+        return False
+    ids = itertools.count(max_reminder_id(data) + 1)
+    dropped = 0
+    for user in legacy:
+        complete = [reminder for reminder in data[user] if reminder.keys() >= REQUIRED_FIELDS]
+        dropped += len(data[user]) - len(complete)
+        data[user] = {next(ids): Reminder.from_dict(reminder) for reminder in complete}
+    print(f"📦 Напоминания {len(legacy)} пользователей получили постоянные id, отброшено черновиков: {dropped}")
+    return True
+
+def apply_timezone_record(data, record):
+    """Применяет одно изменение к хранилищу часовых поясов"""
+    if record.get("op") == "drop":
+        data.pop(record["user"], None)
+    else:
+        data[record["user"]] = record["tz"]
+
+def apply_session_record(data, record):
+    """Применяет одно изменение к незаконченным диалогам {пользователь: {"data": ..., "states": {чат: шаг}}}"""
+    op = record["op"]
+    if op == "drop":
+        data.pop(record["user"], None)
+        return
+    session = data.setdefault(record["user"], {"data": {}, "states": {}})
+    if op == "data":
+        session["data"] = record["data"]
+    elif op == "state":
+        if record["state"] is None:
+            session["states"].pop(str(record["chat"]), None)
+        else:
+            session["states"][str(record["chat"])] = record["state"]
+    # Пользователь без данных и без начатого диалога места не занимает
+    if not session["data"] and not session["states"]:
+        del data[record["user"]]
+
+# ---------------------- Напоминание ----------------------
+# Коды повторений: в памяти и в JSON повторение хранится числом, а не строкой
+NO_REPEAT, DAILY, WEEKLY, MONTHLY, YEARLY = range(5)
+REPEAT_NAMES = ("no_repeat", "daily", "weekly", "monthly", "yearly")
+REPEAT_CODES = {name: code for code, name in enumerate(REPEAT_NAMES)}
+
+class Reminder:
+    """Одно напоминание: поля хранилища и его состояние в планировщике.
+
+    Дата хранится номером дня (date.toordinal()), повторение - кодом, ближайшее
+    срабатывание - секундами UTC, так что строки не разбираются при каждом обращении.
+    В JSON напоминание пишется списком to_row(), без имён полей.
+    """
+
+    __slots__ = ("id", "user_id", "text", "date", "hour", "minute", "repeat", "day", "next_fire", "acked",
+                 "tz", "entry_id")
+
+    def __init__(self, text, date, hour, minute, repeat=NO_REPEAT, day=0, next_fire=None, acked=None):
+        self.id = None
+        self.user_id = None
+        self.text = text
+        self.date = date
+        self.hour = hour
+        self.minute = minute
+        self.repeat = repeat
+        # Число месяца для ежемесячных/ежегодных, если date пришлось перенести на конец месяца
+        self.day = day or datetime.fromordinal(date).day
+        self.next_fire = next_fire
+        # Срабатывание (UTC timestamp основного напоминания), на которое пользователь нажал «Сделаль»
+        self.acked = acked
+        # Заполняются планировщиком: пояс (одна строка на все напоминания пояса) и запись
+        self.tz = None
+        self.entry_id = None
+
+    @property
+    def start(self):
+        return date.fromordinal(self.date)
+
+    def to_row(self):
+        row = [self.text, self.date, self.hour, self.minute, self.repeat, self.day, self.next_fire]
+        # Отметку пишем, только если она есть: у большинства напоминаний её нет
+        if self.acked is not None:
+            row.append(self.acked)
+        return row
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Напоминание в старом виде: словарь с датой строкой и повторением по имени"""
+        return cls(
+            data["text"], date.fromisoformat(data["date"]).toordinal(), data["hour"], data["minute"],
+            REPEAT_CODES.get(data.get("repeat", "no_repeat"), NO_REPEAT), data.get("day", 0), data.get("next_fire"),
+            data.get("acked")
+        )
+
+    @classmethod
+    def decode(cls, value):
+        if isinstance(value, Reminder):
+            return value
+        if isinstance(value, list):
+            return cls.from_row(value)
+        return cls.from_dict(value)
 
-def save_timezones():
-    """Сохраняет часовые пояса в файл"""
+    def set_field(self, field, value):
+        """Меняет поле хранилища; дата и повторение принимаются и в старом строковом виде"""
+        if field == "date" and isinstance(value, str):
+            value = date.fromisoformat(value).toordinal()
+        elif field == "repeat" and isinstance(value, str):
+            value = REPEAT_CODES.get(value, NO_REPEAT)
+        setattr(self, field, value)
+
+def encode_reminder(value):
+    """json.dump(default=...) для напоминаний"""
+    if isinstance(value, Reminder):
+        return value.to_row()
+    raise TypeError(f"не сериализуется в JSON: {type(value).__name__}")
+
+# ---------------------- Двоичные снапшоты ----------------------
+# Снапшот напоминаний: заголовок, отсортированные id пользователей, номера их первых записей,
+# записи постоянной длины и таблица строк с текстами. Файл отображается в память (mmap),
+# а пользователь разбирается в объекты Reminder только при первом обращении к нему
+REMINDER_SNAPSHOT_MAGIC = b"NAPR"
+TIMEZONE_SNAPSHOT_MAGIC = b"NAPZ"
+SNAPSHOT_VERSION = 1
+# magic, версия, резерв, пользователей, записей, наибольший id, размер таблицы строк
+REMINDER_HEADER = struct.Struct("<4sHHIIqQ")
+# id, день, час, минута, повторение, число месяца, next_fire (NaN - нет), acked (-1 - нет), смещение и длина текста
+REMINDER_RECORD = struct.Struct("<qiBBBBdqII")
+# magic, версия, резерв, пользователей, размер списка поясов
+TIMEZONE_HEADER = struct.Struct("<4sHHII")
+NO_ACK = -1
+
+def read_int_array(typecode, data):
+    """Массив чисел из little-endian байтов (на big-endian машинах переворачиваем)"""
+    values = array.array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+def int_array_bytes(typecode, values):
+    values = array.array(typecode, values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+class ReminderSnapshot(MutableMapping):
+    """Напоминания {str(user_id): {id: Reminder}} поверх отображённого в память двоичного снапшота.
+
+    Разобранные и изменённые пользователи лежат в loaded, а taken - пользователи
+    снапшота, которых больше не читаем из файла (разобраны или удалены).
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, users, records, self.max_id, strings_size = REMINDER_HEADER.unpack_from(self.mm, 0)
+        if magic != REMINDER_SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{path}: не снапшот напоминаний версии {SNAPSHOT_VERSION}")
+        offset = REMINDER_HEADER.size
+        self.user_ids = read_int_array("q", self.mm[offset:offset + 8 * users])
+        offset += 8 * users
+        self.starts = read_int_array("q", self.mm[offset:offset + 8 * (users + 1)])
+        self.records_offset = offset + 8 * (users + 1)
+        self.records = records
+        self.strings_offset = self.records_offset + REMINDER_RECORD.size * records
+        self.loaded = {}
+        self.taken = set()
+        self.untaken = users
+
+    def _position(self, key):
+        try:
+            user_id = int(key)
+        except (TypeError, ValueError):
+            return None
+        position = bisect.bisect_left(self.user_ids, user_id)
+        if position < len(self.user_ids) and self.user_ids[position] == user_id:
+            return position
+        return None
+
+    def _take(self, key):
+        if key not in self.taken and self._position(key) is not None:
+            self.taken.add(key)
+            self.untaken -= 1
+
+    def _decode(self, position):
+        user_id = self.user_ids[position]
+        reminders = {}
+        for index in range(self.starts[position], self.starts[position + 1]):
+            (reminder_id, day_number, hour, minute, repeat, day, next_fire, acked,
+             text_offset, text_length) = REMINDER_RECORD.unpack_from(self.mm, self.records_offset + REMINDER_RECORD.size * index)
+            start = self.strings_offset + text_offset
+            reminder = Reminder(self.mm[start:start + text_length].decode('utf-8'), day_number, hour, minute, repeat, day,
+                                None if next_fire != next_fire else next_fire, None if acked == NO_ACK else acked)
+            reminder.id, reminder.user_id = reminder_id, user_id
+            reminders[reminder_id] = reminder
+        return reminders
+
+    def __getitem__(self, key):
+        reminders = self.loaded.get(key)
+        if reminders is not None:
+            return reminders
+        position = None if key in self.taken else self._position(key)
+        if position is None:
+            raise KeyError(key)
+        reminders = self.loaded[key] = self._decode(position)
+        self._take(key)
+        return reminders
+
+    def __setitem__(self, key, reminders):
+        self.loaded[key] = reminders
+        self._take(key)
+
+    def __delitem__(self, key):
+        found = self.loaded.pop(key, None) is not None
+        if key not in self.taken and self._position(key) is not None:
+            self._take(key)
+            found = True
+        if not found:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.loaded or (key not in self.taken and self._position(key) is not None)
+
+    def __iter__(self):
+        yield from list(self.loaded)
+        for user_id in self.user_ids:
+            key = str(user_id)
+            if key not in self.taken:
+                yield key
+
+    def __len__(self):
+        return len(self.loaded) + self.untaken
+
+    def reminder_count(self):
+        """Количество напоминаний без разбора пользователей из файла"""
+        count = sum(len(reminders) for reminders in self.loaded.values())
+        for position, user_id in enumerate(self.user_ids):
+            if str(user_id) not in self.taken:
+                count += self.starts[position + 1] - self.starts[position]
+        return count
+
+    def due_keys(self, until, after=None):
+        """Пользователи, у которых может быть напоминание раньше until: разобранные и те из файла,
+        у кого по столбцу next_fire есть подходящая запись. Тексты при этом не читаются."""
+        keys = list(self.loaded)
+        if np is not None and self.records:
+            columns = np.frombuffer(self.mm, dtype=REMINDER_DTYPE, count=self.records, offset=self.records_offset)
+            next_fire = columns["next_fire"]
+            if after is None:
+                due = np.isnan(next_fire) | (next_fire < until)
+            else:
+                due = (next_fire >= after) & (next_fire < until)
+            starts = np.frombuffer(self.starts, dtype=np.int64)
+            positions = np.unique(np.searchsorted(starts, np.flatnonzero(due), side="right") - 1).tolist()
+        else:
+            positions = []
+            for position in range(len(self.user_ids)):
+                for index in range(self.starts[position], self.starts[position + 1]):
+                    next_fire = REMINDER_RECORD.unpack_from(self.mm, self.records_offset + REMINDER_RECORD.size * index)[6]
+                    if (next_fire != next_fire and after is None) or (
+                            next_fire < until and (after is None or next_fire >= after)):
+                        positions.append(position)
+                        break
+        keys += [key for key in map(str, (self.user_ids[position] for position in positions)) if key not in self.taken]
+        return keys
+
+    @staticmethod
+    def read(path):
+        return ReminderSnapshot(path)
+
+    @staticmethod
+    def write(path, data):
+        """Пишет {пользователь: {id: Reminder}} в двоичный снапшот; одинаковые тексты хранятся один раз"""
+        users = sorted((int(key), reminders) for key, reminders in data.items())
+        strings = {}
+        string_table = bytearray()
+        records = bytearray()
+        starts = [0]
+        max_id = 0
+        for _, reminders in users:
+            for reminder_id, reminder in reminders.items():
+                text = strings.get(reminder.text)
+                if text is None:
+                    encoded = reminder.text.encode('utf-8')
+                    text = strings[reminder.text] = (len(string_table), len(encoded))
+                    string_table += encoded
+                next_fire = reminder.next_fire
+                records += REMINDER_RECORD.pack(
+                    reminder_id, reminder.date, reminder.hour, reminder.minute, reminder.repeat, reminder.day,
+                    float("nan") if next_fire is None else next_fire,
+                    NO_ACK if reminder.acked is None else int(reminder.acked), text[0], text[1])
+                max_id = max(max_id, reminder_id)
+            starts.append(starts[-1] + len(reminders))
+        with open(path, 'wb') as f:
+            f.write(REMINDER_HEADER.pack(REMINDER_SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, len(users), starts[-1],
+                                         max_id, len(string_table)))
+            f.write(int_array_bytes("q", [user_id for user_id, _ in users]))
+            f.write(int_array_bytes("q", starts))
+            f.write(records)
+            f.write(string_table)
+
+# Те же записи для numpy: столбец next_fire читается прямо из файла без разбора записей
+REMINDER_DTYPE = None if np is None else np.dtype([
+    ("id", "<i8"), ("date", "<i4"), ("hour", "u1"), ("minute", "u1"), ("repeat", "u1"), ("day", "u1"),
+    ("next_fire", "<f8"), ("acked", "<i8"), ("text_offset", "<u4"), ("text_length", "<u4"),
+])
+
+class TimezoneSnapshot:
+    """Часовые пояса в двоичном снапшоте: id пользователей, номер пояса у каждого и список поясов.
+
+    Поясов всего десяток, поэтому снапшот читается целиком - это два массива чисел.
+    """
+
+    @staticmethod
+    def read(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, _, users, names_size = TIMEZONE_HEADER.unpack_from(data, 0)
+        if magic != TIMEZONE_SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{path}: не снапшот часовых поясов версии {SNAPSHOT_VERSION}")
+        offset = TIMEZONE_HEADER.size
+        user_ids = read_int_array("q", data[offset:offset + 8 * users])
+        offset += 8 * users
+        indexes = read_int_array("H", data[offset:offset + 2 * users])
+        offset += 2 * users
+        names = [sys.intern(name) for name in data[offset:offset + names_size].decode('utf-8').split("\n")]
+        return {user_id: names[index] for user_id, index in zip(user_ids, indexes)}
+
+    @staticmethod
+    def write(path, data):
+        names = {}
+        users = sorted(data.items())
+        indexes = [names.setdefault(tz, len(names)) for _, tz in users]
+        encoded = "\n".join(names).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(TIMEZONE_HEADER.pack(TIMEZONE_SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, len(users), len(encoded)))
+            f.write(int_array_bytes("q", [user_id for user_id, _ in users]))
+            f.write(int_array_bytes("H", indexes))
+            f.write(encoded)
+
+# ---------------------- Хранилища ----------------------
+# Поля напоминания, которые можно менять через set_reminder_field
+# day - число месяца, на которое настроено ежемесячное/ежегодное напоминание,
+# если в коротком месяце date пришлось перенести на последний день;
+# acked - срабатывание, отмеченное кнопкой «Сделаль»
+REMINDER_FIELDS = ("text", "date", "hour", "minute", "repeat", "next_fire", "day", "acked")
+# Без этих полей напоминание ещё не дособрано и не планируется
+REQUIRED_FIELDS = {'text', 'date', 'hour', 'minute'}
+
+@contextlib.contextmanager
+def paused_gc():
+    """Сборщик мусора выключен на время синхронного куска, который создаёт много объектов.
+
+    Внутри не должно быть await: сборщик один на весь процесс, и остальные корутины
+    бота остались бы без него.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
     try:
-        with open(TIMEZONE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(user_timezones, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Ошибка сохранения часовых поясов: {e}")
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+class JsonStore:
+    """Хранилище в памяти: снапшоты + журналы изменений.
+
+    Напоминания лежат по пользователям в словарях {id: напоминание}, id не
+    меняются при удалении соседних напоминаний. Снапшоты напоминаний и поясов
+    двоичные; пользователи из снапшота напоминаний разбираются при первом обращении.
+    """
+
+    def __init__(self, directory="."):
+        self.data_journal = Journal(os.path.join(directory, DATA_FILE), os.path.join(directory, DATA_JOURNAL_FILE),
+                                    apply_data_record, decode_value=decode_reminders, upgrade=upgrade_reminders,
+                                    encode=encode_reminder, binary_file=os.path.join(directory, DATA_SNAPSHOT_FILE),
+                                    binary=ReminderSnapshot)
+        self.timezone_journal = Journal(os.path.join(directory, TIMEZONE_FILE),
+                                        os.path.join(directory, TIMEZONE_JOURNAL_FILE),
+                                        apply_timezone_record, decode_key=int,
+                                        binary_file=os.path.join(directory, TIMEZONE_SNAPSHOT_FILE),
+                                        binary=TimezoneSnapshot)
+        self.session_journal = Journal(os.path.join(directory, SESSION_FILE),
+                                       os.path.join(directory, SESSION_JOURNAL_FILE),
+                                       apply_session_record, decode_key=int)
+        self.reminders = self._load(self.data_journal, "данных")
+        self.timezones = self._load(self.timezone_journal, "часовых поясов")
+        self.sessions = self._load(self.session_journal, "диалогов")
+        # Один объект-строка на каждый пояс вместо копии у каждого пользователя
+        for user_id, tz in self.timezones.items():
+            self.timezones[user_id] = sys.intern(tz)
+        # Пользователи из двоичного снапшота получают id при разборе, здесь - только пришедшие из журнала
+        loaded = self.reminders.loaded if isinstance(self.reminders, ReminderSnapshot) else self.reminders
+        for user_id_str, reminders in loaded.items():
+            user_id = int(user_id_str)
+            for reminder_id, reminder in reminders.items():
+                reminder.id, reminder.user_id = reminder_id, user_id
+        self.ids = itertools.count(max_reminder_id(self.reminders) + 1)
+
+    @staticmethod
+    def _load(journal, what):
+        try:
+            return journal.load()
+        except Exception as e:
+            print(f"Ошибка загрузки {what}: {e}")
+        return {}
+
+    def _commit(self, record):
+        apply_data_record(self.reminders, record)
+        self.data_journal.append(record)
+
+    async def get_reminders(self, user_id):
+        """Напоминания пользователя {id: напоминание} в порядке создания"""
+        return self.reminders.get(str(user_id), {})
+
+    async def get_reminder(self, user_id, reminder_id):
+        return self.reminders.get(str(user_id), {}).get(reminder_id)
+
+    def add_reminder(self, user_id, reminder, reminder_id=None):
+        """Добавляет готовое напоминание (Reminder) и возвращает его id.
+
+        reminder_id - оставить прежний id (перенос пользователя в другой шард).
+        """
+        if reminder_id is None:
+            reminder_id = next(self.ids)
+        else:
+            self.ids = itertools.count(max(next(self.ids), reminder_id + 1))
+        reminder.id, reminder.user_id = reminder_id, user_id
+        self._commit({"op": "add", "user": str(user_id), "id": reminder.id, "reminder": reminder})
+        return reminder.id
+
+    def issue_ids(self, start, index=0, count=1):
+        """Новые id - не меньше start и с остатком index по модулю count, чтобы id шардов не совпадали"""
+        start = max(next(self.ids), start)
+        self.ids = itertools.count(start + (index - start) % count, count)
+
+    async def foreign_reminder_ids(self, user_id, reminder_ids):
+        """id из reminder_ids, занятые другими пользователями; у JSON id свои у каждого пользователя"""
+        return set()
+
+    def set_reminder_field(self, user_id, reminder_id, field, value):
+        self._commit({"op": "set", "user": str(user_id), "id": reminder_id, "field": field, "value": value})
+
+    async def remove_reminder(self, user_id, reminder_id):
+        """Удаляет напоминание, возвращает его или None, если такого нет"""
+        removed = self.reminders.get(str(user_id), {}).get(reminder_id)
+        if removed is not None:
+            self._commit({"op": "del", "user": str(user_id), "id": reminder_id})
+        return removed
+
+    def iter_reminders(self, keys=None):
+        """Все напоминания всех пользователей (или только пользователей keys): (user_id, id, напоминание)"""
+        for user_id_str in list(self.reminders if keys is None else keys):
+            for reminder_id, reminder in list(self.reminders.get(user_id_str, {}).items()):
+                yield int(user_id_str), reminder_id, reminder
+
+    async def due_reminders(self, until, after=None):
+        """Напоминания, которые сработают раньше until (и не раньше after), или ещё не рассчитанные"""
+        due = []
+        # Из двоичного снапшота разбираем только пользователей, у которых что-то сработает
+        keys = self.reminders.due_keys(until, after) if isinstance(self.reminders, ReminderSnapshot) else None
+        # Разбор пользователей из снапшота создаёт много объектов, которые некому освобождать
+        with paused_gc():
+            for user_id, reminder_id, reminder in self.iter_reminders(keys):
+                next_fire = reminder.next_fire
+                if next_fire is None:
+                    if after is None:
+                        due.append((user_id, reminder_id, reminder))
+                elif next_fire < until and (after is None or next_fire >= after):
+                    due.append((user_id, reminder_id, reminder))
+        return due
+
+    async def get_timezone(self, user_id):
+        return self.timezones.get(user_id)
+
+    async def get_timezones(self):
+        """Часовые пояса всех пользователей"""
+        return self.timezones
+
+    def set_timezone(self, user_id, tz):
+        record = {"op": "tz", "user": user_id, "tz": sys.intern(tz)}
+        apply_timezone_record(self.timezones, record)
+        self.timezone_journal.append(record)
+
+    def _commit_session(self, record):
+        apply_session_record(self.sessions, record)
+        self.session_journal.append(record)
+
+    async def get_user_data(self):
+        """context.user_data всех пользователей с незаконченными диалогами"""
+        return {user_id: session["data"] for user_id, session in self.sessions.items() if session["data"]}
+
+    async def get_conversation_states(self):
+        """Шаги незаконченных диалогов {(чат, пользователь): шаг}"""
+        return {(int(chat_id), user_id): state
+                for user_id, session in self.sessions.items() for chat_id, state in session["states"].items()}
+
+    async def get_session(self, user_id):
+        """user_data пользователя и шаги его диалогов по чатам"""
+        session = self.sessions.get(user_id, {"data": {}, "states": {}})
+        return session["data"], {int(chat_id): state for chat_id, state in session["states"].items()}
+
+    def set_user_data(self, user_id, data):
+        """Сохраняет context.user_data пользователя; пустой словарь удаляет его"""
+        self._commit_session({"op": "data", "user": user_id, "data": data})
+
+    def set_conversation_state(self, chat_id, user_id, state):
+        """Сохраняет шаг диалога; None - диалог закончен"""
+        self._commit_session({"op": "state", "user": user_id, "chat": chat_id, "state": state})
+
+    def user_ids(self):
+        """Все пользователи, у которых есть напоминания, часовой пояс или незаконченный диалог"""
+        return {int(user_id) for user_id in self.reminders} | set(self.timezones) | set(self.sessions)
+
+    async def remove_user(self, user_id):
+        """Удаляет все данные пользователя (при переезде в другой шард)"""
+        if str(user_id) in self.reminders:
+            self._commit({"op": "drop", "user": str(user_id)})
+        if user_id in self.timezones:
+            record = {"op": "drop", "user": user_id}
+            apply_timezone_record(self.timezones, record)
+            self.timezone_journal.append(record)
+        if user_id in self.sessions:
+            self._commit_session({"op": "drop", "user": user_id})
+
+    def stats(self):
+        """Количество пользователей, напоминаний и часовых поясов"""
+        if isinstance(self.reminders, ReminderSnapshot):
+            reminders_count = self.reminders.reminder_count()
+        else:
+            reminders_count = sum(len(reminders) for reminders in self.reminders.values())
+        return len(self.reminders), reminders_count, len(self.timezones)
+
+    async def flush(self):
+        """Дожидается записи всех изменений на диск"""
+        await self.data_journal.writer.flush()
+        await self.timezone_journal.writer.flush()
+        await self.session_journal.writer.flush()
+
+    def close(self):
+        self.data_journal.close()
+        self.timezone_journal.close()
+        self.session_journal.close()
+
+class SqliteStore:
+    """Хранилище в SQLite: напоминания читаются и пишутся по одному пользователю.
+
+    Запросы выполняются в потоке записи. Изменения копятся и уходят в базу одной
+    транзакцией, а чтение сначала отдаёт накопленное, чтобы видеть свои же записи.
+    """
+
+    def __init__(self, path, directory="."):
+        self.directory = directory
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS reminders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                text TEXT,
+                date TEXT,
+                hour INTEGER,
+                minute INTEGER,
+                repeat TEXT,
+                next_fire REAL,
+                day INTEGER,
+                acked REAL
+            );
+            CREATE INDEX IF NOT EXISTS reminders_user ON reminders (user_id, id);
+            CREATE INDEX IF NOT EXISTS reminders_next_fire ON reminders (next_fire);
+            CREATE TABLE IF NOT EXISTS timezones (
+                user_id INTEGER PRIMARY KEY,
+                tz TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS user_data (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS conversations (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                state INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, user_id)
+            );
+        """)
+        # Базы, созданные до появления поля day
+        columns = {row["name"] for row in self.db.execute("PRAGMA table_info(reminders)")}
+        if "day" not in columns:
+            self.db.execute("ALTER TABLE reminders ADD COLUMN day INTEGER")
+        if "acked" not in columns:
+            self.db.execute("ALTER TABLE reminders ADD COLUMN acked REAL")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] < 1:
+            # Черновики теперь хранятся отдельно от напоминаний, старые недособранные удаляем
+            self.db.execute(
+                "DELETE FROM reminders WHERE text IS NULL OR date IS NULL OR hour IS NULL OR minute IS NULL"
+            )
+            self.db.execute("PRAGMA user_version = 1")
+        self.db.commit()
+        self.writer = AsyncWriter(self._execute_batch, path)
+        self._import_json()
+        # id выдаём сами, чтобы add_reminder сразу знал id ещё не записанной строки
+        self.ids = itertools.count(self.db.execute("SELECT COALESCE(MAX(id), 0) FROM reminders").fetchone()[0] + 1)
+
+    def _import_json(self):
+        """Один раз переносит в пустую базу данные из JSON-файлов"""
+        if self.db.execute("SELECT 1 FROM reminders LIMIT 1").fetchone():
+            return
+        if self.db.execute("SELECT 1 FROM timezones LIMIT 1").fetchone():
+            return
+        json_files = (DATA_FILE, DATA_SNAPSHOT_FILE, DATA_JOURNAL_FILE, TIMEZONE_FILE, TIMEZONE_SNAPSHOT_FILE,
+                      TIMEZONE_JOURNAL_FILE, SESSION_FILE, SESSION_JOURNAL_FILE)
+        if not any(os.path.exists(os.path.join(self.directory, path)) for path in json_files):
+            return
+        print("📦 Перенос данных из JSON в SQLite...")
+        json_store = JsonStore(self.directory)
+        with self.db:
+            for user_id, reminder_id, reminder in json_store.iter_reminders():
+                self._insert(user_id, reminder_id, reminder)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO timezones (user_id, tz) VALUES (?, ?)",
+                json_store.timezones.items()
+            )
+            for user_id, session in json_store.sessions.items():
+                self._replace_user_data(user_id, session["data"])
+                for chat_id, state in session["states"].items():
+                    self._replace_state(int(chat_id), user_id, state)
+        json_store.close()
+
+    def _execute_batch(self, operations):
+        """Выполняет накопленные изменения одной транзакцией (в потоке записи)"""
+        with self.db:
+            for operation, args in operations:
+                try:
+                    operation(*args)
+                except Exception as e:
+                    # Одна неудачная операция не должна откатывать остальные
+                    print(f"Ошибка сохранения данных: {e}")
+
+    async def _read(self, func, *args):
+        # Поток записи один, поэтому чтение выполнится после отданных изменений
+        self.writer.flush_nowait()
+        return await run_io(func, *args)
+
+    @staticmethod
+    def _row_to_reminder(row):
+        reminder = Reminder(
+            row["text"], date.fromisoformat(row["date"]).toordinal(), row["hour"], row["minute"],
+            REPEAT_CODES.get(row["repeat"], NO_REPEAT), row["day"] or 0, row["next_fire"], row["acked"]
+        )
+        reminder.id, reminder.user_id = row["id"], row["user_id"]
+        return reminder
+
+    @staticmethod
+    def _column_value(field, value):
+        # В базе дата и повторение остаются читаемыми строками
+        if field == "date" and isinstance(value, int):
+            return date.fromordinal(value).isoformat()
+        if field == "repeat" and isinstance(value, int):
+            return REPEAT_NAMES[value]
+        return value
+
+    def _insert(self, user_id, reminder_id, reminder):
+        self.db.execute(
+            f"INSERT INTO reminders (id, user_id, {', '.join(REMINDER_FIELDS)}) VALUES (?, ?{', ?' * len(REMINDER_FIELDS)})",
+            [reminder_id, user_id] + [self._column_value(key, getattr(reminder, key)) for key in REMINDER_FIELDS]
+        )
+
+    def _update(self, user_id, reminder_id, field, value):
+        self.db.execute(
+            f"UPDATE reminders SET {field} = ? WHERE id = ? AND user_id = ?",
+            (self._column_value(field, value), reminder_id, user_id)
+        )
+
+    def _select_user(self, user_id):
+        rows = self.db.execute(
+            "SELECT * FROM reminders WHERE user_id = ? ORDER BY id", (user_id,)
+        ).fetchall()
+        return {row["id"]: self._row_to_reminder(row) for row in rows}
+
+    def _select_one(self, user_id, reminder_id):
+        row = self.db.execute(
+            "SELECT * FROM reminders WHERE id = ? AND user_id = ?", (reminder_id, user_id)
+        ).fetchone()
+        return self._row_to_reminder(row) if row is not None else None
+
+    def _delete(self, user_id, reminder_id):
+        removed = self._select_one(user_id, reminder_id)
+        if removed is not None:
+            with self.db:
+                self.db.execute("DELETE FROM reminders WHERE id = ?", (reminder_id,))
+        return removed
+
+    def _select_timezone(self, user_id):
+        row = self.db.execute("SELECT tz FROM timezones WHERE user_id = ?", (user_id,)).fetchone()
+        return row["tz"] if row is not None else None
+
+    def _replace_timezone(self, user_id, tz):
+        self.db.execute("INSERT OR REPLACE INTO timezones (user_id, tz) VALUES (?, ?)", (user_id, tz))
+
+    def _replace_user_data(self, user_id, data):
+        if data:
+            self.db.execute("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                            (user_id, json.dumps(data, ensure_ascii=False)))
+        else:
+            self.db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+    def _replace_state(self, chat_id, user_id, state):
+        if state is not None:
+            self.db.execute("INSERT OR REPLACE INTO conversations (chat_id, user_id, state) VALUES (?, ?, ?)",
+                            (chat_id, user_id, state))
+        else:
+            self.db.execute("DELETE FROM conversations WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+
+    def _select_user_data(self):
+        return {row["user_id"]: json.loads(row["data"]) for row in self.db.execute("SELECT user_id, data FROM user_data")}
+
+    def _select_states(self):
+        return {(row["chat_id"], row["user_id"]): row["state"]
+                for row in self.db.execute("SELECT chat_id, user_id, state FROM conversations")}
+
+    def _select_session(self, user_id):
+        row = self.db.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        states = self.db.execute("SELECT chat_id, state FROM conversations WHERE user_id = ?", (user_id,))
+        return (json.loads(row["data"]) if row is not None else {}), {chat_id: state for chat_id, state in states}
+
+    async def get_reminders(self, user_id):
+        return await self._read(self._select_user, user_id)
+
+    async def get_reminder(self, user_id, reminder_id):
+        return await self._read(self._select_one, user_id, reminder_id)
+
+    def add_reminder(self, user_id, reminder, reminder_id=None):
+        """Добавляет готовое напоминание (Reminder) и возвращает его id.
+
+        reminder_id - оставить прежний id (перенос пользователя в другой шард).
+        """
+        if reminder_id is None:
+            reminder_id = next(self.ids)
+        else:
+            self.ids = itertools.count(max(next(self.ids), reminder_id + 1))
+        reminder.id, reminder.user_id = reminder_id, user_id
+        self.writer.submit((self._insert, (user_id, reminder.id, reminder)))
+        return reminder.id
+
+    def issue_ids(self, start, index=0, count=1):
+        """Новые id - не меньше start и с остатком index по модулю count, чтобы id шардов не совпадали"""
+        start = max(next(self.ids), start)
+        self.ids = itertools.count(start + (index - start) % count, count)
+
+    async def foreign_reminder_ids(self, user_id, reminder_ids):
+        """id из reminder_ids, которые в базе уже заняты другими пользователями (id - ключ всей таблицы)"""
+        return await self._read(self._select_foreign_ids, user_id, list(reminder_ids))
+
+    def _select_foreign_ids(self, user_id, reminder_ids):
+        foreign = set()
+        for start in range(0, len(reminder_ids), 500):
+            chunk = reminder_ids[start:start + 500]
+            foreign.update(row[0] for row in self.db.execute(
+                f"SELECT id FROM reminders WHERE user_id != ? AND id IN ({', '.join('?' * len(chunk))})",
+                [user_id] + chunk))
+        return foreign
+
+    def set_reminder_field(self, user_id, reminder_id, field, value):
+        if field not in REMINDER_FIELDS:
+            raise ValueError(f"неизвестное поле напоминания: {field}")
+        self.writer.submit((self._update, (user_id, reminder_id, field, value)))
+
+    async def remove_reminder(self, user_id, reminder_id):
+        """Удаляет напоминание, возвращает его или None, если такого нет"""
+        return await self._read(self._delete, user_id, reminder_id)
+
+    def iter_reminders(self):
+        """Все напоминания всех пользователей: (user_id, id, напоминание)"""
+        for row in self.db.execute("SELECT * FROM reminders ORDER BY user_id, id"):
+            yield row["user_id"], row["id"], self._row_to_reminder(row)
+
+    def _select_due(self, until, after):
+        if after is None:
+            rows = self.db.execute("SELECT * FROM reminders WHERE next_fire IS NULL OR next_fire < ?", (until,))
+        else:
+            rows = self.db.execute("SELECT * FROM reminders WHERE next_fire >= ? AND next_fire < ?", (after, until))
+        return [(row["user_id"], row["id"], self._row_to_reminder(row)) for row in rows]
+
+    async def due_reminders(self, until, after=None):
+        """Напоминания, которые сработают раньше until (и не раньше after), или ещё не рассчитанные"""
+        return await self._read(self._select_due, until, after)
+
+    async def get_timezone(self, user_id):
+        return await self._read(self._select_timezone, user_id)
+
+    def _select_timezones(self):
+        return {row["user_id"]: sys.intern(row["tz"]) for row in self.db.execute("SELECT user_id, tz FROM timezones")}
+
+    async def get_timezones(self):
+        """Часовые пояса всех пользователей"""
+        return await self._read(self._select_timezones)
+
+    def set_timezone(self, user_id, tz):
+        self.writer.submit((self._replace_timezone, (user_id, tz)))
+
+    async def get_user_data(self):
+        """context.user_data всех пользователей с незаконченными диалогами"""
+        return await self._read(self._select_user_data)
+
+    async def get_conversation_states(self):
+        """Шаги незаконченных диалогов {(чат, пользователь): шаг}"""
+        return await self._read(self._select_states)
+
+    async def get_session(self, user_id):
+        """user_data пользователя и шаги его диалогов по чатам"""
+        return await self._read(self._select_session, user_id)
+
+    def set_user_data(self, user_id, data):
+        """Сохраняет context.user_data пользователя; пустой словарь удаляет его"""
+        self.writer.submit((self._replace_user_data, (user_id, data)))
+
+    def set_conversation_state(self, chat_id, user_id, state):
+        """Сохраняет шаг диалога; None - диалог закончен"""
+        self.writer.submit((self._replace_state, (chat_id, user_id, state)))
+
+    def user_ids(self):
+        """Все пользователи, у которых есть напоминания, часовой пояс или незаконченный диалог"""
+        return {row[0] for row in self.db.execute(
+            "SELECT user_id FROM reminders UNION SELECT user_id FROM timezones "
+            "UNION SELECT user_id FROM user_data UNION SELECT user_id FROM conversations"
+        )}
+
+    def _delete_user(self, user_id):
+        self.db.execute("DELETE FROM reminders WHERE user_id = ?", (user_id,))
+        self.db.execute("DELETE FROM timezones WHERE user_id = ?", (user_id,))
+        self.db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+        self.db.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+
+    async def remove_user(self, user_id):
+        """Удаляет все данные пользователя (при переезде в другой шард)"""
+        self.writer.submit((self._delete_user, (user_id,)))
+
+    def stats(self):
+        """Количество пользователей, напоминаний и часовых поясов"""
+        users, reminders = self.db.execute("SELECT COUNT(DISTINCT user_id), COUNT(*) FROM reminders").fetchone()
+        timezones = self.db.execute("SELECT COUNT(*) FROM timezones").fetchone()[0]
+        return users, reminders, timezones
+
+    async def flush(self):
+        """Дожидается записи всех изменений в базу"""
+        await self.writer.flush()
+
+    def close(self):
+        self.writer.flush_sync()
+        self.db.close()
+
+def open_store(directory="."):
+    """Открывает хранилище, выбранное в STORAGE_BACKEND, в папке directory"""
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStore(os.path.join(directory, SQLITE_FILE), directory)
+    return JsonStore(directory)
 
 # ---------------------- Инициализация хранилищ ----------------------
-user_data_store = load_data()
-user_timezones = load_timezones()
+# Хранилище открывается при запуске бота, а не при импорте: import napominalochka
+# (бенчмарки, инструменты) не должен создавать файлы данных в текущей папке
+store = None
 scheduled_jobs = {}
 
+def open_default_store():
+    """Открывает хранилище бота в текущей папке, если оно ещё не открыто"""
+    global store
+    if store is None:
+        store = open_store()
+    return store
+
+# ---------------------- Незаконченные диалоги ----------------------
+# Раз в сколько секунд изменения диалогов и user_data отдаются хранилищу
+SESSION_FLUSH_INTERVAL = 5
+# Имя ConversationHandler в хранилище; диалог у бота один
+CONVERSATION_NAME = "napominalochka"
+
+class StorePersistence(BasePersistence):
+    """Шаг диалога и context.user_data в хранилище бота, чтобы перезапуск не обрывал создание напоминания.
+
+    Раз в update_interval PTB отдаёт записи пользователей, от которых были обновления.
+    Хранилищу уходят только те, что поменялись с прошлой записи, и пишутся они
+    одной пачкой вместе с остальными изменениями, а не полным дампом.
+    """
+
+    def __init__(self, update_interval=SESSION_FLUSH_INTERVAL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        # Последнее записанное: с ним сравниваются новые значения
+        self.user_data = {}
+        self.states = {}
+
+    async def get_user_data(self):
+        self.user_data = dict(await store.get_user_data())
+        return {user_id: dict(data) for user_id, data in self.user_data.items()}
+
+    async def get_conversations(self, name):
+        self.states = dict(await store.get_conversation_states())
+        return dict(self.states)
+
+    async def update_user_data(self, user_id, data):
+        if self.user_data.get(user_id, {}) == data:
+            return
+        self.user_data[user_id] = data
+        store.set_user_data(user_id, data)
+
+    async def drop_user_data(self, user_id):
+        if self.user_data.pop(user_id, None):
+            store.set_user_data(user_id, {})
+
+    async def update_conversation(self, name, key, new_state):
+        if self.states.get(key) == new_state:
+            return
+        if new_state is None:
+            self.states.pop(key, None)
+        else:
+            self.states[key] = new_state
+        chat_id, user_id = key
+        store.set_conversation_state(chat_id, user_id, new_state)
+
+    async def flush(self):
+        await store.flush()
+
+    # Данные бота, чатов и callback_data бот не хранит
+    async def get_bot_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
 # ---------------------- Часовые пояса России ----------------------
 RUSSIAN_TIMEZONES = {
     'kaliningrad': ('Калининград (UTC+2)', 'Europe/Kaliningrad'),
@@ -104,264 +1630,1185 @@ IMAGE_URLS = [
 def get_random_image():
     return random.choice(IMAGE_URLS)
 
-def get_user_timezone(user_id):
+# ---------------------- Кэш file_id картинок ----------------------
+# Чат, куда при запуске отправляются ещё не закэшированные картинки (None - кэшировать по ходу работы)
+MEDIA_CACHE_CHAT_ID = None
+# Части текста BadRequest, по которым видно, что Telegram не принял именно file_id
+FILE_ID_ERRORS = ("file identifier", "file_id")
+
+def is_file_id_error(error):
+    """BadRequest из-за устаревшего file_id (а не из-за чата или подписи)"""
+    message = str(error).lower()
+    return any(part in message for part in FILE_ID_ERRORS)
+
+class MediaCache:
+    """file_id уже отправленных картинок: Telegram не скачивает картинку по ссылке при каждой отправке"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file_ids = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.file_ids = json.load(f)
+            except Exception as e:
+                print(f"Ошибка загрузки кэша картинок: {e}")
+        self.writer = AsyncWriter(self._write, path)
+
+    def _write(self, snapshots):
+        # Из пачки нужен только последний снимок
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(snapshots[-1], f, ensure_ascii=False)
+        os.replace(tmp_file, self.path)
+
+    def get(self, url):
+        return self.file_ids.get(url)
+
+    def remember(self, url, message):
+        """Запоминает file_id из отправленного сообщения с картинкой"""
+        photo = getattr(message, "photo", None)
+        if not photo:
+            return
+        file_id = photo[-1].file_id
+        if self.file_ids.get(url) != file_id:
+            self.file_ids[url] = file_id
+            self.writer.submit(dict(self.file_ids))
+
+    def forget(self, url):
+        """Выбрасывает file_id, который Telegram больше не принимает"""
+        if self.file_ids.pop(url, None) is not None:
+            self.writer.submit(dict(self.file_ids))
+
+    def warm_up(self):
+        """Отправляет в MEDIA_CACHE_CHAT_ID картинки без file_id, чтобы закэшировать их заранее"""
+        if MEDIA_CACHE_CHAT_ID is None:
+            return
+        for url in IMAGE_URLS:
+            if url not in self.file_ids:
+                delivery.submit("send_photo", MEDIA_CACHE_CHAT_ID, datetime.now(pytz.UTC).timestamp(),
+                                "кэш картинок", photo=url, disable_notification=True)
+
+    async def flush(self):
+        await self.writer.flush()
+
+media_cache = MediaCache(MEDIA_CACHE_FILE)
+
+# ---------------------- Часовые пояса пользователей ----------------------
+DEFAULT_TIMEZONE = 'Europe/Moscow'
+# Сколько часовых поясов пользователей держим в памяти
+USER_TIMEZONE_CACHE_SIZE = 100000
+
+class TimezoneService:
+    """Разобранные pytz-пояса, названия поясов по IANA-имени и смещения от UTC.
+
+    Смещение пояса запоминается вместе с интервалом, на котором оно действует
+    (до следующего перехода на летнее/зимнее время), так что повторные запросы
+    отвечают без обращения к pytz.
+    """
+
+    def __init__(self, timezones):
+        self.tzinfos = {}
+        self.display_names = {tz: name for name, tz in timezones.values()}
+        self.offsets = {}
+        self.tables = {}
+        self.user_timezones = OrderedDict()
+
+    def tzinfo(self, tz_name):
+        tz = self.tzinfos.get(tz_name)
+        if tz is None:
+            tz = self.tzinfos[tz_name] = pytz.timezone(tz_name)
+        return tz
+
+    def display_name(self, tz_name, default="Москва"):
+        """Название пояса для пользователя, например 'Омск (UTC+6)'"""
+        return self.display_names.get(tz_name, default)
+
+    def utc_offset(self, tz_name, at):
+        """Смещение пояса от UTC в момент at (UTC timestamp)"""
+        cached = self.offsets.get(tz_name)
+        if cached is not None and cached[0] <= at < cached[1]:
+            return cached[2]
+        tz = self.tzinfo(tz_name)
+        moment = datetime.fromtimestamp(at, pytz.UTC)
+        offset = moment.astimezone(tz).utcoffset()
+        transitions = getattr(tz, "_utc_transition_times", None)
+        if transitions:
+            # Границы интервала - соседние переходы из таблицы pytz
+            naive = moment.replace(tzinfo=None)
+            i = bisect.bisect_right(transitions, naive)
+            start = transitions[i - 1].replace(tzinfo=pytz.UTC).timestamp() if i > 0 else float("-inf")
+            end = transitions[i].replace(tzinfo=pytz.UTC).timestamp() if i < len(transitions) else float("inf")
+        else:
+            start, end = float("-inf"), float("inf")
+        self.offsets[tz_name] = (start, end, offset)
+        return offset
+
+    def transition_table(self, tz_name):
+        """Моменты переходов (UTC, datetime64[m]) и смещения после них - для расчёта по столбцам"""
+        table = self.tables.get(tz_name)
+        if table is None:
+            tz = self.tzinfo(tz_name)
+            transitions = getattr(tz, "_utc_transition_times", None)
+            if transitions:
+                times = np.array(transitions, dtype="datetime64[m]")
+                offsets = [info[0] for info in tz._transition_info]
+            else:
+                times = np.array([datetime.min], dtype="datetime64[m]")
+                offsets = [datetime.now(tz).utcoffset()]
+            minutes = [int(offset.total_seconds() // 60) for offset in offsets]
+            table = self.tables[tz_name] = (times, np.array(minutes, dtype="timedelta64[m]"))
+        return table
+
+    def local_now(self, tz_name):
+        """Текущее время пояса без tzinfo - для сравнения с датой и временем напоминания"""
+        now = datetime.now(pytz.UTC)
+        return (now + self.utc_offset(tz_name, now.timestamp())).replace(tzinfo=None)
+
+    async def user_timezone(self, user_id):
+        """Пояс пользователя или Москва по умолчанию; хранилище читается один раз на пользователя"""
+        tz_name = self.user_timezones.get(user_id)
+        if tz_name is None:
+            tz_name = await store.get_timezone(user_id) or DEFAULT_TIMEZONE
+            self._remember(user_id, tz_name)
+        else:
+            self.user_timezones.move_to_end(user_id)
+        return tz_name
+
+    def set_user_timezone(self, user_id, tz_name):
+        store.set_timezone(user_id, tz_name)
+        self._remember(user_id, tz_name)
+        # Время в списке напоминаний показывается в поясе пользователя
+        reminder_pages.invalidate(user_id)
+
+    def _remember(self, user_id, tz_name):
+        self.user_timezones[user_id] = tz_name
+        self.user_timezones.move_to_end(user_id)
+        if len(self.user_timezones) > USER_TIMEZONE_CACHE_SIZE:
+            self.user_timezones.popitem(last=False)
+
+tz_service = TimezoneService(RUSSIAN_TIMEZONES)
+
+async def get_user_timezone(user_id):
     """Возвращает часовой пояс пользователя или Москву по умолчанию"""
-    return user_timezones.get(user_id, 'Europe/Moscow')
+    return await tz_service.user_timezone(user_id)
+
+# ---------------------- Повторения ----------------------
+# Шаг повторения: в днях для ежедневных и еженедельных, в месяцах для остальных
+REPEAT_DAYS = {DAILY: 1, WEEKLY: 7}
+REPEAT_MONTHS = {MONTHLY: 1, YEARLY: 12}
+
+def is_repeating(repeat):
+    return repeat in REPEAT_DAYS or repeat in REPEAT_MONTHS
+
+def occurrence_date(repeat, start, day, n):
+    """Дата n-го повторения, считая start нулевым.
+
+    Ежемесячные и ежегодные повторения идут в число day, а в коротких месяцах
+    переносятся на последний день месяца (31 января -> 28 февраля -> 31 марта).
+    """
+    if repeat in REPEAT_DAYS:
+        return start + timedelta(days=REPEAT_DAYS[repeat] * n)
+    year, month = divmod(start.year * 12 + start.month - 1 + REPEAT_MONTHS[repeat] * n, 12)
+    return date(year, month + 1, min(day, calendar.monthrange(year, month + 1)[1]))
+
+def local_to_utc(tz, day, hour, minute):
+    """Местное время напоминания -> UTC; несуществующее при переводе часов время сдвигается вперёд"""
+    local = tz.normalize(tz.localize(datetime.combine(day, datetime.min.time()).replace(hour=hour, minute=minute)))
+    return local.astimezone(pytz.UTC)
+
+def next_occurrence(repeat, start, day, hour, minute, tz, after):
+    """Первое повторение (UTC) позже after, без перебора всех пропущенных.
+
+    Номер повторения сразу вычисляется по местной дате after, а затем
+    проверяется не больше пары соседних повторений.
+    """
+    after_date = after.astimezone(tz).date()
+    if repeat in REPEAT_DAYS:
+        n = (after_date - start).days // REPEAT_DAYS[repeat]
+    else:
+        months = (after_date.year - start.year) * 12 + after_date.month - start.month
+        n = months // REPEAT_MONTHS[repeat]
+    n = max(n, 0)
+    while True:
+        when = local_to_utc(tz, occurrence_date(repeat, start, day, n), hour, minute)
+        if when > after:
+            return when
+        n += 1
+
+# ---------------------- Доставка сообщений ----------------------
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около 1 в секунду в один чат
+DELIVERY_GLOBAL_RATE = 30
+DELIVERY_CHAT_RATE = 1
+DELIVERY_CHAT_BURST = 3
+DELIVERY_WORKERS = 16
+DELIVERY_MAX_ATTEMPTS = 5
+# Сколько ждём досылки очереди при остановке бота
+DELIVERY_DRAIN_TIMEOUT = 10
+DELIVERY_REPORT_INTERVAL = 60
+# Сколько пустых лимитов по чатам держим, прежде чем почистить их
+DELIVERY_CHAT_BUCKETS_MAX = 10000
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Забирает токен (можно в долг) и возвращает, сколько секунд подождать"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_idle(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class DeliveryQueue:
+    """Очередь отправки: общий лимит и лимит на чат, ограниченный пул отправщиков и повторы.
+
+    Бот передаётся в start(), так что вместо настоящего Bot подходит любой объект
+    с асинхронными send_photo / send_message.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.global_bucket = TokenBucket(DELIVERY_GLOBAL_RATE, DELIVERY_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.paused_until = 0.0
+        self.bot = None
+        self.workers = []
+        self.stats = {"sent": 0, "failed": 0, "retried": 0, "lag_total": 0.0, "lag_max": 0.0}
+        self.lag = metrics.histogram("napominalochka_delivery_lag_seconds")
+        metrics.gauge("napominalochka_queue_depth", self.queue.qsize, queue="delivery")
+
+    def submit(self, method, chat_id, planned, what, **kwargs):
+        """Ставит отправку в очередь; planned - плановое время (UTC timestamp) для подсчёта задержки"""
+        self.queue.put_nowait({"method": method, "chat_id": chat_id, "planned": planned,
+                               "what": what, "kwargs": kwargs, "attempt": 0})
+
+    def start(self, bot):
+        self.bot = bot
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(DELIVERY_WORKERS)]
+        self.workers.append(asyncio.create_task(self._report()))
+
+    async def stop(self):
+        """Досылает очередь (не дольше DELIVERY_DRAIN_TIMEOUT) и останавливает отправщиков"""
+        try:
+            await asyncio.wait_for(self.queue.join(), DELIVERY_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Не досланы сообщения: {self.queue.qsize()}")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def metrics(self):
+        """Глубина очереди, счётчики и задержка доставки относительно планового времени"""
+        sent = self.stats["sent"]
+        return {
+            "queue_depth": self.queue.qsize(),
+            "sent": sent,
+            "failed": self.stats["failed"],
+            "retried": self.stats["retried"],
+            "lag_avg": self.stats["lag_total"] / sent if sent else 0.0,
+            "lag_max": self.stats["lag_max"],
+        }
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= DELIVERY_CHAT_BUCKETS_MAX:
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(DELIVERY_CHAT_RATE, DELIVERY_CHAT_BURST)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self._deliver(item)
+            except Exception as e:
+                print(f"❌ Ошибка доставки ({item['what']}): {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, item):
+        chat_id = item["chat_id"]
+        while True:
+            item["attempt"] += 1
+            kwargs = item["kwargs"]
+            url = file_id = None
+            if item["method"] == "send_photo":
+                # Картинку по ссылке заменяем на file_id, если он уже известен
+                url = kwargs["photo"]
+                file_id = media_cache.get(url)
+                if file_id is not None:
+                    kwargs = dict(kwargs, photo=file_id)
+            # После RetryAfter Telegram ждёт паузы от всего бота
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+            await asyncio.sleep(self.global_bucket.reserve())
+            try:
+                message = await self._call(item["method"], chat_id, kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                delay = 0
+                error = e
+            except (BadRequest, Forbidden) as e:
+                if file_id is not None and isinstance(e, BadRequest) and is_file_id_error(e):
+                    # file_id больше не принимается - отправляем по ссылке и обновляем кэш
+                    media_cache.forget(url)
+                    continue
+                # Повтор не поможет: чат недоступен или запрос неверный
+                self._failed(item, e)
+                return
+            except NetworkError as e:
+                delay = 2 ** item["attempt"]
+                error = e
+            except Exception as e:
+                self._failed(item, e)
+                return
+            else:
+                if url is not None and file_id is None:
+                    media_cache.remember(url, message)
+                lag = max(0.0, datetime.now(pytz.UTC).timestamp() - item["planned"])
+                self.stats["sent"] += 1
+                self.stats["lag_total"] += lag
+                self.stats["lag_max"] = max(self.stats["lag_max"], lag)
+                self.lag.observe(lag)
+                print(f"✅ УСПЕШНО отправлено ({item['what']}) пользователю {chat_id}")
+                return
+            if item["attempt"] >= DELIVERY_MAX_ATTEMPTS:
+                self._failed(item, error)
+                return
+            self.stats["retried"] += 1
+            await asyncio.sleep(delay)
+
+    async def _call(self, method, chat_id, kwargs):
+        """Один запрос к Telegram: время ответа и ошибки идут в метрики"""
+        started = time.perf_counter()
+        try:
+            return await getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+        except Exception as e:
+            metrics.counter("napominalochka_send_errors_total", method=method, error=type(e).__name__).inc()
+            raise
+        finally:
+            metrics.histogram("napominalochka_send_seconds", method=method).observe(time.perf_counter() - started)
+
+    def _failed(self, item, error):
+        self.stats["failed"] += 1
+        print(f"❌ Ошибка отправки ({item['what']}) пользователю {item['chat_id']}: {error}")
+
+    async def _report(self):
+        reported = None
+        while True:
+            await asyncio.sleep(DELIVERY_REPORT_INTERVAL)
+            metrics = self.metrics()
+            if metrics != reported:
+                print(f"📬 Доставка: в очереди {metrics['queue_depth']}, отправлено {metrics['sent']}, "
+                      f"ошибок {metrics['failed']}, повторов {metrics['retried']}, "
+                      f"задержка ср. {metrics['lag_avg']:.2f} с / макс. {metrics['lag_max']:.2f} с")
+                reported = metrics
+
+delivery = DeliveryQueue()
 
 # ---------------------- Функция отправки основного напоминания ----------------------
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    user_id = job.data["user_id"]
-    reminder_text = job.data["text"]
-    reminder_index = job.data.get("reminder_index")
-    repeat = job.data.get("repeat")
+def send_reminder(reminder, planned):
+    """Ставит основное напоминание в очередь доставки и сдвигает дату повторяющегося"""
+    user_id = reminder.user_id
+    reminder_text = reminder.text
     
     print(f"🔔 ОТПРАВКА НАПОМИНАНИЯ пользователю {user_id}: {reminder_text}")
     
-    # Обновляем дату в хранилище для повторяющихся напоминаний
-    if repeat and reminder_index is not None:
-        user_id_str = str(user_id)
-        if user_id_str in user_data_store and reminder_index < len(user_data_store[user_id_str]):
-            # Обновляем дату на следующую
-            reminder_data = user_data_store[user_id_str][reminder_index]
-            current_date = datetime.strptime(reminder_data["date"], "%Y-%m-%d").date()
-            
-            if repeat == "daily":
-                new_date = current_date + timedelta(days=1)
-            elif repeat == "weekly":
-                new_date = current_date + timedelta(weeks=1)
-            elif repeat == "monthly":
-                new_date = current_date + timedelta(days=30)
-            elif repeat == "yearly":
-                new_date = current_date + timedelta(days=365)
-            
-            reminder_data["date"] = new_date.strftime("%Y-%m-%d")
-            save_data()
-            print(f"📅 Обновлена дата напоминания для пользователя {user_id}: {new_date.strftime('%Y-%m-%d')}")
+    # Обновляем дату в хранилище для повторяющихся напоминаний:
+    # планировщик уже перевёл next_fire на следующее срабатывание
+    if is_repeating(reminder.repeat) and reminder.id is not None:
+        new_date = datetime.fromtimestamp(reminder.next_fire, tz_service.tzinfo(reminder.tz)).date()
+        store.set_reminder_field(user_id, reminder.id, "date", new_date.toordinal())
+        store.set_reminder_field(user_id, reminder.id, "next_fire", reminder.next_fire)
+        reminder_pages.invalidate(user_id)
+        print(f"📅 Обновлена дата напоминания для пользователя {user_id}: {new_date.strftime('%Y-%m-%d')}")
+    elif reminder.id is not None:
+        # Одноразовое сработало: после перезапуска оно не должно прийти снова
+        store.set_reminder_field(user_id, reminder.id, "next_fire", FIRED)
     
-    random_image = get_random_image()
-    
-    try:
-        await context.bot.send_photo(
-            chat_id=user_id,
-            photo=random_image,
-            caption=f"Эт твоя напоминулька, ты хотель {reminder_text} прекрасного тебе денька💖"
-        )
-        print(f"✅ УСПЕШНО отправлено напоминание пользователю {user_id}: {reminder_text}")
-    except Exception as e:
-        print(f"❌ Ошибка отправки напоминания: {e}")
+    # Напоминания одного чата на ту же минуту уходят одним сообщением
+    reminder_batches.add(user_id, reminder, planned)
 
 # ---------------------- Функция отправки скрытого напоминания ----------------------
-async def send_hidden_reminder(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    user_id = job.data["user_id"]
-    reminder_text = job.data["text"]
+def send_hidden_reminder(reminder, planned):
+    """Ставит скрытое напоминание в очередь доставки"""
+    user_id = reminder.user_id
+    reminder_text = reminder.text
     
     print(f"🔔 ОТПРАВКА СКРЫТОГО НАПОМИНАНИЯ пользователю {user_id}: {reminder_text}")
     
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"Ты сделаль? {reminder_text} 😼"
-        )
-        print(f"✅ УСПЕШНО отправлено скрытое напоминание пользователю {user_id}: {reminder_text}")
-    except Exception as e:
-        print(f"❌ Ошибка отправки скрытого напоминания: {e}")
+    hidden_batches.add(user_id, reminder, planned)
+
+# ---------------------- Склейка напоминаний ----------------------
+# Сколько секунд копим напоминания одного чата перед отправкой. Напоминания на одну
+# минуту срабатывают в одном проходе планировщика, так что хватает и доли секунды
+REMINDER_BATCH_WINDOW = 0.5
+# Лимиты Telegram на длину подписи к картинке и текста сообщения
+CAPTION_LIMIT = 1024
+MESSAGE_TEXT_LIMIT = 4096
+# И на число кнопок в одной клавиатуре
+KEYBOARD_BUTTON_LIMIT = 100
+
+def pack_batch(batch, head, tail, limit, max_items=None):
+    """Раскладывает напоминания пачки списком по сообщениям: [(текст, часть пачки)].
+
+    Текст сообщения не длиннее limit (слишком длинное напоминание обрезается),
+    напоминаний в сообщении не больше max_items - под каждым своя кнопка.
+    """
+    parts, chunk, lines = [], [], []
+    size = len(head) + len(tail)
+    for item in batch:
+        line = preview(f"• {item[0].text}", limit - len(head) - len(tail))
+        if chunk and (size + len(line) + 1 > limit or len(chunk) == max_items):
+            parts.append((head + "\n".join(lines) + tail, chunk))
+            chunk, lines, size = [], [], len(head) + len(tail)
+        chunk.append(item)
+        lines.append(line)
+        size += len(line) + 1
+    if chunk:
+        parts.append((head + "\n".join(lines) + tail, chunk))
+    return parts
+
+def occurrence(planned):
+    """Срабатывание, которое отмечает кнопка «Сделаль»: секунды UTC основного напоминания"""
+    return int(planned)
+
+def is_acked(reminder, hidden_planned):
+    """Отметил ли пользователь срабатывание, к которому относится скрытое напоминание"""
+    return (reminder.acked is not None
+            and reminder.acked == occurrence(hidden_planned - HIDDEN_REMINDER_DELAY.total_seconds()))
+
+def done_markup(batch):
+    """Кнопки «Сделаль» - по одной на каждое напоминание в сообщении"""
+    if len(batch) == 1:
+        reminder, planned = batch[0]
+        return InlineKeyboardMarkup([[InlineKeyboardButton(
+            "✅ Сделаль", callback_data=f"done_{reminder.id}_{occurrence(planned)}")]])
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"✅ {preview(reminder.text)}", callback_data=f"done_{reminder.id}_{occurrence(planned)}")]
+        for reminder, planned in batch
+    ])
+
+def deliver_reminders(chat_id, batch):
+    """Основные напоминания чата: одна картинка с подписью на все сразу и кнопки «Сделаль»"""
+    planned = min(when for _, when in batch)
+    if len(batch) == 1:
+        head, tail = "Эт твоя напоминулька, ты хотель ", " прекрасного тебе денька💖"
+        parts = [(head + preview(batch[0][0].text, CAPTION_LIMIT - len(head) - len(tail)) + tail, batch)]
+    else:
+        parts = pack_batch(batch, "Эт твои напоминульки, ты хотель:\n", "\nпрекрасного тебе денька💖", CAPTION_LIMIT,
+                           KEYBOARD_BUTTON_LIMIT)
+    for caption, part in parts:
+        delivery.submit("send_photo", chat_id, planned, "напоминание" if len(batch) == 1 else "напоминания",
+                        photo=get_random_image(), caption=caption, reply_markup=done_markup(part))
+
+def deliver_hidden_reminders(chat_id, batch):
+    """Скрытые напоминания чата: одно сообщение на все сразу, кроме уже отмеченных"""
+    # «Сделаль» могли нажать, пока скрытое напоминание ждало в пачке
+    batch = [(reminder, when) for reminder, when in batch if not is_acked(reminder, when)]
+    if not batch:
+        return
+    planned = min(when for _, when in batch)
+    if len(batch) == 1:
+        head, tail = "Ты сделаль? ", " 😼"
+        texts = [head + preview(batch[0][0].text, MESSAGE_TEXT_LIMIT - len(head) - len(tail)) + tail]
+    else:
+        texts = [text for text, _ in pack_batch(batch, "Ты сделаль?\n", "\n😼", MESSAGE_TEXT_LIMIT)]
+    for text in texts:
+        delivery.submit("send_message", chat_id, planned,
+                        "скрытое напоминание" if len(batch) == 1 else "скрытые напоминания", text=text)
+
+class ReminderBatcher:
+    """Копит напоминания по чатам REMINDER_BATCH_WINDOW секунд и отдаёт каждый чат доставке одной пачкой.
+
+    Таймер один на всех: он заводится первым напоминанием и сбрасывает всё накопленное.
+    """
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self.pending = {}  # чат -> [(напоминание, плановое время)]
+        self.timer = None
+
+    def add(self, chat_id, reminder, planned):
+        batch = self.pending.get(chat_id)
+        if batch is None:
+            batch = self.pending[chat_id] = []
+        batch.append((reminder, planned))
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(REMINDER_BATCH_WINDOW, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, {}
+        for chat_id, batch in pending.items():
+            self.deliver(chat_id, batch)
+
+reminder_batches = ReminderBatcher(deliver_reminders)
+hidden_batches = ReminderBatcher(deliver_hidden_reminders)
+
+# ---------------------- Планировщик ----------------------
+# Через сколько после основного напоминания приходит скрытое
+HIDDEN_REMINDER_DELAY = timedelta(minutes=10)
+
+# В планировщике держим только напоминания на ближайшие SCHEDULE_HORIZON,
+# остальные раз в SCHEDULE_REFILL_INTERVAL подтягиваются из хранилища.
+# None - держать в планировщике все напоминания сразу
+SCHEDULE_HORIZON = timedelta(hours=6)
+SCHEDULE_REFILL_INTERVAL = timedelta(minutes=30)
+
+# События записи в куче планировщика
+EVENT_MAIN, EVENT_HIDDEN = 0, 1
+
+# next_fire одноразового напоминания, которое уже сработало: раньше любого until оно не наступит,
+# так что при перезапуске due_reminders его больше не отдаёт и повторно оно не приходит
+FIRED = float("inf")
+
+class ReminderScheduler:
+    """Одна куча ближайших срабатываний и один цикл вместо пары задач JobQueue на напоминание.
+
+    Записи - сами объекты Reminder. Основное и скрытое напоминание - два события
+    одной записи. Отменённые записи просто удаляются из словаря, а их события
+    выбрасываются при извлечении из кучи. Перепланированная запись оставляет
+    себе уже назначенные скрытые напоминания, а прежнее основное событие
+    выбрасывается по порядковому номеру.
+    """
+
+    def __init__(self):
+        self.heap = []  # (время срабатывания UTC, порядковый номер, id записи, событие)
+        self.entries = {}
+        self.mains = {}  # id записи -> порядковый номер её действующего основного события
+        self.hidden = {}  # id записи -> сколько её скрытых напоминаний ещё впереди
+        self.ids = itertools.count()
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+        # Граница окна (UTC timestamp): всё, что срабатывает позже, пока лежит только в хранилище
+        self.window_end = None
+        self.lag = (metrics.histogram("napominalochka_scheduler_lag_seconds", event="main"),
+                    metrics.histogram("napominalochka_scheduler_lag_seconds", event="hidden"))
+        metrics.gauge("napominalochka_queue_depth", lambda: len(self.heap), queue="scheduler_heap")
+
+    def _push(self, when, entry_id, event):
+        sequence = next(self.sequence)
+        heapq.heappush(self.heap, (when, sequence, entry_id, event))
+        if self.heap[0][2] == entry_id:
+            # Новое событие раньше всех остальных - будим цикл
+            self.wakeup.set()
+        return sequence
+
+    def _entry(self, reminder):
+        """Запись для напоминания: его прежняя, если она ещё жива (ждёт скрытого), иначе новая"""
+        entry_id = reminder.entry_id
+        if entry_id not in self.entries:
+            entry_id = reminder.entry_id = next(self.ids)
+        self.entries[entry_id] = reminder
+        return entry_id
+
+    def add(self, reminder):
+        """Добавляет или перепланирует напоминание; reminder.next_fire - время основного напоминания"""
+        entry_id = self._entry(reminder)
+        self.mains[entry_id] = self._push(reminder.next_fire, entry_id, EVENT_MAIN)
+        return entry_id
+
+    def add_many(self, reminders):
+        """Добавляет сразу много напоминаний одной перестройкой кучи"""
+        for reminder in reminders:
+            entry_id = self._entry(reminder)
+            sequence = self.mains[entry_id] = next(self.sequence)
+            self.heap.append((reminder.next_fire, sequence, entry_id, EVENT_MAIN))
+        heapq.heapify(self.heap)
+        self.wakeup.set()
+
+    def cancel(self, entry_id):
+        """Отменяет все будущие события записи за O(1)"""
+        self.entries.pop(entry_id, None)
+        self.mains.pop(entry_id, None)
+        self.hidden.pop(entry_id, None)
+
+    def drop_main(self, entry_id):
+        """Снимает основное событие записи; уже назначенные скрытые напоминания остаются"""
+        self.mains.pop(entry_id, None)
+        self._release(entry_id)
+
+    def _release(self, entry_id):
+        """Удаляет запись, у которой не осталось событий"""
+        if entry_id not in self.mains and entry_id not in self.hidden:
+            self.entries.pop(entry_id, None)
+
+    def in_window(self, when):
+        """Попадает ли время срабатывания (UTC timestamp) в текущее окно планировщика"""
+        return self.window_end is None or when < self.window_end
+
+    def start(self, *background):
+        """Запускает цикл планировщика и дополнительные фоновые задачи"""
+        self.tasks = [asyncio.create_task(self.run())]
+        self.tasks += [asyncio.create_task(coroutine) for coroutine in background]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        for task in self.tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.tasks = []
+
+    async def run(self):
+        while True:
+            now = datetime.now(pytz.UTC).timestamp()
+            while self.heap and self.heap[0][0] <= now:
+                when, sequence, entry_id, event = heapq.heappop(self.heap)
+                entry = self.entries.get(entry_id)
+                if entry is None or event == EVENT_MAIN and self.mains.get(entry_id) != sequence:
+                    continue
+                self.lag[event].observe(max(0.0, now - when))
+                self._fire(entry_id, entry, event, when)
+            timeout = self.heap[0][0] - now if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, entry_id, reminder, event, when):
+        if event == EVENT_MAIN:
+            self._push(reminder.next_fire + HIDDEN_REMINDER_DELAY.total_seconds(), entry_id, EVENT_HIDDEN)
+            self.hidden[entry_id] = self.hidden.get(entry_id, 0) + 1
+            # Одноразовая запись дальше живёт только до скрытого напоминания
+            del self.mains[entry_id]
+            if is_repeating(reminder.repeat):
+                reminder.next_fire = next_occurrence(
+                    reminder.repeat, reminder.start, reminder.day, reminder.hour, reminder.minute,
+                    tz_service.tzinfo(reminder.tz), datetime.fromtimestamp(reminder.next_fire, pytz.UTC)
+                ).timestamp()
+                # Следующее повторение за горизонтом подтянет пополнение окна - в ту же запись
+                if self.in_window(reminder.next_fire):
+                    self.mains[entry_id] = self._push(reminder.next_fire, entry_id, EVENT_MAIN)
+            # Сама отправка идёт через очередь доставки и цикл не задерживает
+            send_reminder(reminder, when)
+        else:
+            left = self.hidden.pop(entry_id) - 1
+            if left:
+                self.hidden[entry_id] = left
+            # На отмеченное кнопкой «Сделаль» срабатывание скрытое напоминание не шлём
+            if not is_acked(reminder, when):
+                send_hidden_reminder(reminder, when)
+            self._release(entry_id)
+
+scheduler = ReminderScheduler()
 
 # ---------------------- Функция планирования напоминания ----------------------
-async def schedule_reminder(user_id, context: ContextTypes.DEFAULT_TYPE, reminder_data, reminder_index=None):
+async def schedule_reminder(reminder):
     try:
-        reminder_text = reminder_data["text"]
-        date_str = reminder_data["date"]
-        hour = reminder_data["hour"]
-        minute = reminder_data["minute"]
-        repeat = reminder_data.get("repeat", "no_repeat")
+        user_id = reminder.user_id
+        hour = reminder.hour
+        minute = reminder.minute
+        repeat = reminder.repeat
         
         # Получаем часовой пояс пользователя
-        user_tz = get_user_timezone(user_id)
-        user_timezone = pytz.timezone(user_tz)
-        
-        # Создаем datetime в часовом поясе пользователя
-        reminder_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-        reminder_datetime_naive = datetime.combine(reminder_date, datetime.min.time()).replace(hour=hour, minute=minute)
-        
-        # Преобразуем в часовой пояс пользователя, затем в UTC
-        reminder_datetime_user = user_timezone.localize(reminder_datetime_naive)
-        reminder_datetime_utc = reminder_datetime_user.astimezone(pytz.UTC)
+        user_tz = await get_user_timezone(user_id)
+        user_timezone = tz_service.tzinfo(user_tz)
         
-        # Время для скрытого напоминания (через 10 минут)
-        hidden_reminder_datetime_utc = reminder_datetime_utc + timedelta(minutes=10)
+        # Создаем datetime в часовом поясе пользователя и переводим в UTC
+        reminder_date = reminder.start
+        reminder_datetime_utc = local_to_utc(user_timezone, reminder_date, hour, minute)
         
         # Текущее время в UTC
         now_utc = datetime.now(pytz.UTC)
         
         print(f"⏰ Пользователь {user_id} установил: {hour}:{minute:02d} в поясе {user_tz}")
         print(f"🌍 Это соответствует: {reminder_datetime_utc.strftime('%d.%m.%Y %H:%M')} UTC")
-        print(f"🔔 Скрытое напоминание: {hidden_reminder_datetime_utc.strftime('%d.%m.%Y %H:%M')} UTC")
         
         # Если время уже прошло, корректируем для повторяющихся
         if reminder_datetime_utc < now_utc:
-            if repeat == "no_repeat":
-                # Для неповторяющихся - отправляем через 10 секунд
-                reminder_datetime_utc = now_utc + timedelta(seconds=10)
-                hidden_reminder_datetime_utc = reminder_datetime_utc + timedelta(minutes=10)
-                print(f"⏩ Время прошло, отправляем через 10 секунд")
-            else:
-                # Для повторяющихся - находим следующее подходящее время
-                while reminder_datetime_utc < now_utc:
-                    if repeat == "daily":
-                        reminder_datetime_utc += timedelta(days=1)
-                    elif repeat == "weekly":
-                        reminder_datetime_utc += timedelta(weeks=1)
-                    elif repeat == "monthly":
-                        reminder_datetime_utc += timedelta(days=30)
-                    elif repeat == "yearly":
-                        reminder_datetime_utc += timedelta(days=365)
-                
-                hidden_reminder_datetime_utc = reminder_datetime_utc + timedelta(minutes=10)
-                print(f"🔄 Время прошло, установлено следующее повторение")
-        
-        # Создаем уникальные имена для задач
-        timestamp = datetime.now().timestamp()
-        job_name = f"reminder_{user_id}_{timestamp}"
-        hidden_job_name = f"hidden_reminder_{user_id}_{timestamp}"
-        
-        # Определяем интервалы повторения
-        repeat_interval = None
-        if repeat == "daily":
-            repeat_interval = timedelta(days=1)
-        elif repeat == "weekly":
-            repeat_interval = timedelta(weeks=1)
-        elif repeat == "monthly":
-            repeat_interval = timedelta(days=30)
-        elif repeat == "yearly":
-            repeat_interval = timedelta(days=365)
-        
-        # Планируем основное напоминание
-        if repeat == "no_repeat":
-            context.job_queue.run_once(
-                send_reminder,
-                when=reminder_datetime_utc,
-                data={
-                    "user_id": user_id,
-                    "text": reminder_text,
-                    "reminder_index": reminder_index
-                },
-                name=job_name
-            )
-            print(f"📌 Запланировано ОДНОРАЗОВОЕ напоминание")
-        else:
-            context.job_queue.run_repeating(
-                send_reminder,
-                interval=repeat_interval,
-                first=reminder_datetime_utc,
-                data={
-                    "user_id": user_id,
-                    "text": reminder_text,
-                    "reminder_index": reminder_index,
-                    "repeat": repeat
-                },
-                name=job_name
-            )
-            print(f"📌 Запланировано ПОВТОРЯЮЩЕЕСЯ напоминание: {repeat}")
+            if not is_repeating(repeat):
+                # Для неповторяющихся - отправляем через 10 секунд
+                reminder_datetime_utc = now_utc + timedelta(seconds=10)
+                print(f"⏩ Время прошло, отправляем через 10 секунд")
+            else:
+                # Для повторяющихся - сразу вычисляем следующее повторение
+                reminder_datetime_utc = next_occurrence(
+                    repeat, reminder_date, reminder.day, hour, minute, user_timezone, now_utc
+                )
+                print(f"🔄 Время прошло, установлено следующее повторение")
         
-        # Планируем скрытое напоминание
-        if repeat == "no_repeat":
-            context.job_queue.run_once(
-                send_hidden_reminder,
-                when=hidden_reminder_datetime_utc,
-                data={
-                    "user_id": user_id,
-                    "text": reminder_text,
-                    "reminder_index": reminder_index
-                },
-                name=hidden_job_name
-            )
-        else:
-            context.job_queue.run_repeating(
-                send_hidden_reminder,
-                interval=repeat_interval,
-                first=hidden_reminder_datetime_utc,
-                data={
-                    "user_id": user_id,
-                    "text": reminder_text,
-                    "reminder_index": reminder_index,
-                    "repeat": repeat
-                },
-                name=hidden_job_name
-            )
+        # Запоминаем время ближайшего срабатывания (по нему в SQLite есть индекс)
+        next_fire = reminder_datetime_utc.timestamp()
+        if reminder.next_fire != next_fire:
+            store.set_reminder_field(user_id, reminder.id, "next_fire", next_fire)
+            reminder.next_fire = next_fire
+        reminder.tz = user_tz
         
-        # Сохраняем информацию о задачах
-        if user_id not in scheduled_jobs:
-            scheduled_jobs[user_id] = []
+        # Само напоминание и есть запись планировщика. Прежняя запись этого напоминания
+        # переходит к нему: её основное событие заменяется, а ещё не отправленное скрытое остаётся
+        user_jobs = scheduled_jobs.setdefault(user_id, {})
+        previous = user_jobs.pop(reminder.id, None)
+        reminder.entry_id = previous.entry_id if previous is not None else None
         
-        job_info = {
-            "job_name": job_name,
-            "hidden_job_name": hidden_job_name,
-            "text": reminder_text,
-            "datetime": reminder_datetime_utc,
-            "hidden_datetime": hidden_reminder_datetime_utc,
-            "repeat": repeat,
-            "reminder_index": reminder_index
-        }
+        if not scheduler.in_window(next_fire):
+            if previous is not None:
+                scheduler.drop_main(previous.entry_id)
+                if previous.entry_id in scheduler.entries:
+                    # Запись ждёт скрытого напоминания: отметка «Сделаль» и удаление должны её найти
+                    scheduler.entries[previous.entry_id] = reminder
+                    user_jobs[reminder.id] = reminder
+            print(f"💤 Напоминание за горизонтом планировщика, подтянется позже")
+            return
         
-        if reminder_index is not None and reminder_index < len(scheduled_jobs[user_id]):
-            scheduled_jobs[user_id][reminder_index] = job_info
-        else:
-            scheduled_jobs[user_id].append(job_info)
+        user_jobs[reminder.id] = reminder
+        scheduler.add(reminder)
+        print(f"📌 Запланировано напоминание: {REPEAT_NAMES[repeat]}")
         
         user_time = reminder_datetime_utc.astimezone(user_timezone)
-        hidden_user_time = hidden_reminder_datetime_utc.astimezone(user_timezone)
+        hidden_user_time = (reminder_datetime_utc + HIDDEN_REMINDER_DELAY).astimezone(user_timezone)
         print(f"✅ Основное напоминание запланировано на {user_time.strftime('%d.%m.%Y %H:%M')} в поясе {user_tz}")
         print(f"✅ Скрытое напоминание запланировано на {hidden_user_time.strftime('%d.%m.%Y %H:%M')} в поясе {user_tz}")
         
-        # Сохраняем данные после добавления напоминания
-        save_data()
-        
     except Exception as e:
         print(f"❌ Ошибка планирования напоминания: {e}")
 
+def unschedule_reminder(user_id, reminder_id):
+    """Отменяет основное и скрытое напоминание"""
+    removed = scheduled_jobs.get(user_id, {}).pop(reminder_id, None)
+    if removed is not None:
+        scheduler.cancel(removed.entry_id)
+
+# ---------------------- Пакетный расчёт срабатываний ----------------------
+# Через сколько отправить одноразовое напоминание, время которого уже прошло
+OVERDUE_DELAY = timedelta(seconds=10)
+# Номер дня 1970-01-01: от него отсчитываются даты datetime64[D]
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def offsets_at(tz_name, utc):
+    """Смещения пояса от UTC для массива моментов UTC (datetime64[m])"""
+    times, offsets = tz_service.transition_table(tz_name)
+    return offsets[np.maximum(np.searchsorted(times, utc, side="right") - 1, 0)]
+
+def local_to_utc_many(tz_name, local):
+    """Местное время (datetime64[m]) -> UTC для целого столбца, как local_to_utc"""
+    utc = local - offsets_at(tz_name, local)
+    utc = local - offsets_at(tz_name, utc)
+    # Время, которого нет из-за перевода часов, досчитываем по одному
+    inexact = np.flatnonzero(utc + offsets_at(tz_name, utc) != local)
+    if len(inexact):
+        tz = tz_service.tzinfo(tz_name)
+        for i in inexact:
+            moment = local[i].astype(datetime)
+            fixed = local_to_utc(tz, moment.date(), moment.hour, moment.minute)
+            utc[i] = np.datetime64(fixed.replace(tzinfo=None), "m")
+    return utc
+
+def occurrence_dates(codes, start, day, n):
+    """n-е повторения для столбцов, как occurrence_date"""
+    step_days = np.where(codes == WEEKLY, 7, 1)
+    by_days = start + n * step_days
+    month = start.astype("datetime64[M]") + n * np.where(codes == YEARLY, 12, 1)
+    month_start = month.astype("datetime64[D]")
+    month_days = ((month + 1).astype("datetime64[D]") - month_start).astype(int)
+    by_months = month_start + (np.minimum(day, month_days) - 1)
+    return np.where(codes >= MONTHLY, by_months, by_days)
+
+def next_fire_times(tz_names, dates, days, hours, minutes, codes, now):
+    """Ближайшие срабатывания (UTC, datetime64[s]) для столбцов напоминаний.
+
+    Расчёт идёт по группам напоминаний с одним часовым поясом; просроченные
+    повторяющиеся сразу переносятся на следующее повторение после now.
+    """
+    now64 = np.datetime64(now.replace(tzinfo=None), "s")
+    start = dates.astype("datetime64[D]")
+    day = np.where(days > 0, days, (start - start.astype("datetime64[M]").astype("datetime64[D]")).astype(int) + 1)
+    time_of_day = (hours * 60 + minutes).astype("timedelta64[m]")
+    result = np.empty(len(start), dtype="datetime64[s]")
+    zones, groups = np.unique(tz_names, return_inverse=True)
+    for group, tz_name in enumerate(zones):
+        rows = np.flatnonzero(groups == group)
+        utc = local_to_utc_many(tz_name, start[rows] + time_of_day[rows]).astype("datetime64[s]")
+        overdue = utc < now64
+        once = overdue & (codes[rows] == NO_REPEAT)
+        utc[once] = now64 + np.timedelta64(int(OVERDUE_DELAY.total_seconds()), "s")
+        repeat = np.flatnonzero(overdue & ~once)
+        if len(repeat):
+            rows_r = rows[repeat]
+            group_codes = codes[rows_r]
+            # Номер повторения по местной дате now, как в next_occurrence
+            now_local = (now64.astype("datetime64[m]") + offsets_at(tz_name, np.array([now64], dtype="datetime64[m]"))[0])
+            now_day = now_local.astype("datetime64[D]")
+            months = (now_day.astype("datetime64[M]") - start[rows_r].astype("datetime64[M]")).astype(int)
+            n = np.where(
+                group_codes >= MONTHLY,
+                months // np.where(group_codes == YEARLY, 12, 1),
+                (now_day - start[rows_r]).astype(int) // np.where(group_codes == WEEKLY, 7, 1),
+            )
+            n = np.maximum(n, 0)
+            pending = np.arange(len(rows_r))
+            while len(pending):
+                local = occurrence_dates(group_codes[pending], start[rows_r[pending]], day[rows_r[pending]], n[pending])
+                fire = local_to_utc_many(tz_name, local + time_of_day[rows_r[pending]]).astype("datetime64[s]")
+                utc[repeat[pending]] = fire
+                late = fire <= now64
+                n[pending[late]] += 1
+                pending = pending[late]
+        result[rows] = utc
+    return result
+
+# Меньше этого напоминаний на процесс не делим: пересылка столбцов дороже расчёта
+BULK_CHUNK_MIN = 50000
+
+async def next_fire_times_pooled(tz_names, dates, days, hours, minutes, codes, now):
+    """next_fire_times в пуле процессов: столбцы делятся на куски по процессам"""
+    count = len(dates)
+    parts = max(1, min(cpu_pool.workers, count // BULK_CHUNK_MIN))
+    bounds = np.linspace(0, count, parts + 1).astype(int).tolist()
+    results = await asyncio.gather(*(
+        cpu_pool.run(next_fire_times, tz_names[a:b], dates[a:b], days[a:b], hours[a:b], minutes[a:b], codes[a:b], now)
+        for a, b in zip(bounds, bounds[1:])
+    ))
+    return np.concatenate(results)
+
+async def bulk_schedule_due(until, after=None):
+    """Планирует напоминания из хранилища до until (и не раньше after) одним пакетным расчётом"""
+    reminders = [reminder for _, _, reminder in await store.due_reminders(until, after)]
+    if not reminders:
+        return 0
+    timezones = await store.get_timezones()
+    now = datetime.now(pytz.UTC)
+    
+    # Столбцы напоминаний; дата уже номер дня, так что строки не разбираются.
+    # Сборщик мусора на миллионе новых объектов только тратит время - их некому освобождать
+    with paused_gc():
+        tz_list = [timezones.get(reminder.user_id, DEFAULT_TIMEZONE) for reminder in reminders]
+        tz_names = np.array(tz_list)
+        dates = (np.fromiter((reminder.date for reminder in reminders), dtype=np.int64, count=len(reminders))
+                 - EPOCH_ORDINAL).astype("datetime64[D]")
+        days = np.fromiter((reminder.day for reminder in reminders), dtype=np.int64, count=len(reminders))
+        hours = np.fromiter((reminder.hour for reminder in reminders), dtype=np.int64, count=len(reminders))
+        minutes = np.fromiter((reminder.minute for reminder in reminders), dtype=np.int64, count=len(reminders))
+        codes = np.fromiter((reminder.repeat for reminder in reminders), dtype=np.int8, count=len(reminders))
+    
+    fire_times = await next_fire_times_pooled(tz_names, dates, days, hours, minutes, codes, now)
+    timestamps = (fire_times - np.datetime64(0, "s")).astype(np.int64)
+    # Дальше до конца без await
+    with paused_gc():
+        return schedule_fire_times(reminders, tz_list, timestamps, until)
+
+def schedule_fire_times(reminders, tz_list, timestamps, until):
+    """Записывает посчитанные срабатывания и кладёт в планировщик те, что раньше until"""
+    # В хранилище пишем только изменившиеся next_fire (в том числе ушедшие за горизонт)
+    stored = np.array([reminder.next_fire for reminder in reminders], dtype=float)
+    changed = np.flatnonzero(stored != timestamps)
+    for i, next_fire in zip(changed.tolist(), timestamps[changed].astype(float).tolist()):
+        reminder = reminders[i]
+        store.set_reminder_field(reminder.user_id, reminder.id, "next_fire", next_fire)
+        reminder.next_fire = next_fire
+    
+    order = np.argsort(timestamps, kind="stable")
+    order = order[timestamps[order] < until].tolist()
+    entries = []
+    for i in order:
+        reminder = reminders[i]
+        reminder.tz = tz_list[i]
+        user_jobs = scheduled_jobs.setdefault(reminder.user_id, {})
+        # При подтягивании окна напоминание могло уже попасть в планировщик при создании или
+        # ждать там скрытого напоминания - тогда оно занимает прежнюю запись, и скрытое не теряется
+        previous = user_jobs.get(reminder.id)
+        reminder.entry_id = previous.entry_id if previous is not None else None
+        user_jobs[reminder.id] = reminder
+        entries.append(reminder)
+    # Записи уже отсортированы по времени, куча собирается за один проход
+    scheduler.add_many(entries)
+    return len(entries)
+
 # ---------------------- Восстановление напоминаний при запуске ----------------------
-# async def restore_reminders_async(application):
-#     """Восстанавливает все напоминания при запуске бота (асинхронная версия)"""
-#     print("🔄 Восстановление напоминаний...")
+async def schedule_due(until, after=None):
+    """Планирует напоминания из хранилища, которые сработают раньше until"""
+    restored = 0
+    for user_id, _, reminder in await store.due_reminders(until, after):
+        try:
+            await schedule_reminder(reminder)
+            restored += 1
+        except Exception as e:
+            print(f"❌ Ошибка восстановления напоминания для пользователя {user_id}: {e}")
+    return restored
+
+async def refill_schedule():
+    """Периодически подтягивает в планировщик следующее окно напоминаний"""
+    while True:
+        await asyncio.sleep(SCHEDULE_REFILL_INTERVAL.total_seconds())
+        window_start = scheduler.window_end
+        window_end = datetime.now(pytz.UTC) + SCHEDULE_HORIZON
+        # Сдвигаем границу заранее, чтобы новые напоминания сразу попадали в окно
+        scheduler.window_end = window_end.timestamp()
+        restored = await (bulk_schedule_due if np is not None else schedule_due)(scheduler.window_end, window_start)
+        print(f"🔄 Окно планировщика сдвинуто до {window_end.strftime('%d.%m.%Y %H:%M')} UTC, добавлено {restored}")
+
+async def restore_reminders(application):
+    """Восстанавливает напоминания при запуске бота и запускает планировщик"""
+    print("🔄 Восстановление напоминаний...")
+    cpu_pool.start()
+    
+    started = time.perf_counter()
+    # С numpy все срабатывания считаются одним пакетом, иначе - по одному
+    restore = bulk_schedule_due if np is not None else schedule_due
+    if SCHEDULE_HORIZON is None:
+        # Без окна планируем всё: next_fire заведомо раньше бесконечности
+        restored = await restore(float("inf"))
+        scheduler.start()
+    else:
+        scheduler.window_end = (datetime.now(pytz.UTC) + SCHEDULE_HORIZON).timestamp()
+        restored = await restore(scheduler.window_end)
+        scheduler.start(refill_schedule())
     
-#     for user_id_str, reminders in user_data_store.items():
-#         user_id = int(user_id_str)
-#         for idx, reminder in enumerate(reminders):
-#             try:
-#                 # Проверяем, есть ли все необходимые данные для планирования
-#                 if all(key in reminder for key in ['text', 'date', 'hour', 'minute']):
-#                     # Планируем напоминание
-#                     await schedule_reminder(user_id, application, reminder, idx)
-#                     print(f"✅ Восстановлено напоминание для пользователя {user_id}: {reminder['text']}")
-#                 else:
-#                     print(f"⚠️ Неполные данные для напоминания пользователя {user_id}: {reminder}")
-#             except Exception as e:
-#                 print(f"❌ Ошибка восстановления напоминания для пользователя {user_id}: {e}")
+    print(f"✅ Восстановлено напоминаний в планировщике: {restored} за {time.perf_counter() - started:.2f} с")
+    delivery.start(application.bot)
+    media_cache.warm_up()
+    metrics.gauge("napominalochka_queue_depth", application.update_queue.qsize, queue="updates")
+    await metrics.start()
+
+# ---------------------- Клавиатуры ----------------------
+# Статичные клавиатуры одинаковы для всех пользователей: собираем их один раз при запуске
+def back_to_start_row(text="Вернуться в менюшку"):
+    return [InlineKeyboardButton(text, callback_data="back_to_start")]
+
+def grid(buttons, width):
+    """Раскладывает кнопки по строкам по width штук"""
+    return [buttons[i:i + width] for i in range(0, len(buttons), width)]
+
+# ---------------------- Страницы списков ----------------------
+# Сколько напоминаний на странице «Мои напоминалочки» и кнопок на странице остановки
+REMINDERS_PAGE_SIZE = 10
+STOP_PAGE_SIZE = 8
+# Длинный текст напоминания в списке и на кнопке обрезается
+PREVIEW_LENGTH = 60
+# Для скольких пользователей держим готовые страницы
+PAGE_CACHE_SIZE = 10000
+
+def preview(text, limit=PREVIEW_LENGTH):
+    """Текст не длиннее limit символов; обрезанный кончается многоточием"""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def page_markup(rows, route, page, count):
+    """Клавиатура страницы: кнопки rows, ◀️/▶️ на соседние страницы (callback "<route>_<номер>") и возврат в меню"""
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"{route}_{page - 1}"))
+    if page < count - 1:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"{route}_{page + 1}"))
+    return InlineKeyboardMarkup(rows + ([nav] if nav else []) + [back_to_start_row()])
+
+class ReminderPages:
+    """Готовые страницы списков по пользователям, чтобы листание было поиском в словаре.
+
+    Запись пользователя сбрасывается целиком, когда меняются его напоминания или пояс.
+    Обработчик, который начал собирать страницы до сброса, пишет в уже выброшенную
+    запись и ничего не портит.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.users = OrderedDict()
+
+    def get(self, user_id):
+        entry = self.users.get(user_id)
+        if entry is None:
+            entry = self.users[user_id] = {}
+            if len(self.users) > self.size:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(user_id)
+        return entry
+
+    def invalidate(self, user_id):
+        self.users.pop(user_id, None)
+
+reminder_pages = ReminderPages(PAGE_CACHE_SIZE)
+
+START_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Что напомнить?", callback_data="what")],
+    [InlineKeyboardButton("Мои напоминалочки", callback_data="my_reminders")],
+    [InlineKeyboardButton("Мой часовой пояс", callback_data="timezone")],
+    [InlineKeyboardButton("Пообщаться со мной", callback_data="chat_with_me")],
+    [InlineKeyboardButton("Поддержать автора", callback_data="support_author")],
+    [InlineKeyboardButton("Остановить туть", callback_data="stop")]
+])
+BACK_TO_START_MARKUP = InlineKeyboardMarkup([back_to_start_row()])
+BACK_MARKUP = InlineKeyboardMarkup([back_to_start_row("Назад")])
+# По 2 пояса в строке
+TIMEZONE_MARKUP = InlineKeyboardMarkup(
+    grid([InlineKeyboardButton(name, callback_data=f"tz_{key}") for key, (name, tz) in RUSSIAN_TIMEZONES.items()], 2)
+    + [back_to_start_row()]
+)
+HOUR_MARKUP = InlineKeyboardMarkup(
+    grid([InlineKeyboardButton(f"{i:02}", callback_data=f"hour_{i:02}") for i in range(24)], 6)
+    + [back_to_start_row()]
+)
+MINUTE_MARKUP = InlineKeyboardMarkup(
+    grid([InlineKeyboardButton(f"{i:02}", callback_data=f"minute_{i}") for i in range(0, 60, 5)], 6)
+    + [back_to_start_row()]
+)
+REPEAT_QUESTION_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Повторять?", callback_data="repeat"),
+     InlineKeyboardButton("Не повторять", callback_data="no_repeat")],
+    back_to_start_row()
+])
+REPEAT_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Каждый день", callback_data="daily")],
+    [InlineKeyboardButton("Каждую неделю", callback_data="weekly")],
+    [InlineKeyboardButton("Каждый месяц", callback_data="monthly")],
+    [InlineKeyboardButton("Каждый год", callback_data="yearly")],
+    back_to_start_row()
+])
+CONFIRM_STOP_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Точно?", callback_data="confirm_stop")],
+    back_to_start_row()
+])
+WHEN_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Когда напомнить?", callback_data="when")],
+    back_to_start_row()
+])
+
+# Календари по (год, месяц) на текущий день; с наступлением нового дня кэш сбрасывается
+calendar_cache = {}
+calendar_cache_day = None
+
+def build_calendar(year, month, today):
+    keyboard = []
+
+    first_day = datetime(year, month, 1)
+    last_day = (first_day.replace(month=month % 12 + 1, day=1) - timedelta(days=1)).day
+
+    for week_start in range(1, last_day + 1, 7):
+        row = []
+        for d in range(week_start, min(week_start + 7, last_day + 1)):
+            day_date = datetime(year, month, d).date()
+            if day_date >= today:
+                row.append(InlineKeyboardButton(str(d), callback_data=f"calendar_{day_date}"))
+            else:
+                row.append(InlineKeyboardButton(" ", callback_data="ignore"))
+        keyboard.append(row)
+
+    keyboard.append([InlineKeyboardButton("След. месяц", callback_data="next_month")])
+    keyboard.append(back_to_start_row())
+    return InlineKeyboardMarkup(keyboard)
+
+def calendar_markup(month_offset=0):
+    """Календарь на месяц со сдвигом month_offset от текущего, из кэша"""
+    global calendar_cache, calendar_cache_day
+    now = datetime.now()
+    today = now.date()
+    if today != calendar_cache_day:
+        # Наступила полночь: прошедшие дни должны погаснуть
+        calendar_cache = {}
+        calendar_cache_day = today
+    year = now.year + (now.month + month_offset - 1) // 12
+    month = (now.month + month_offset - 1) % 12 + 1
+    markup = calendar_cache.get((year, month))
+    if markup is None:
+        markup = calendar_cache[(year, month)] = build_calendar(year, month, today)
+    return markup
 
 # ---------------------- Старт ----------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("Что напомнить?", callback_data="what")],
-        [InlineKeyboardButton("Мои напоминалочки", callback_data="my_reminders")],
-        [InlineKeyboardButton("Мой часовой пояс", callback_data="timezone")],
-        [InlineKeyboardButton("Пообщаться со мной", callback_data="chat_with_me")],
-        [InlineKeyboardButton("Поддержать автора", callback_data="support_author")],
-        [InlineKeyboardButton("Остановить туть", callback_data="stop")]
-    ]
     if update.message:
-        await update.message.reply_text("Привет, котик!🐱 выбирай, что делаем:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.message.reply_text("Привет, котик!🐱 выбирай, что делаем:", reply_markup=START_MARKUP)
     elif update.callback_query:
         query = update.callback_query
         try:
             await query.answer()
         except:
             pass
-        await query.edit_message_text("Привет, котик!🐱 выбирай, что делаем:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await query.edit_message_text("Привет, котик!🐱 выбирай, что делаем:", reply_markup=START_MARKUP)
     return STATE_START
 
 # ---------------------- Обработка кнопок ----------------------
+# Разобранный callback_data: запрос, пользователь, маршрут и значение после префикса
+Callback = namedtuple("Callback", ["query", "user_id", "route", "value"])
+
+class CallbackRouter:
+    """Маршруты кнопок: точные ключи и префиксы вида "hour_" в словарях, выбор маршрута за O(1).
+
+    Для каждого маршрута копится гистограмма времени обработки (napominalochka_handler_seconds).
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+        self.latency = {}  # маршрут -> Histogram
+
+    def add(self, key, handler, prefix=False, parse=None, error_state=STATE_START):
+        if prefix and not key.endswith("_"):
+            raise ValueError(f"префикс маршрута должен заканчиваться на '_': {key}")
+        (self.prefixes if prefix else self.exact)[key] = (handler, parse, error_state)
+        self.latency[key] = metrics.histogram("napominalochka_handler_seconds", route=key)
+
+    def resolve(self, data):
+        """Находит маршрут: сначала точный ключ, потом префикс до первого '_'"""
+        route = self.exact.get(data)
+        if route is not None:
+            return data, route, None
+        key, sep, payload = data.partition("_")
+        route = self.prefixes.get(key + sep)
+        if route is not None:
+            return key + sep, route, payload
+        return None, None, None
+
+    async def dispatch(self, update, context):
+        query = update.callback_query
+        key, route, payload = self.resolve(query.data or "")
+        if route is None:
+            await query.answer("Эта кнопка недоступна.", show_alert=True)
+            return STATE_START
+        handler, parse, error_state = route
+        started = time.perf_counter()
+        try:
+            if parse is not None:
+                try:
+                    payload = parse(payload)
+                except ValueError:
+                    await query.edit_message_text("Эхъ, попробуй снова, ошибочка вышла😿")
+                    return error_state
+            return await handler(update, context, Callback(query, query.from_user.id, key, payload))
+        finally:
+            self.latency[key].observe(time.perf_counter() - started)
+
+    def report(self):
+        """Строки со временем обработки по маршрутам, самые медленные сверху"""
+        lines = []
+        for key, latency in sorted(self.latency.items(), key=lambda item: -item[1].sum):
+            if latency.count:
+                lines.append(f"   - {key}: {latency.count} раз, ср. {latency.sum / latency.count * 1000:.1f} мс, "
+                             f"p99 {latency.quantile(0.99) * 1000:.1f} мс, макс. {latency.max * 1000:.1f} мс")
+        return lines
+
+router = CallbackRouter()
+
+def callback_route(*keys, prefix=False, parse=None, error_state=STATE_START):
+    """Регистрирует обработчик кнопки для одного или нескольких ключей"""
+    def register(handler):
+        for key in keys:
+            router.add(key, handler, prefix=prefix, parse=parse, error_state=error_state)
+        return handler
+    return register
+
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     try:
@@ -369,378 +2816,395 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         pass
 
-    user_id = query.from_user.id
-    data = query.data
+    print(f"🔘 Обработка кнопки: {query.data} от пользователя {query.from_user.id}")
+    return await router.dispatch(update, context)
 
-    print(f"🔘 Обработка кнопки: {data} от пользователя {user_id}")
+# ---------------- Начальные действия ----------------
+@callback_route("what")
+async def handle_what(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    # Сохраняем состояние, что пользователь начал создание напоминания
+    context.user_data['creating_reminder'] = True
+    await query.edit_message_text("Введи, что напомнить:", reply_markup=BACK_TO_START_MARKUP)
+    return STATE_TEXT
 
-    # ---------------- Начальные действия ----------------
-    if data == "what":
-        # Сохраняем состояние, что пользователь начал создание напоминания
-        context.user_data['creating_reminder'] = True
-        keyboard = [[InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")]]
-        await query.edit_message_text("Введи, что напомнить:", reply_markup=InlineKeyboardMarkup(keyboard))
-        return STATE_TEXT
+# Подписи повторений в списке напоминаний
+REPEAT_LABELS = {
+    DAILY: " 🔄 (каждый день)",
+    WEEKLY: " 🔄 (каждую неделю)",
+    MONTHLY: " 🔄 (каждый месяц)",
+    YEARLY: " 🔄 (каждый год)",
+}
+# Списки длиннее этого собираются в пуле процессов: на коротких пересылка дороже самой работы
+RENDER_OFFLOAD_MIN = 200
 
-    elif data == "my_reminders":
-        reminders = user_data_store.get(str(user_id), [])
-        if not reminders:
-            text = "Туть пусто 👉👈"
-        else:
-            text_list = []
-            for idx, r in enumerate(reminders):
-                reminder_text = r.get('text', "?")
-                if all(key in r for key in ['date', 'hour', 'minute']):
-                    # Показываем время в часовом поясе пользователя
-                    date_str = r['date']
-                    hour = r['hour']
-                    minute = r['minute']
-                    user_tz = get_user_timezone(user_id)
-                    user_timezone = pytz.timezone(user_tz)
-                    
-                    reminder_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                    reminder_datetime = user_timezone.localize(
-                        datetime.combine(reminder_date, datetime.min.time()).replace(hour=hour, minute=minute)
-                    )
-                    
-                    # Находим название пояса для отображения
-                    tz_name = "Москва"
-                    for key, value in RUSSIAN_TIMEZONES.items():
-                        if value[1] == user_tz:
-                            tz_name = value[0]
-                            break
-                    
-                    # Добавляем информацию о повторении
-                    repeat_text = ""
-                    repeat = r.get('repeat', 'no_repeat')
-                    if repeat != 'no_repeat':
-                        if repeat == 'daily':
-                            repeat_text = " 🔄 (каждый день)"
-                        elif repeat == 'weekly':
-                            repeat_text = " 🔄 (каждую неделю)"
-                        elif repeat == 'monthly':
-                            repeat_text = " 🔄 (каждый месяц)"
-                        elif repeat == 'yearly':
-                            repeat_text = " 🔄 (каждый год)"
-                    
-                    # Проверяем активность напоминания
-                    now_user = datetime.now(user_timezone)
-                    status = "✅" if reminder_datetime > now_user else "⏰"
-                    
-                    text_list.append(f"{status} {reminder_text} — {reminder_datetime.strftime('%d.%m.%Y %H:%M')} ({tz_name.split(' ')[0]}){repeat_text}")
-                else:
-                    text_list.append(f"❌ {reminder_text} — Неполные данные (нет даты/времени)")
-            text = "Твои напоминульки:\n" + "\n".join(text_list)
-        keyboard = [[InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-        return STATE_START
+def render_reminder_pages(rows, tz_label, now_local, page_size):
+    """Тексты страниц списка напоминаний; rows - (текст, дата, час, минута, повторение).
 
-    # ---------------- Поддержать автора ----------------
-    elif data == "support_author":
-        support_message = (
-            "Это не обязательно, но напоминулька для тебя бесплатна, но если ты хочешь нас поддержать, "
-            "ты можешь отправить поддержалочку на номер карты: 2202206413185344 Павел Д."
-        )
-        keyboard = [[InlineKeyboardButton("Назад", callback_data="back_to_start")]]
-        await query.edit_message_text(support_message, reply_markup=InlineKeyboardMarkup(keyboard))
-        return STATE_START
+    Для каждой страницы возвращает (текст, когда устареет): в этот момент местного
+    времени первое ещё не прошедшее напоминание страницы станет прошедшим.
+    """
+    count = (len(rows) + page_size - 1) // page_size
+    pages = []
+    for page in range(count):
+        text_list = []
+        expires = None
+        for text, day, hour, minute, repeat in rows[page * page_size:(page + 1) * page_size]:
+            # Показываем время в часовом поясе пользователя
+            reminder_datetime = datetime.fromordinal(day).replace(hour=hour, minute=minute)
+            # Проверяем активность напоминания (оба времени - местные)
+            if reminder_datetime > now_local:
+                status = "✅"
+                expires = reminder_datetime if expires is None else min(expires, reminder_datetime)
+            else:
+                status = "⏰"
+            text_list.append(f"{status} {preview(text)} — {reminder_datetime.strftime('%d.%m.%Y %H:%M')} ({tz_label})"
+                             f"{REPEAT_LABELS.get(repeat, '')}")
+        header = "Твои напоминульки:" if count == 1 else f"Твои напоминульки ({page + 1} из {count}):"
+        pages.append((header + "\n" + "\n".join(text_list), expires))
+    return pages
 
-    # ---------------- Пообщаться со мной ----------------
-    elif data == "chat_with_me":
-        chat_message = (
-            "Эхъ, я тоже очень хочу с тобой пообщаться, но пока что я не умею разговаривать, у меня лапки 😿 "
-            "Но скоро я научусь и мы сможем с тобой болтать!"
-        )
-        keyboard = [[InlineKeyboardButton("Назад", callback_data="back_to_start")]]
-        await query.edit_message_text(chat_message, reply_markup=InlineKeyboardMarkup(keyboard))
+async def render_list(user_id, entry, offload=True):
+    """Собирает все страницы «Мои напоминалочки» пользователя в запись кэша"""
+    reminders = await store.get_reminders(user_id)
+    rows = [(r.text, r.date, r.hour, r.minute, r.repeat) for r in reminders.values()]
+    # Пояс, его название и текущее местное время нужны один раз на весь список
+    user_tz = await get_user_timezone(user_id)
+    tz_label = tz_service.display_name(user_tz).split(' ')[0]
+    now_user = tz_service.local_now(user_tz)
+    if not offload or len(rows) < RENDER_OFFLOAD_MIN:
+        pages = render_reminder_pages(rows, tz_label, now_user, REMINDERS_PAGE_SIZE)
+    else:
+        # Повторное нажатие отменяет ещё не начатую сборку прежнего списка
+        pages = await cpu_pool.run(render_reminder_pages, rows, tz_label, now_user, REMINDERS_PAGE_SIZE,
+                                   key=("my_reminders", user_id), wait=False)
+    entry["list"] = pages
+    entry["list_markup"] = {}
+    return pages
+
+async def show_reminders_page(callback, page):
+    query = callback.query
+    user_id = callback.user_id
+    entry = reminder_pages.get(user_id)
+    pages = entry.get("list")
+    if pages and 0 <= page < len(pages) and pages[page][1] is not None:
+        # Напоминание на странице успело пройти - статус ✅ уже неверен
+        if tz_service.local_now(await get_user_timezone(user_id)) >= pages[page][1]:
+            pages = None
+    if pages is None:
+        try:
+            pages = await render_list(user_id, entry)
+        except CpuPoolBusy:
+            if ("my_reminders", user_id) in cpu_pool.jobs:
+                # Список уже собирается по более новому нажатию
+                return STATE_START
+            # Пул занят - собираем на месте
+            pages = await render_list(user_id, entry, offload=False)
+    if not pages:
+        await query.edit_message_text("Туть пусто 👉👈", reply_markup=BACK_TO_START_MARKUP)
         return STATE_START
+    page = min(max(page, 0), len(pages) - 1)
+    markup = entry["list_markup"].get(page)
+    if markup is None:
+        markup = entry["list_markup"][page] = page_markup([], "list", page, len(pages))
+    await query.edit_message_text(pages[page][0], reply_markup=markup)
+    return STATE_START
 
-    # ---------------- Часовой пояс ----------------
-    elif data == "timezone":
-        user_tz = user_timezones.get(user_id)
-        
-        if user_tz:
-            message = "Выбери свой часовой пояс:"
-        else:
-            message = "Выбери свой часовой пояс:"
-        
-        # Создаем клавиатуру с часовыми поясами
-        keyboard = []
-        row = []
-        for i, (key, (name, tz)) in enumerate(RUSSIAN_TIMEZONES.items(), 1):
-            row.append(InlineKeyboardButton(name, callback_data=f"tz_{key}"))
-            if i % 2 == 0:  # По 2 кнопки в строке
-                keyboard.append(row)
-                row = []
-        if row:  # Добавляем оставшиеся кнопки
-            keyboard.append(row)
-        
-        keyboard.append([InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")])
-        
-        await query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
-        return STATE_TIMEZONE
-
-    elif data.startswith("tz_"):
-        tz_key = data.split("_")[1]
-        if tz_key in RUSSIAN_TIMEZONES:
-            user_timezones[user_id] = RUSSIAN_TIMEZONES[tz_key][1]
-            tz_name = RUSSIAN_TIMEZONES[tz_key][0]
-            
-            # Сохраняем часовой пояс
-            save_timezones()
-            
-            await query.edit_message_text(
-                f"Отлично! Установлен часовой пояс: {tz_name} 🕐\n"
-                f"Теперь все напоминания будут приходить в твоём местном времени!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")]])
-            )
-            return STATE_START
+@callback_route("my_reminders")
+async def handle_my_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    return await show_reminders_page(callback, 0)
 
-    # ---------------- Остановка напоминания ----------------
-    elif data == "stop":
-        reminders = user_data_store.get(str(user_id), [])
-        if not reminders:
-            await query.edit_message_text("Нет напоминулек для остановки 😿")
-            return STATE_START
-        keyboard = [[InlineKeyboardButton(r['text'], callback_data=f"stop_{idx}")] for idx, r in enumerate(reminders)]
-        keyboard.append([InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")])
-        await query.edit_message_text("Выбери напоминульку для остановки:", reply_markup=InlineKeyboardMarkup(keyboard))
-        return STATE_SELECT_REMINDER
-
-    elif data.startswith("stop_"):
-        idx = int(data.split("_")[1])
-        reminders = user_data_store.get(str(user_id), [])
-        if idx >= len(reminders):
-            await query.edit_message_text("Ошибка: в напоминульках пусто 🙀")
-            return STATE_START
+@callback_route("list_", prefix=True, parse=int)
+async def handle_reminders_page(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    return await show_reminders_page(callback, callback.value)
 
-        context.user_data['stop_index'] = idx
-        reminder_name = reminders[idx].get('text', "?")
-        keyboard = [
-            [InlineKeyboardButton("Точно?", callback_data="confirm_stop")],
-            [InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")]
-        ]
-        await query.edit_message_text(f"Ты выбрал: {reminder_name}\nХочешь удалить?", reply_markup=InlineKeyboardMarkup(keyboard))
-        return STATE_CONFIRM_STOP
-
-    elif data == "confirm_stop":
-        idx = context.user_data.get('stop_index')
-        reminders = user_data_store.get(str(user_id), [])
-
-        if idx is not None and idx < len(reminders):
-            removed = reminders.pop(idx)
-            # Также удаляем запланированные задачи (основную и скрытую)
-            if user_id in scheduled_jobs and idx < len(scheduled_jobs[user_id]):
-                job_info = scheduled_jobs[user_id].pop(idx)
-                # Находим и отменяем обе задачи в job_queue
-                current_jobs = context.job_queue.get_jobs_by_name(job_info["job_name"])
-                for job in current_jobs:
-                    job.schedule_removal()
-                
-                hidden_jobs = context.job_queue.get_jobs_by_name(job_info["hidden_job_name"])
-                for job in hidden_jobs:
-                    job.schedule_removal()
-            
-            # Сохраняем данные после удаления
-            save_data()
-            
-            await query.edit_message_text(f"Напоминулька '{removed.get('text', '?')}' остановлена😻")
-        else:
-            await query.edit_message_text("Ошибка: в напоминульках пусто🙀")
-        context.user_data.pop('stop_index', None)
-        return await start(update, context)
+# ---------------- Поддержать автора ----------------
+@callback_route("support_author")
+async def handle_support_author(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    support_message = (
+        "Это не обязательно, но напоминулька для тебя бесплатна, но если ты хочешь нас поддержать, "
+        "ты можешь отправить поддержалочку на номер карты: 2202206413185344 Павел Д."
+    )
+    await query.edit_message_text(support_message, reply_markup=BACK_MARKUP)
+    return STATE_START
 
-    elif data == "change":
-        await query.edit_message_text("Введи новую напоминульку:")
-        return STATE_TEXT
+# ---------------- Пообщаться со мной ----------------
+@callback_route("chat_with_me")
+async def handle_chat_with_me(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    chat_message = (
+        "Эхъ, я тоже очень хочу с тобой пообщаться, но пока что я не умею разговаривать, у меня лапки 😿 "
+        "Но скоро я научусь и мы сможем с тобой болтать!"
+    )
+    await query.edit_message_text(chat_message, reply_markup=BACK_MARKUP)
+    return STATE_START
 
-    elif data == "back_to_start":
-        return await start(update, context)
+# ---------------- Часовой пояс ----------------
+@callback_route("timezone")
+async def handle_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    user_id = callback.user_id
+    user_tz = await store.get_timezone(user_id)
+    
+    if user_tz:
+        message = "Выбери свой часовой пояс:"
+    else:
+        message = "Выбери свой часовой пояс:"
+    
+    await query.edit_message_text(message, reply_markup=TIMEZONE_MARKUP)
+    return STATE_TIMEZONE
 
-    # ---------------- Когда напомнить ----------------
-    elif data == "when":
-        if str(user_id) not in user_data_store or not user_data_store[str(user_id)]:
-            await query.edit_message_text("Сначала введи что напоминаем🐱")
-            return STATE_TEXT
-        
-        # Проверяем, есть ли текст напоминания
-        user_reminders = user_data_store[str(user_id)]
-        if not user_reminders or 'text' not in user_reminders[-1]:
-            await query.edit_message_text("Сначала введи что напоминаем🐱")
-            return STATE_TEXT
-            
-        await show_calendar(update, context)
-        return STATE_CALENDAR
-
-    # ---------------- Выбор даты ----------------
-    elif data.startswith("calendar_"):
-        date_str = data.split("_")[1]
-        if str(user_id) not in user_data_store or not user_data_store[str(user_id)]:
-            await query.edit_message_text("Сначала введи что напоминаем🐱")
-            return STATE_TEXT
-        
-        # Проверяем, есть ли текст напоминания
-        user_reminders = user_data_store[str(user_id)]
-        if not user_reminders or 'text' not in user_reminders[-1]:
-            await query.edit_message_text("Сначала введи что напоминаем🐱")
-            return STATE_TEXT
-            
-        user_data_store[str(user_id)][-1]["date"] = date_str
-        save_data()
-
-        hours = [f"{i:02}" for i in range(24)]
-        keyboard = []
-        row = []
-        for idx, h in enumerate(hours, 1):
-            row.append(InlineKeyboardButton(h, callback_data=f"hour_{h}"))
-            if idx % 6 == 0:
-                keyboard.append(row)
-                row = []
-        if row:
-            keyboard.append(row)
-        keyboard.append([InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")])
-        await query.edit_message_text("В какой час?", reply_markup=InlineKeyboardMarkup(keyboard))
-        return STATE_HOUR
-
-    # ---------------- Выбор часа ----------------
-    elif data.startswith("hour_"):
-        if str(user_id) not in user_data_store or not user_data_store[str(user_id)]:
-            await query.edit_message_text("Сначала введи что напоминаем🐱")
-            return STATE_TEXT
-        
-        # Проверяем, есть ли текст и дата напоминания
-        user_reminders = user_data_store[str(user_id)]
-        if not user_reminders or 'text' not in user_reminders[-1] or 'date' not in user_reminders[-1]:
-            await query.edit_message_text("Сначала введи что напоминаем и выбери дату🐱")
-            return STATE_TEXT
-            
-        hour_str = data.split("_")[1]
-        try:
-            hour = int(hour_str)
-        except ValueError:
-            await query.edit_message_text("Эхъ, попробуй снова, ошибочка вышла😿")
-            return STATE_HOUR
-        user_data_store[str(user_id)][-1]["hour"] = hour
-        save_data()
-
-        keyboard = []
-        row = []
-        for i in range(0, 60, 5):
-            row.append(InlineKeyboardButton(f"{i:02}", callback_data=f"minute_{i}"))
-            if len(row) == 6:
-                keyboard.append(row)
-                row = []
-        if row:
-            keyboard.append(row)
-        keyboard.append([InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")])
-        await query.edit_message_text("А в какую минутку?", reply_markup=InlineKeyboardMarkup(keyboard))
-        return STATE_MINUTE
-
-    # ---------------- Выбор минут ----------------
-    elif data.startswith("minute_"):
-        if str(user_id) not in user_data_store or not user_data_store[str(user_id)]:
-            await query.edit_message_text("Сначала введи что напоминаем🐱")
-            return STATE_TEXT
+@callback_route("tz_", prefix=True)
+async def handle_set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    user_id = callback.user_id
+    tz_key = callback.value
+    if tz_key in RUSSIAN_TIMEZONES:
+        tz_name = RUSSIAN_TIMEZONES[tz_key][0]
         
-        # Проверяем, есть ли текст, дата и час напоминания
-        user_reminders = user_data_store[str(user_id)]
-        if not user_reminders or 'text' not in user_reminders[-1] or 'date' not in user_reminders[-1] or 'hour' not in user_reminders[-1]:
-            await query.edit_message_text("Сначала заверши настройку напоминания🐱")
-            return STATE_TEXT
-            
-        try:
-            minute = int(data.split("_")[1])
-        except ValueError:
-            await query.edit_message_text("Эхъ, попробуй снова, ошибочка вышла😿")
-            return STATE_MINUTE
-        user_data_store[str(user_id)][-1]["minute"] = minute
-        save_data()
-
-        keyboard = [
-            [InlineKeyboardButton("Повторять?", callback_data="repeat"),
-             InlineKeyboardButton("Не повторять", callback_data="no_repeat")],
-            [InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")]
-        ]
-        await query.edit_message_text("Когда повторять?", reply_markup=InlineKeyboardMarkup(keyboard))
-        return STATE_REPEAT
-
-    # ---------------- Повторяемость ----------------
-    elif data == "repeat":
-        keyboard = [
-            [InlineKeyboardButton("Каждый день", callback_data="daily")],
-            [InlineKeyboardButton("Каждую неделю", callback_data="weekly")],
-            [InlineKeyboardButton("Каждый месяц", callback_data="monthly")],
-            [InlineKeyboardButton("Каждый год", callback_data="yearly")],
-            [InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")]
-        ]
-        await query.edit_message_text("Выберите частоту повторения:", reply_markup=InlineKeyboardMarkup(keyboard))
-        return STATE_REPEAT
-
-    elif data in ["daily", "weekly", "monthly", "yearly", "no_repeat"]:
-        # Проверяем, есть ли все необходимые данные
-        user_reminders = user_data_store.get(str(user_id), [])
-        if not user_reminders:
-            await query.edit_message_text("Ошибка: нет напоминаний для планирования😿")
-            return await start(update, context)
-            
-        current_reminder = user_reminders[-1]
-        if not all(key in current_reminder for key in ['text', 'date', 'hour', 'minute']):
-            await query.edit_message_text("Ошибка: неполные данные напоминания😿")
-            return await start(update, context)
-            
-        user_data_store[str(user_id)][-1]["repeat"] = data
-        reminder = user_data_store[str(user_id)][-1]
-        
-        # Показываем пользователю время в его часовом поясе
-        date_str = reminder['date']
-        hour = reminder['hour']
-        minute = reminder['minute']
-        user_tz = get_user_timezone(user_id)
-        user_timezone = pytz.timezone(user_tz)
+        # Сохраняем часовой пояс
+        tz_service.set_user_timezone(user_id, RUSSIAN_TIMEZONES[tz_key][1])
         
-        reminder_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-        reminder_datetime = user_timezone.localize(
-            datetime.combine(reminder_date, datetime.min.time()).replace(hour=hour, minute=minute)
+        await query.edit_message_text(
+            f"Отлично! Установлен часовой пояс: {tz_name} 🕐\n"
+            f"Теперь все напоминания будут приходить в твоём местном времени!",
+            reply_markup=BACK_TO_START_MARKUP
         )
+        return STATE_START
+
+# ---------------- Остановка напоминания ----------------
+async def show_stop_page(callback, page):
+    query = callback.query
+    user_id = callback.user_id
+    entry = reminder_pages.get(user_id)
+    stop = entry.get("stop")
+    if stop is None:
+        reminders = await store.get_reminders(user_id)
+        stop = entry["stop"] = {"items": [(reminder_id, r.text) for reminder_id, r in reminders.items()], "pages": {}}
+    items = stop["items"]
+    if not items:
+        await query.edit_message_text("Нет напоминулек для остановки 😿")
+        return STATE_START
+    count = (len(items) + STOP_PAGE_SIZE - 1) // STOP_PAGE_SIZE
+    page = min(max(page, 0), count - 1)
+    cached = stop["pages"].get(page)
+    if cached is None:
+        buttons = [[InlineKeyboardButton(preview(text), callback_data=f"stop_{reminder_id}")]
+                   for reminder_id, text in items[page * STOP_PAGE_SIZE:(page + 1) * STOP_PAGE_SIZE]]
+        title = "Выбери напоминульку для остановки:"
+        if count > 1:
+            title = f"Выбери напоминульку для остановки ({page + 1} из {count}):"
+        cached = stop["pages"][page] = (title, page_markup(buttons, "stoplist", page, count))
+    await query.edit_message_text(cached[0], reply_markup=cached[1])
+    return STATE_SELECT_REMINDER
+
+@callback_route("stop")
+async def handle_stop(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    return await show_stop_page(callback, 0)
+
+@callback_route("stoplist_", prefix=True, parse=int)
+async def handle_stop_page(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    return await show_stop_page(callback, callback.value)
+
+@callback_route("stop_", prefix=True, parse=int)
+async def handle_select_stop(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    user_id = callback.user_id
+    reminder_id = callback.value
+    reminder = await store.get_reminder(user_id, reminder_id)
+    if reminder is None:
+        await query.edit_message_text("Ошибка: в напоминульках пусто 🙀")
+        return STATE_START
+
+    context.user_data['stop_id'] = reminder_id
+    reminder_name = reminder.text
+    await query.edit_message_text(f"Ты выбрал: {reminder_name}\nХочешь удалить?", reply_markup=CONFIRM_STOP_MARKUP)
+    return STATE_CONFIRM_STOP
+
+@callback_route("confirm_stop")
+async def handle_confirm_stop(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    user_id = callback.user_id
+    reminder_id = context.user_data.get('stop_id')
+    removed = await store.remove_reminder(user_id, reminder_id) if reminder_id is not None else None
+
+    if removed is not None:
+        # Также отменяем основное и скрытое напоминание в планировщике
+        unschedule_reminder(user_id, reminder_id)
+        reminder_pages.invalidate(user_id)
         
-        # Находим название пояса для отображения
-        tz_name = "Москва"
-        for key, value in RUSSIAN_TIMEZONES.items():
-            if value[1] == user_tz:
-                tz_name = value[0]
-                break
-        
-        await query.message.reply_text("Спасибо! Есть напоминулька!")
+        await query.edit_message_text(f"Напоминулька '{removed.text}' остановлена😻")
+    else:
+        await query.edit_message_text("Ошибка: в напоминульках пусто🙀")
+    context.user_data.pop('stop_id', None)
+    return await start(update, context)
+
+@callback_route("change")
+async def handle_change(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    await query.edit_message_text("Введи новую напоминульку:")
+    return STATE_TEXT
+
+@callback_route("back_to_start")
+async def handle_back_to_start(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    return await start(update, context)
+
+# ---------------- Когда напомнить ----------------
+@callback_route("when")
+async def handle_when(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    # Проверяем, есть ли текст напоминания
+    draft = context.user_data.get('draft')
+    if not draft or 'text' not in draft:
+        await query.edit_message_text("Сначала введи что напоминаем🐱")
+        return STATE_TEXT
         
-        repeat_text = ""
-        if data != "no_repeat":
-            if data == "daily":
-                repeat_text = " 🔄 (повторяется каждый день)"
-            elif data == "weekly":
-                repeat_text = " 🔄 (повторяется каждую неделю)"
-            elif data == "monthly":
-                repeat_text = " 🔄 (повторяется каждый месяц)"
-            elif data == "yearly":
-                repeat_text = " 🔄 (повторяется каждый год)"
+    await show_calendar(update, context)
+    return STATE_CALENDAR
+
+# ---------------- Выбор даты ----------------
+@callback_route("calendar_", prefix=True)
+async def handle_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    date_str = callback.value
+    # Проверяем, есть ли текст напоминания
+    draft = context.user_data.get('draft')
+    if not draft or 'text' not in draft:
+        await query.edit_message_text("Сначала введи что напоминаем🐱")
+        return STATE_TEXT
         
-        await query.message.reply_text(
-            f"📝 Текст: {reminder['text']}\n"
-            f"⏰ Дата и время: {reminder_datetime.strftime('%d.%m.%Y %H:%M')}\n"
-            f"🌍 Часовой пояс: {tz_name}{repeat_text}"
-        )
+    draft["date"] = date_str
+
+    await query.edit_message_text("В какой час?", reply_markup=HOUR_MARKUP)
+    return STATE_HOUR
+
+# ---------------- Выбор часа ----------------
+@callback_route("hour_", prefix=True, parse=int, error_state=STATE_HOUR)
+async def handle_hour(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    # Проверяем, есть ли текст и дата напоминания
+    draft = context.user_data.get('draft')
+    if not draft or 'text' not in draft or 'date' not in draft:
+        await query.edit_message_text("Сначала введи что напоминаем и выбери дату🐱")
+        return STATE_TEXT
         
-        # Планируем напоминание с указанием индекса
-        reminder_index = len(user_data_store[str(user_id)]) - 1
-        await schedule_reminder(user_id, context, reminder, reminder_index)
+    draft["hour"] = callback.value
+
+    await query.edit_message_text("А в какую минутку?", reply_markup=MINUTE_MARKUP)
+    return STATE_MINUTE
+
+# ---------------- Выбор минут ----------------
+@callback_route("minute_", prefix=True, parse=int, error_state=STATE_MINUTE)
+async def handle_minute(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    # Проверяем, есть ли текст, дата и час напоминания
+    draft = context.user_data.get('draft')
+    if not draft or 'text' not in draft or 'date' not in draft or 'hour' not in draft:
+        await query.edit_message_text("Сначала заверши настройку напоминания🐱")
+        return STATE_TEXT
         
-        # Очищаем флаг создания напоминания
-        context.user_data.pop('creating_reminder', None)
+    draft["minute"] = callback.value
+
+    await query.edit_message_text("Когда повторять?", reply_markup=REPEAT_QUESTION_MARKUP)
+    return STATE_REPEAT
+
+# ---------------- Повторяемость ----------------
+@callback_route("repeat")
+async def handle_repeat_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    await query.edit_message_text("Выберите частоту повторения:", reply_markup=REPEAT_MENU_MARKUP)
+    return STATE_REPEAT
+
+@callback_route("daily", "weekly", "monthly", "yearly", "no_repeat")
+async def handle_repeat_choice(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = callback.query
+    user_id = callback.user_id
+    data = callback.route
+    # Проверяем, есть ли все необходимые данные
+    draft = context.user_data.get('draft')
+    if not draft:
+        await query.edit_message_text("Ошибка: нет напоминаний для планирования😿")
+        return await start(update, context)
         
+    if not draft.keys() >= REQUIRED_FIELDS:
+        await query.edit_message_text("Ошибка: неполные данные напоминания😿")
         return await start(update, context)
+        
+    # Черновик готов - только теперь он становится напоминанием в хранилище
+    reminder_date = date.fromisoformat(draft["date"])
+    reminder = Reminder(draft["text"], reminder_date.toordinal(), draft["hour"], draft["minute"], REPEAT_CODES[data])
+    store.add_reminder(user_id, reminder)
+    reminder_pages.invalidate(user_id)
+    context.user_data.pop('draft', None)
+    
+    # Показываем пользователю время в его часовом поясе
+    user_tz = await get_user_timezone(user_id)
+    reminder_datetime = datetime.combine(reminder_date, datetime.min.time()).replace(hour=reminder.hour, minute=reminder.minute)
+    
+    # Название пояса для отображения
+    tz_name = tz_service.display_name(user_tz)
+    
+    await query.message.reply_text("Спасибо! Есть напоминулька!")
+    
+    repeat_text = ""
+    if data != "no_repeat":
+        if data == "daily":
+            repeat_text = " 🔄 (повторяется каждый день)"
+        elif data == "weekly":
+            repeat_text = " 🔄 (повторяется каждую неделю)"
+        elif data == "monthly":
+            repeat_text = " 🔄 (повторяется каждый месяц)"
+        elif data == "yearly":
+            repeat_text = " 🔄 (повторяется каждый год)"
+    
+    await query.message.reply_text(
+        f"📝 Текст: {reminder.text}\n"
+        f"⏰ Дата и время: {reminder_datetime.strftime('%d.%m.%Y %H:%M')}\n"
+        f"🌍 Часовой пояс: {tz_name}{repeat_text}"
+    )
+    
+    # Планируем напоминание (id ему выдало хранилище)
+    await schedule_reminder(reminder)
+    
+    # Очищаем флаг создания напоминания
+    context.user_data.pop('creating_reminder', None)
+    
+    return await start(update, context)
 
-    else:
+# ---------------------- Кнопка «Сделаль» ----------------------
+async def handle_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отметка под напоминанием: скрытое напоминание к этому срабатыванию не придёт.
+
+    Кнопка живёт вне диалога, поэтому обработчик стоит отдельно от ConversationHandler
+    и шаг диалога не меняет.
+    """
+    query = update.callback_query
+    user_id = query.from_user.id
+    try:
+        _, reminder_id, acked = query.data.split("_")
+        reminder_id, acked = int(reminder_id), int(acked)
+    except ValueError:
         await query.answer("Эта кнопка недоступна.", show_alert=True)
-        return STATE_START
+        return
+
+    # Запись скрытого напоминания в куче остаётся и просто пропускается при срабатывании
+    reminder = scheduled_jobs.get(user_id, {}).get(reminder_id)
+    if reminder is not None:
+        reminder.acked = acked
+    store.set_reminder_field(user_id, reminder_id, "acked", acked)
+    print(f"✅ Пользователь {user_id} отметил напоминание {reminder_id}")
+
+    await query.answer("Умничка! Больше не напомню 😺")
+    # Убираем нажатую кнопку, остальные напоминания в сообщении можно отметить потом
+    markup = getattr(query.message, "reply_markup", None)
+    rows = [[button for button in row if button.callback_data != query.data]
+            for row in markup.inline_keyboard] if markup is not None else []
+    rows = [row for row in rows if row]
+    try:
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(rows) if rows else None)
+    except BadRequest:
+        pass
 
 # ---------------------- Ввод текста ----------------------
 async def text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -749,76 +3213,440 @@ async def text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     print(f"📝 Пользователь {user_id} ввел текст: {text}")
     
-    if str(user_id) not in user_data_store:
-        user_data_store[str(user_id)] = []
-    
-    # Добавляем новое напоминание
-    user_data_store[str(user_id)].append({"text": text})
-    
-    # Сохраняем данные после добавления текста напоминания
-    save_data()
-
-    keyboard = [
-        [InlineKeyboardButton("Когда напомнить?", callback_data="when")],
-        [InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")]
-    ]
-    await update.message.reply_text(f"Установили напоминульку: '{text}' 😺\nТеперь выбери когда напомнить:", reply_markup=InlineKeyboardMarkup(keyboard))
+    # Начинаем черновик напоминания; в хранилище он попадёт, когда будет выбрано повторение
+    context.user_data['draft'] = {"text": text}
+
+    await update.message.reply_text(f"Установили напоминульку: '{text}' 😺\nТеперь выбери когда напомнить:", reply_markup=WHEN_MARKUP)
     return STATE_START
 
 # ---------------------- Календарь ----------------------
 async def show_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE, month_offset=0):
     query = update.callback_query
-    now = datetime.now()
-    year = now.year + (now.month + month_offset - 1) // 12
-    month = (now.month + month_offset - 1) % 12 + 1
-    keyboard = []
+    try:
+        await query.edit_message_text("Выбери дату:", reply_markup=calendar_markup(month_offset))
+    except:
+        pass
 
-    first_day = datetime(year, month, 1)
-    last_day = (first_day.replace(month=month % 12 + 1, day=1) - timedelta(days=1)).day
+# ---------------------- Остановка ----------------------
+async def stop_delivery(application):
+    """Останавливает планировщик и досылает очередь, пока бот ещё может отправлять"""
+    await scheduler.stop()
+    reminder_batches.flush()
+    hidden_batches.flush()
+    await delivery.stop()
 
-    for week_start in range(1, last_day + 1, 7):
-        row = []
-        for d in range(week_start, min(week_start + 7, last_day + 1)):
-            day_date = datetime(year, month, d).date()
-            if day_date >= now.date():
-                row.append(InlineKeyboardButton(str(d), callback_data=f"calendar_{day_date}"))
+async def shutdown(application):
+    """Дописывает на диск всё, что не успело сохраниться"""
+    report = router.report()
+    if report:
+        print("📈 Время обработки кнопок:")
+        print("\n".join(report))
+    await store.flush()
+    await media_cache.flush()
+    cpu_pool.stop()
+    await metrics.stop()
+
+# ---------------------- Webhook ----------------------
+# Публичный адрес, на который Telegram будет присылать обновления (https, порт 443/80/88/8443)
+WEBHOOK_URL = "https://example.com/telegram"
+# Где слушает встроенный сервер (обычно за nginx, который держит сертификат)
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+# Telegram присылает его в заголовке каждого запроса - чужие запросы отбрасываем
+WEBHOOK_SECRET = "MY_WEBHOOK_SECRET"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Сколько необработанных обновлений держим в очереди; сверх этого Telegram повторит доставку позже
+WEBHOOK_QUEUE_LIMIT = 10000
+
+def webhook_app(accept, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    """HTTP-сервер для Telegram: проверяет секрет и отдаёт обновление в accept(data), тот возвращает код ответа"""
+    secret = secret.encode()
+
+    async def receive(request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), secret):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError as e:
+            print(f"⚠️ Непонятное обновление от Telegram: {e}")
+            return web.Response(status=400)
+        return web.Response(status=await accept(data))
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    return app
+
+def queue_update(application):
+    """accept для webhook_app: кладёт обновление в очередь Application и сразу отвечает"""
+    async def accept(data):
+        if application.update_queue.qsize() >= WEBHOOK_QUEUE_LIMIT:
+            return 503
+        try:
+            update = Update.de_json(data, application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            print(f"⚠️ Непонятное обновление от Telegram: {e}")
+            return 400
+        # Обработка идёт в цикле Application, Telegram ответа не ждёт
+        application.update_queue.put_nowait(update)
+        return 200
+    return accept
+
+def stop_on_signals():
+    """Событие, которое срабатывает по Ctrl+C или SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows или не главный поток
+            pass
+    return stop_event
+
+async def run_webhook(application, url=WEBHOOK_URL, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                      path=WEBHOOK_PATH, secret=WEBHOOK_SECRET, stop_event=None):
+    """Работа бота через webhook вместо run_polling; останавливается по Ctrl+C/SIGTERM или stop_event.
+
+    Без url webhook в Telegram не регистрируется - так работают шарды, которым обновления пересылает front.
+    """
+    if web is None:
+        raise RuntimeError("Для режима webhook нужен aiohttp: pip install aiohttp")
+    stop_event = stop_event or stop_on_signals()
+
+    # Тот же порядок запуска и остановки, что у run_polling, вместе с post_init/post_stop/post_shutdown
+    await application.initialize()
+    runner = web.AppRunner(webhook_app(queue_update(application), path, secret), access_log=None)
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if url:
+            await application.bot.set_webhook(url, allowed_updates=Update.ALL_TYPES, secret_token=secret)
+        await application.start()
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+        print(f"🌐 Webhook слушает {listen}:{port}{path}")
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# ---------------------- Шарды ----------------------
+# Сколько процессов-шардов обслуживают пользователей; 1 - всё в одном процессе, как раньше.
+# При SHARD_COUNT > 1 запущенный бот становится front: получает обновления от Telegram и
+# пересылает каждое шарду, которому принадлежит пользователь. У шарда своя папка с данными
+# (shards/<номер>), свой планировщик и своя очередь доставки.
+SHARD_COUNT = 1
+SHARD_DIR = "shards"
+# Сколько шардов было при прошлом запуске; по нему видно, что пользователей пора переносить
+SHARD_LAYOUT_FILE = "shards.json"
+# Шард i слушает 127.0.0.1:SHARD_BASE_PORT + i
+SHARD_BASE_PORT = 8600
+SHARD_FORWARD_TIMEOUT = 10
+# Сколько раз пытаемся отдать обновление недоступному шарду за один опрос Telegram; не принятые
+# обновления придут снова со следующим getUpdates, а остальные шарды тем временем не ждут
+SHARD_FORWARD_ATTEMPTS = 6
+# Сколько ждём остановки шарда (он досылает очередь), прежде чем завершить его принудительно
+SHARD_STOP_TIMEOUT = DELIVERY_DRAIN_TIMEOUT + 20
+FRONT_POLL_TIMEOUT = 30
+# Как часто front проверяет, живы ли процессы шардов (упавший шард перезапускается)
+SHARD_WATCH_INTERVAL = 5
+
+def shard_of(user_id, count):
+    """Номер шарда пользователя: 32-битный хеш user_id делится на count равных диапазонов"""
+    h = (user_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    return ((h >> 32) * count) >> 32
+
+def shard_dirs(count):
+    """Папки с данными шардов; один шард - это обычная папка бота"""
+    if count == 1:
+        return ["."]
+    return [os.path.join(SHARD_DIR, str(index)) for index in range(count)]
+
+def update_user_id(data):
+    """Пользователь, от которого пришло обновление (JSON от Telegram), или 0"""
+    for value in data.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user") or value.get("chat")
+            if user:
+                return user["id"]
+    return 0
+
+def read_shard_layout():
+    """{"count": N}; если перенос пользователей прервался, ещё и "moving_to" """
+    if not os.path.exists(SHARD_LAYOUT_FILE):
+        return {"count": 1}
+    with open(SHARD_LAYOUT_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_shard_layout(layout):
+    tmp_file = SHARD_LAYOUT_FILE + ".tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(layout, f)
+    os.replace(tmp_file, SHARD_LAYOUT_FILE)
+
+async def move_users(old_count, new_count):
+    """Переносит каждого пользователя в папку его шарда при new_count шардах.
+
+    Сначала пользователь записывается в новый шард и запись дожидается диска, только
+    потом он удаляется из старого. Если перенос прервётся, пользователь окажется в двух
+    местах, и повторный запуск перепишет его в новом шарде заново.
+
+    id напоминаний сохраняются (на них ссылаются кнопки в отправленных сообщениях).
+    Возвращает первый id, который ещё не выдан ни в одном шарде.
+    """
+    targets = shard_dirs(new_count)
+    sources = list(dict.fromkeys(shard_dirs(old_count) + targets))
+    stores = {}
+    for directory in sources:
+        if os.path.abspath(directory) == os.path.abspath("."):
+            stores[directory] = store
+        else:
+            os.makedirs(directory, exist_ok=True)
+            stores[directory] = open_store(directory)
+    moved = 0
+    try:
+        for source in sources:
+            source_store = stores[source]
+            misplaced = [user_id for user_id in source_store.user_ids()
+                         if targets[shard_of(user_id, new_count)] != source]
+            for user_id in misplaced:
+                target_store = stores[targets[shard_of(user_id, new_count)]]
+                reminders = await source_store.get_reminders(user_id)
+                tz = await source_store.get_timezone(user_id)
+                data, states = await source_store.get_session(user_id)
+                # Остатки прерванного переноса
+                await target_store.remove_user(user_id)
+                # Новый id - только если в базе шарда этот id уже у другого пользователя
+                taken = await target_store.foreign_reminder_ids(user_id, reminders)
+                for reminder_id, reminder in reminders.items():
+                    target_store.add_reminder(user_id, Reminder.from_row(reminder.to_row()),
+                                              None if reminder_id in taken else reminder_id)
+                if tz is not None:
+                    target_store.set_timezone(user_id, tz)
+                if data:
+                    target_store.set_user_data(user_id, data)
+                for chat_id, state in states.items():
+                    target_store.set_conversation_state(chat_id, user_id, state)
+            for target in targets:
+                await stores[target].flush()
+            for user_id in misplaced:
+                await source_store.remove_user(user_id)
+            await source_store.flush()
+            moved += len(misplaced)
+        ids_from = max(next(opened.ids) for opened in stores.values())
+    finally:
+        for opened in stores.values():
+            if opened is not store:
+                opened.close()
+    print(f"🧩 Шардов было {old_count}, стало {new_count}, перенесено пользователей: {moved}")
+    return ids_from
+
+async def rebalance_shards(count):
+    """Раскладывает данные по count шардам, если при прошлом запуске их было другое число.
+
+    В раскладке запоминается ids_from - с него шарды выдают новые id, не пересекаясь с чужими.
+    """
+    layout = read_shard_layout()
+    if "moving_to" in layout:
+        # Прошлый перенос прервался - сначала доводим его
+        ids_from = await move_users(layout["count"], layout["moving_to"])
+        layout = {"count": layout["moving_to"], "ids_from": ids_from}
+        write_shard_layout(layout)
+    if layout["count"] != count:
+        write_shard_layout({"count": layout["count"], "moving_to": count})
+        ids_from = await move_users(layout["count"], count)
+        write_shard_layout({"count": count, "ids_from": ids_from})
+
+def run_shard(index, count, ids_from=1):
+    """Процесс-шард: свои пользователи, свой планировщик и доставка; обновления приходят от front"""
+    print(f"🧩 Шард {index + 1} из {count}, порт {SHARD_BASE_PORT + index}")
+    # Шард выдаёт только id с остатком index по модулю count: при переносе пользователей id не столкнутся
+    store.issue_ids(ids_from, index, count)
+    # Лимит Telegram общий на бота - делим его между шардами
+    rate = DELIVERY_GLOBAL_RATE / count
+    delivery.global_bucket = TokenBucket(rate, max(1, rate))
+    # И процессоры машины тоже
+    cpu_pool.workers = max(1, CPU_WORKERS // count) if CPU_WORKERS else 0
+    if METRICS_PORT:
+        metrics.port = METRICS_PORT + 1 + index
+    application = build_application(ApplicationBuilder().token(TOKEN).base_url(API_BASE_URL).updater(None))
+    asyncio.run(run_webhook(application, url=None, listen="127.0.0.1", port=SHARD_BASE_PORT + index))
+
+class ShardRouter:
+    """Front: пересылает обновление шарду, которому принадлежит пользователь"""
+
+    def __init__(self, count, session):
+        self.count = count
+        self.session = session
+        self.urls = [f"http://127.0.0.1:{SHARD_BASE_PORT + index}{WEBHOOK_PATH}" for index in range(count)]
+        self.forwarded = [0] * count
+        # Обновления, уже принятые шардами, но ещё не подтверждённые offset (придут повторно)
+        self.delivered = set()
+
+    async def forward(self, data):
+        """Отдаёт обновление шарду и возвращает код его ответа (503, если шард недоступен)"""
+        shard = shard_of(update_user_id(data), self.count)
+        try:
+            async with self.session.post(self.urls[shard], json=data, headers={SECRET_HEADER: WEBHOOK_SECRET},
+                                         timeout=ClientTimeout(total=SHARD_FORWARD_TIMEOUT)) as response:
+                status = response.status
+        except (ClientError, asyncio.TimeoutError):
+            return 503
+        if status == 200:
+            self.forwarded[shard] += 1
+        return status
+
+    async def forward_in_order(self, updates, stop_event):
+        """Пересылает обновления одному шарду по порядку.
+
+        Недоступный шард ждём не дольше SHARD_FORWARD_ATTEMPTS попыток и до остановки front;
+        возвращает update_id первого не принятого обновления или None, если приняты все.
+        """
+        for data in updates:
+            update_id = data["update_id"]
+            if update_id in self.delivered:
+                continue
+            delay = 0.1
+            for _ in range(SHARD_FORWARD_ATTEMPTS):
+                status = await self.forward(data)
+                if status == 200:
+                    break
+                if status in (400, 403):
+                    print(f"⚠️ Шард отклонил обновление {update_id}: {status}")
+                    break
+                if stop_event.is_set():
+                    return update_id
+                try:
+                    await asyncio.wait_for(stop_event.wait(), delay)
+                    return update_id
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(delay * 2, 5)
             else:
-                row.append(InlineKeyboardButton(" ", callback_data="ignore"))
-        keyboard.append(row)
+                print(f"⚠️ Шард {shard_of(update_user_id(data), self.count) + 1} недоступен, "
+                      f"обновление {update_id} отложено")
+                return update_id
+            self.delivered.add(update_id)
+        return None
 
-    keyboard.append([InlineKeyboardButton("След. месяц", callback_data="next_month")])
-    keyboard.append([InlineKeyboardButton("Вернуться в менюшку", callback_data="back_to_start")])
+    async def forward_batch(self, updates, stop_event):
+        """Пачка из getUpdates: шарды параллельно, у каждого шарда - в порядке прихода.
+
+        Возвращает offset для следующего getUpdates: после последнего обновления, если приняты все,
+        иначе первое не принятое (принятые после него при повторе пропускаются).
+        """
+        by_shard = {}
+        for data in updates:
+            by_shard.setdefault(shard_of(update_user_id(data), self.count), []).append(data)
+        pending = await asyncio.gather(*(self.forward_in_order(batch, stop_event) for batch in by_shard.values()))
+        pending = [update_id for update_id in pending if update_id is not None]
+        offset = min(pending) if pending else updates[-1]["update_id"] + 1
+        self.delivered = {update_id for update_id in self.delivered if update_id >= offset}
+        return offset
+
+def start_shard(index, count):
+    """Процесс шарда index; запускается тем же скриптом, что и front, - с теми же настройками"""
+    ids_from = read_shard_layout().get("ids_from", 1)
+    return subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0]), "--shard", f"{index}/{count}/{ids_from}"],
+                            cwd=os.path.abspath(shard_dirs(count)[index]))
+
+async def watch_shards(processes, count):
+    """Раз в SHARD_WATCH_INTERVAL проверяет процессы шардов и перезапускает завершившиеся.
 
+    Пока шард перезапускается, его обновления ждут у front (см. forward_in_order).
+    """
+    while True:
+        await asyncio.sleep(SHARD_WATCH_INTERVAL)
+        for index, process in enumerate(processes):
+            code = process.poll()
+            if code is not None:
+                print(f"💥 Шард {index + 1} завершился с кодом {code}, перезапускаем")
+                processes[index] = start_shard(index, count)
+
+async def run_front(count, processes=None):
+    """Front: получает обновления от Telegram (polling или webhook) и раздаёт их шардам"""
+    stop_event = stop_on_signals()
+    watcher = asyncio.create_task(watch_shards(processes, count)) if processes else None
     try:
-        await query.edit_message_text("Выбери дату:", reply_markup=InlineKeyboardMarkup(keyboard))
-    except:
-        pass
+        await serve_front(count, stop_event)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
 
-# ---------------------- Основная функция ----------------------
-def main():
-    """Основная синхронная функция"""
-    # Создаем приложение
-    application = ApplicationBuilder().token(TOKEN).build()
+async def serve_front(count, stop_event):
+    """Пересылка обновлений шардам до stop_event"""
+    async with ClientSession() as session, Bot(TOKEN, base_url=API_BASE_URL) as bot:
+        router = ShardRouter(count, session)
+        if UPDATE_MODE == "webhook":
+            await bot.set_webhook(WEBHOOK_URL, allowed_updates=Update.ALL_TYPES, secret_token=WEBHOOK_SECRET)
+            runner = web.AppRunner(webhook_app(router.forward), access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+            print(f"🌐 Front слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+            try:
+                await stop_event.wait()
+            finally:
+                await runner.cleanup()
+        else:
+            await bot.delete_webhook()
+            offset = None
+            while not stop_event.is_set():
+                polling = asyncio.ensure_future(bot.get_updates(
+                    offset=offset, timeout=FRONT_POLL_TIMEOUT, read_timeout=FRONT_POLL_TIMEOUT + 10,
+                    allowed_updates=Update.ALL_TYPES))
+                stopping = asyncio.ensure_future(stop_event.wait())
+                await asyncio.wait((polling, stopping), return_when=asyncio.FIRST_COMPLETED)
+                stopping.cancel()
+                if not polling.done():
+                    polling.cancel()
+                    break
+                try:
+                    updates = polling.result()
+                except NetworkError as e:
+                    print(f"⚠️ Ошибка получения обновлений: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                if updates:
+                    # offset сдвигаем только до первого обновления, которое шард ещё не принял
+                    offset = await router.forward_batch([update.to_dict() for update in updates], stop_event)
+    print(f"📨 Переслано шардам: {router.forwarded}")
 
-    # Восстанавливаем напоминания СИНХРОННО
-    print("🔄 Восстановление напоминаний...")
-    
-    for user_id_str, reminders in user_data_store.items():
-        user_id = int(user_id_str)
-        for idx, reminder in enumerate(reminders):
+def run_sharded(count):
+    """Запускает count шардов отдельными процессами и front в текущем"""
+    asyncio.run(rebalance_shards(count))
+    processes = [start_shard(index, count) for index in range(count)]
+    try:
+        # Список processes общий с front: перезапущенный шард подменяет в нём упавший
+        asyncio.run(run_front(count, processes))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
             try:
-                # Проверяем, есть ли все необходимые данные для планирования
-                if all(key in reminder for key in ['text', 'date', 'hour', 'minute']):
-                    # Планируем напоминание СИНХРОННО через run_sync
-                    application.job_queue.run_once(
-                        lambda context: asyncio.create_task(schedule_reminder(user_id, context, reminder, idx)),
-                        when=0
-                    )
-                    print(f"✅ Восстановлено напоминание для пользователя {user_id}: {reminder['text']}")
-                else:
-                    print(f"⚠️ Неполные данные для напоминания пользователя {user_id}: {reminder}")
-            except Exception as e:
-                print(f"❌ Ошибка восстановления напоминания для пользователя {user_id}: {e}")
+                process.wait(SHARD_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+# ---------------------- Основная функция ----------------------
+def build_application(builder=None):
+    """Приложение со всеми обработчиками; builder можно передать свой (например, с другим base_url)"""
+    open_default_store()
+    # Напоминания восстанавливаются в планировщик после запуска цикла событий
+    application = (
+        (builder or ApplicationBuilder().token(TOKEN).base_url(API_BASE_URL))
+        .persistence(StorePersistence())
+        .post_init(restore_reminders)
+        .post_stop(stop_delivery)
+        .post_shutdown(shutdown)
+        .build()
+    )
 
     # Добавляем обработчики
     conv_handler = ConversationHandler(
@@ -838,19 +3666,48 @@ def main():
             STATE_TIMEZONE: [CallbackQueryHandler(button)],
         },
         fallbacks=[CommandHandler("start", start)],
-        per_message=False
+        per_message=False,
+        name=CONVERSATION_NAME,
+        persistent=True
     )
 
+    # Кнопка «Сделаль» под напоминанием работает на любом шаге диалога и без него
+    application.add_handler(CallbackQueryHandler(handle_done, pattern=r"^done_"))
     application.add_handler(conv_handler)
-    
+    return application
+
+def main():
+    """Основная синхронная функция"""
+    open_default_store()
+    if len(sys.argv) == 3 and sys.argv[1] == "--shard":
+        run_shard(*map(int, sys.argv[2].split("/")))
+        store.close()
+        return
+    if SHARD_COUNT > 1:
+        run_sharded(SHARD_COUNT)
+        store.close()
+        return
+    if os.path.exists(SHARD_LAYOUT_FILE):
+        # Раньше бот работал шардами - собираем всех пользователей обратно
+        asyncio.run(rebalance_shards(1))
+
+    application = build_application()
+
     print("🤖 Бот запущен...")
     print("📊 Статистика:")
-    print(f"   - Пользователей: {len(user_data_store)}")
-    print(f"   - Всего напоминаний: {sum(len(reminders) for reminders in user_data_store.values())}")
-    print(f"   - Часовые пояса: {len(user_timezones)}")
+    users_count, reminders_count, timezones_count = store.stats()
+    print(f"   - Пользователей: {users_count}")
+    print(f"   - Всего напоминаний: {reminders_count}")
+    print(f"   - Часовые пояса: {timezones_count}")
     
-    # Запускаем бота СИНХРОННО
-    application.run_polling()
+    if UPDATE_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        # Запускаем бота СИНХРОННО
+        application.run_polling()
+
+    # Закрываем хранилище (для JSON - дожидаемся фонового сжатия журналов)
+    store.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,16 +1,219 @@
 # "Я всё проправиль! Пожалуйста - проверь свои напоминалочки, вдруг я что-то забыл 🐱"
 from telegram import Bot
+from telegram.error import BadRequest, Forbidden, InvalidToken, NetworkError, RetryAfter
+from datetime import timedelta
 import asyncio
+import json
+import os
+import sqlite3
+import struct
+import time
 
 TOKEN = "MY_TOKEN_TELEGRAM" #Нужен реальный токен
-USER_ID = 0000000000000000 #Указание ид вручную (будет доработка)
 IMAGE_URL = "https://disk.yandex.ru/i/sUQJiDSpgfTyNg"
+MESSAGE = "Я всё проправиль! Пожалуйста - проверь свои напоминалочки, вдруг я что-то забыл 🐱"
 
-async def send_test_message():
-    bot = Bot(token=TOKEN)
-    message = "Я всё проправиль! Пожалуйста - проверь свои напоминалочки, вдруг я что-то забыл 🐱"
-    await bot.send_photo(chat_id=USER_ID, photo=IMAGE_URL, caption=message)
+# Где лежат данные бота и как они хранятся (как STORAGE_BACKEND в napominalochka.py)
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STORAGE_BACKEND = "json"
+DATA_FILES = ["user_data.json", "user_timezones.json"]
+# Двоичные снапшоты: заголовок (magic, версия, резерв, число пользователей, ...), за ним id пользователей
+BINARY_FILES = {"user_data.bin": struct.Struct("<4sHHIIqQ"), "user_timezones.bin": struct.Struct("<4sHHII")}
+JOURNAL_FILES = ["user_data.journal.1", "user_data.journal", "user_timezones.journal.1", "user_timezones.journal"]
+SQLITE_FILE = "napominalochka.db"
+# При SHARD_COUNT > 1 у каждого шарда своя папка с такими же файлами
+SHARD_DIR = "shards"
+
+# Имя рассылки: по нему ведётся файл прогресса, новая рассылка - новое имя
+BROADCAST_ID = "sorry"
+CHECKPOINT_FILE = f"broadcast_{BROADCAST_ID}.checkpoint"
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота
+RATE_PER_SECOND = 25
+WORKERS = 8
+MAX_ATTEMPTS = 5
+
+# ---------------------- Получатели ----------------------
+def data_dirs():
+    """Папка бота и папки шардов, если они есть"""
+    dirs = [BOT_DIR]
+    shards = os.path.join(BOT_DIR, SHARD_DIR)
+    if os.path.isdir(shards):
+        dirs += [os.path.join(shards, name) for name in sorted(os.listdir(shards))]
+    return dirs
+
+def iter_user_ids():
+    """Отдаёт по одному всех пользователей бота без повторов"""
+    seen = set()
+    for data_dir in data_dirs():
+        for user_id in iter_dir_user_ids(data_dir):
+            if user_id not in seen:
+                seen.add(user_id)
+                yield user_id
+
+def iter_dir_user_ids(data_dir):
+    """Пользователи из файлов данных одной папки (могут повторяться)"""
+    if STORAGE_BACKEND == "sqlite":
+        path = os.path.join(data_dir, SQLITE_FILE)
+        if not os.path.exists(path):
+            return
+        db = sqlite3.connect(path)
+        try:
+            for (user_id,) in db.execute("SELECT user_id FROM reminders UNION SELECT user_id FROM timezones"):
+                yield user_id
+        finally:
+            db.close()
+        return
+
+    for name in DATA_FILES:
+        path = os.path.join(data_dir, name)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                user_ids = list(json.load(f))
+            for user_id in user_ids:
+                yield int(user_id)
+    for name, header in BINARY_FILES.items():
+        path = os.path.join(data_dir, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                users = header.unpack(f.read(header.size))[3]
+                yield from (user_id for (user_id,) in struct.iter_unpack("<q", f.read(8 * users)))
+    # Пользователи, появившиеся после последнего сжатия, есть только в журналах
+    for name in JOURNAL_FILES:
+        path = os.path.join(data_dir, name)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield int(json.loads(line)["user"])
+                except (ValueError, KeyError):
+                    continue
+
+# ---------------------- Прогресс ----------------------
+def load_checkpoint(path):
+    """Пользователи, которым рассылка уже отправлена (или отправить нельзя)"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r', encoding='utf-8') as f:
+        return {int(line) for line in f if line.strip()}
+
+# ---------------------- Рассылка ----------------------
+class RateLimiter:
+    """Не больше rate отправок в секунду на все обработчики вместе"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = time.monotonic()
+        self.paused_until = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(self.next_slot, now, self.paused_until)
+        self.next_slot = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+    def pause(self, seconds):
+        # После RetryAfter Telegram ждёт паузы от всего бота
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+async def send_one(bot, limiter, user_id):
+    """Отправляет рассылку одному пользователю.
+
+    Возвращает (текст ошибки или None, закончили ли с этим пользователем).
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        await limiter.wait()
+        try:
+            await bot.send_photo(chat_id=user_id, photo=IMAGE_URL, caption=MESSAGE)
+            return None, True
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            limiter.pause(retry_after)
+            error = e
+        except (BadRequest, Forbidden) as e:
+            # Бот заблокирован или чата нет - повтор не поможет
+            return str(e), True
+        except NetworkError as e:
+            await asyncio.sleep(2 ** attempt)
+            error = e
+    return str(error), False
+
+async def broadcast(bot, user_ids, checkpoint_path):
+    """Рассылает сообщение всем user_ids, пропуская уже отмеченных в файле прогресса"""
+    done = load_checkpoint(checkpoint_path)
+    limiter = RateLimiter(RATE_PER_SECOND)
+    queue = asyncio.Queue(maxsize=WORKERS * 4)
+    stats = {"sent": 0, "skipped": 0, "failed": {}}
+    # С неверным токеном не уйдёт ни одно сообщение - рассылку останавливаем целиком
+    stopped = []
+
+    async def worker(checkpoint):
+        while True:
+            user_id = await queue.get()
+            try:
+                if stopped:
+                    # Остаток очереди просто разбираем, чтобы queue.join() дождался
+                    continue
+                try:
+                    error, finished = await send_one(bot, limiter, user_id)
+                except InvalidToken as e:
+                    stopped.append(e)
+                    continue
+                except Exception as e:
+                    # Прочие ошибки (ChatMigrated, Conflict, ...) не должны ронять обработчик;
+                    # как и сетевые, не отмечаем - при следующем запуске будет повтор
+                    error, finished = f"{type(e).__name__}: {e}", False
+                if error is None:
+                    stats["sent"] += 1
+                else:
+                    stats["failed"][user_id] = error
+                    print(f"❌ Не отправлено {user_id}: {error}")
+                # Временные ошибки не отмечаем - при следующем запуске будет повтор
+                if finished:
+                    checkpoint.write(f"{user_id}\n")
+                    checkpoint.flush()
+            finally:
+                queue.task_done()
+
+    started = time.monotonic()
+    with open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+        workers = [asyncio.create_task(worker(checkpoint)) for _ in range(WORKERS)]
+        for user_id in user_ids:
+            if stopped:
+                break
+            if user_id in done:
+                stats["skipped"] += 1
+                continue
+            await queue.put(user_id)
+        await queue.join()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    elapsed = time.monotonic() - started
+
+    if stopped:
+        print(f"⛔ Рассылка остановлена: {stopped[0]}")
+    print("📊 Итог рассылки:")
+    print(f"   - Отправлено: {stats['sent']}")
+    print(f"   - Пропущено (уже было): {stats['skipped']}")
+    print(f"   - Не отправлено: {len(stats['failed'])}")
+    for user_id, error in stats["failed"].items():
+        print(f"     {user_id}: {error}")
+    print(f"   - Время: {elapsed:.1f} с, {stats['sent'] / elapsed if elapsed else 0:.1f} сообщений/с")
+    return stats
+
+async def send_broadcast(bot=None):
+    """Рассылка всем пользователям бота; вместо настоящего Bot можно передать поддельный"""
+    checkpoint_path = os.path.join(BOT_DIR, CHECKPOINT_FILE)
+    if bot is None:
+        async with Bot(token=TOKEN) as bot:
+            await broadcast(bot, iter_user_ids(), checkpoint_path)
+    else:
+        await broadcast(bot, iter_user_ids(), checkpoint_path)
     print("✅ Отправлено")
 
 if __name__ == "__main__":
-    asyncio.run(send_test_message())
+    asyncio.run(send_broadcast())